@@ -0,0 +1,130 @@
+"""
+Compares the bot's default gateway mode with its lean mode (LEAN=1).
+
+A mix of gateway events like a busy server's (chat messages, typing, reacts)
+is fed through discord.py's event parsing, the same as if they'd come from the
+gateway. In lean mode, events that the bot's intents don't ask for are
+dropped, since discord wouldn't send them. Reports how many events each mode
+handles per second, how much cpu time parsing them takes, and how much memory
+discord.py's caches end up using.
+
+usage: python -m bench.gateway [--guilds N] [--duration S] [--seed N]
+"""
+import argparse
+import asyncio
+from contextlib import redirect_stdout
+from itertools import count
+import os
+import random
+from time import perf_counter
+import tracemalloc
+
+from discord import ClientUser
+
+from src.bot_stuff import Bot, bot_options
+
+# same as in main.py, which can't be imported without a bot token
+EXTENSIONS = ['src.pug', 'src.eggs']
+
+BOT_ID = 1
+CHANNELS_PER_GUILD = 5
+USERS_PER_GUILD = 200
+
+# (gateway event, intent that it needs, events per second in each guild)
+EVENT_MIX = [
+    ('MESSAGE_CREATE',       'guild_messages',  2),
+    ('TYPING_START',         'guild_typing',    3),
+    ('MESSAGE_REACTION_ADD', 'guild_reactions', 1),
+]
+
+
+def user(user_id):
+    return { 'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0000', 'avatar': None }
+
+def guild_data(guild_id):
+    return {
+        'id': str(guild_id), 'name': f'guild{guild_id}', 'member_count': USERS_PER_GUILD,
+        'roles': [], 'emojis': [], 'members': [], 'presences': [], 'voice_states': [],
+        'channels': [{ 'id': str(guild_id * 100 + i), 'type': 0, 'name': f'chan{i}', 'position': i,
+                       'permission_overwrites': [] } for i in range(CHANNELS_PER_GUILD)],
+    }
+
+def make_events(guilds, duration, rand):
+    ids = count(10**6)
+    events = []
+    for guild_id in range(1, guilds + 1):
+        for name, intent, rate in EVENT_MIX:
+            for _ in range(int(rate * duration)):
+                chan_id = guild_id * 100 + rand.randrange(CHANNELS_PER_GUILD)
+                user_id = 1000 + rand.randrange(USERS_PER_GUILD)
+                member = { 'user': user(user_id), 'roles': [], 'joined_at': '2020-01-01T00:00:00+00:00', 'deaf': False, 'mute': False }
+                data = { 'channel_id': str(chan_id), 'guild_id': str(guild_id) }
+                if name == 'MESSAGE_CREATE':
+                    data.update(id=str(next(ids)), author=user(user_id), member=member, content='lol',
+                                timestamp='2020-01-01T00:00:00+00:00', edited_timestamp=None, tts=False,
+                                mention_everyone=False, mentions=[], mention_roles=[], attachments=[],
+                                embeds=[], pinned=False, type=0)
+                elif name == 'TYPING_START':
+                    data.update(user_id=str(user_id), timestamp=0, member=member)
+                else:
+                    data.update(user_id=str(user_id), message_id=str(rand.randrange(10**6, 10**7)),
+                                emoji={ 'name': 'XD', 'id': None }, member=member)
+                events.append((name, intent, data))
+    rand.shuffle(events)
+    return events
+
+async def run_mode(lean, guilds, events, duration):
+    bot = Bot(**bot_options(EXTENSIONS, lean=lean), command_prefix='dont care')
+    state = bot._connection
+    state.user = ClientUser(state=state, data=user(BOT_ID))
+    for guild_id in range(1, guilds + 1):
+        state._add_guild_from_data(guild_data(guild_id))
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    handled, start = 0, perf_counter()
+    for name, intent, data in events:
+        if not getattr(state._intents, intent):
+            # discord wouldn't send this one
+            continue
+        handled += 1
+        getattr(state, f'parse_{name.lower()}')(data)
+    parse_time = perf_counter() - start
+    # let the dispatched events get handled
+    await asyncio.sleep(0)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'events/s': handled / duration,
+        'parse cpu ms/s': parse_time / duration * 1000,
+        'cache bytes': after - before,
+        'cached messages': len(state._messages or ()),
+    }
+
+async def run(guilds=20, duration=60, seed=0):
+    """ Returns a dict of results for each mode """
+    events = make_events(guilds, duration, random.Random(seed))
+    return { 'default': await run_mode(False, guilds, events, duration),
+             'lean':    await run_mode(True, guilds, events, duration) }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=60, help='seconds of events to simulate')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        results = asyncio.get_event_loop().run_until_complete(run(**vars(args)))
+    names = list(results['default'])
+    width = max(map(len, names))
+    print(f"{''.ljust(width)}  {'default':>12}  {'lean':>12}")
+    for name in names:
+        values = (f"{results[mode][name]:.2f}" if isinstance(results[mode][name], float) else results[mode][name]
+                  for mode in ('default', 'lean'))
+        print(f"{name.ljust(width)}  " + '  '.join(f"{v:>12}" for v in values))
+
+if __name__ == '__main__':
+    main()
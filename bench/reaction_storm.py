@@ -0,0 +1,502 @@
+"""
+Floods lots of channels with reaction events, and measures how the bot keeps up.
+
+The bot runs for real (events go through on_raw_reaction(), update_reacts()
+and update_state()), but its http client is swapped out for a fake discord
+backend that has discord's rate limits and some latency. Each channel is
+started in the idle state and gets a stream of random react adds/removes from
+fewer than MIN_PLAYERS users, so it stays idle and every event is a render.
+
+Edits that only happened because rendering isn't deterministic (i.e. that
+wouldn't be needed if both renders used the same random numbers) are counted
+separately. Use --reloads to see them, since the render cache otherwise hides
+them.
+
+With --workers, the storm is run once for each number of workers given, split
+across that many processes like WORKERS does (see main.py and shards.py). Each
+worker is a ShardedBot that only has the guilds on its own shards, and gets
+their events through discord.py's gateway parsing, like in bench/gateway.py.
+Reports how many events per second the workers handle between them.
+
+usage: python -m bench.reaction_storm [--channels N] [--rate N] [--duration S] [--workers N ...] ...
+"""
+import argparse
+import asyncio
+from collections import Counter, defaultdict
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field, replace
+from itertools import count
+from multiprocessing import Barrier, Pipe, Process
+import os
+import random
+import sys
+from threading import Thread
+from time import monotonic, process_time
+
+from discord import ClientUser, PartialEmoji, RawReactionActionEvent
+
+from bench.gateway import CHANNELS_PER_GUILD, guild_data, user
+from src import mem, names, states
+from src.bot_stuff import Bot, ShardedBot, fingerprint
+from src.scheduler import Bucket
+from src.shards import Peer, Router, shard_for, worker_shards
+from src.states import CAPT_EMOJI, HOST_EMOJI, MIN_PLAYERS, OPTION_EMOJIS, IdleState
+from src.utils import first
+
+BOT_ID   = 1
+OWNER_ID = 2
+GUILD_ID = 3
+
+# discord's actual limits, as (number of requests, per seconds). see
+# ROUTE_LIMITS in scheduler.py for the (slightly lower) ones the bot uses.
+DISCORD_GLOBAL_LIMIT = (50, 1)
+DISCORD_ROUTE_LIMITS = {
+    'message':  (5, 5),
+    'delete':   (5, 1),
+    'reaction': (1, 0.25),
+    'fetch':    (50, 1),
+    'user':     (50, 1),
+}
+
+# emojis that users react with
+USER_EMOJIS = [HOST_EMOJI, CAPT_EMOJI, *OPTION_EMOJIS[:4]]
+
+
+@dataclass
+class FakeMessage:
+    content: str
+    embed: dict
+    reactions: dict = field(default_factory=lambda: defaultdict(set))
+
+
+class FakeHTTP:
+    """
+    Stands in for discord.py's HTTPClient. Requests that go over a rate limit
+    get a 429, and are retried after waiting like discord.py does.
+    """
+
+    def __init__(self, latency, workers=1):
+        self.latency = latency
+        # the global limit is shared by every worker
+        limit, per = DISCORD_GLOBAL_LIMIT
+        self.global_bucket = Bucket(limit / workers, per)
+        self.buckets = {}
+        self.ids = count(1000)
+        self.messages = {}
+        self.calls = Counter()
+        self.rate_limited = 0
+
+    async def call(self, method, route, chan_id):
+        if (route, chan_id) not in self.buckets:
+            self.buckets[route, chan_id] = Bucket(*DISCORD_ROUTE_LIMITS[route])
+        bucket = self.buckets[route, chan_id]
+        while True:
+            await asyncio.sleep(self.latency)
+            now = monotonic()
+            retry_after = max(self.global_bucket.wait_time(now), bucket.wait_time(now))
+            if retry_after == 0:
+                break
+            self.rate_limited += 1
+            await asyncio.sleep(retry_after)
+        self.global_bucket.take()
+        bucket.take()
+        self.calls[method] += 1
+
+    async def send_message(self, channel_id, content, *, embed=None, **kwargs):
+        await self.call('send_message', 'message', channel_id)
+        msg_id = next(self.ids)
+        self.messages[msg_id] = FakeMessage(content, embed)
+        return { 'id': str(msg_id) }
+
+    async def edit_message(self, channel_id, message_id, **fields):
+        await self.call('edit_message', 'message', channel_id)
+        msg = self.messages[message_id]
+        msg.content, msg.embed = fields.get('content'), fields.get('embed')
+
+    async def delete_message(self, channel_id, message_id, **kwargs):
+        await self.call('delete_message', 'delete', channel_id)
+        del self.messages[message_id]
+
+    async def add_reaction(self, channel_id, message_id, emoji):
+        await self.call('add_reaction', 'reaction', channel_id)
+        self.messages[message_id].reactions[emoji].add(BOT_ID)
+
+    async def remove_own_reaction(self, channel_id, message_id, emoji):
+        await self.call('remove_own_reaction', 'reaction', channel_id)
+        self.messages[message_id].reactions[emoji].discard(BOT_ID)
+
+    async def remove_reaction(self, channel_id, message_id, emoji, member_id):
+        await self.call('remove_reaction', 'reaction', channel_id)
+        self.messages[message_id].reactions[emoji].discard(member_id)
+
+    async def clear_single_reaction(self, channel_id, message_id, emoji):
+        await self.call('clear_single_reaction', 'reaction', channel_id)
+        self.messages[message_id].reactions.pop(emoji, None)
+
+    async def clear_reactions(self, channel_id, message_id):
+        await self.call('clear_reactions', 'reaction', channel_id)
+        self.messages[message_id].reactions.clear()
+
+    async def get_message(self, channel_id, message_id):
+        await self.call('get_message', 'fetch', channel_id)
+        msg = self.messages[message_id]
+        return { 'id': str(message_id),
+                 'reactions': [{ 'emoji': { 'name': e, 'id': None }, 'count': len(users) }
+                               for e, users in msg.reactions.items() if users] }
+
+    async def get_reaction_users(self, channel_id, message_id, emoji, limit, after=None):
+        await self.call('get_reaction_users', 'fetch', channel_id)
+        users = sorted(u for u in self.messages[message_id].reactions[emoji] if after is None or u > after)
+        return [{ 'id': str(u) } for u in users[:limit]]
+
+    async def get_user(self, user_id):
+        await self.call('get_user', 'user', None)
+        return { 'id': str(user_id), 'username': f'user{user_id}' }
+
+
+def deep_sizeof(obj, seen=None):
+    """ Roughly how many bytes an object takes up, including what it refers to """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (Bot, asyncio.Future, asyncio.Lock, type)):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(e, seen) for e in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    for cls in type(obj).__mro__:
+        for slot in getattr(cls, '__slots__', ()):
+            size += deep_sizeof(getattr(obj, slot, None), seen)
+    return size
+
+def empty_render_caches():
+    """ Empties the render caches, which is what reloading the bot does """
+    classes = [states.State]
+    for cls in classes:
+        classes += cls.__subclasses__()
+        for attr in vars(cls).values():
+            if isinstance(attr, states.renders):
+                attr.cache.clear()
+
+def fresh_render(state, random_state):
+    """
+    Renders a state from scratch, skipping the render cache, with the global
+    RNG set to 'random_state'
+    """
+    render = type(state).messages
+    render = getattr(render, 'render', None) or render.fget
+    saved, _ = random.getstate(), random.setstate(random_state)
+    try:
+        return render(replace(state))
+    finally:
+        random.setstate(saved)
+
+def nondeterministic_edits(old_state, old_msgs, new_state, new_msgs):
+    """
+    Returns how many of the edits between two states were only caused by
+    randomness in rendering, i.e. they wouldn't have been needed if both
+    renders had used the same random numbers
+    """
+    edited = [k for k in old_msgs.keys() & new_msgs.keys() if fingerprint(old_msgs[k]) != fingerprint(new_msgs[k])]
+    if not edited:
+        return 0
+    random_state = random.Random(0).getstate()
+    old_fresh, new_fresh = fresh_render(old_state, random_state), fresh_render(new_state, random_state)
+    return sum(fingerprint(old_fresh.get(k)) == fingerprint(new_fresh.get(k)) for k in edited)
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def shard_guilds(channels, shard_count):
+    """
+    Returns { guild id: its channel ids } for enough guilds to have 'channels'
+    channels, spread evenly over the shards
+    """
+    guilds = {}
+    for i in range(-(-channels // CHANNELS_PER_GUILD)):
+        guild_id = (i + 1) << 22
+        assert shard_for(guild_id, shard_count) == (i + 1) % shard_count
+        n = min(CHANNELS_PER_GUILD, channels - i * CHANNELS_PER_GUILD)
+        guilds[guild_id] = [guild_id * 100 + j for j in range(n)]
+    return guilds
+
+async def run(channels=100, users=MIN_PLAYERS - 1, rate=20, duration=10, latency=0.05, seed=0,
+              deterministic=True, reloads=0, worker=0, workers=1, shard_count=None, conn=None, barrier=None,
+              latencies=None):
+    """
+    Runs the storm and returns a dict of results. 'rate' is the number of
+    events per second in each channel. 'deterministic' sets
+    DETERMINISTIC_RENDERS while it runs, and 'reloads' is how many times the
+    render caches get emptied during the storm, like reloading the bot does.
+
+    If 'shard_count' is set, this is one of 'workers' worker processes (see
+    run_workers()), which only runs the channels on its own shards. 'conn' is
+    its connection to the router, and 'barrier' is shared with the other
+    workers so that they all storm at the same time. Event latencies get added
+    to 'latencies' if it's given.
+    """
+    # more users than this would start the pug
+    assert users < MIN_PLAYERS
+    was_deterministic, states.DETERMINISTIC_RENDERS = states.DETERMINISTIC_RENDERS, deterministic
+    rand = random.Random(seed + worker)
+    http = FakeHTTP(latency, workers)
+
+    if shard_count is None:
+        bot = Bot(command_prefix='dont care')
+        chan_ids = list(range(10_000, 10_000 + channels))
+        guild_ids = dict.fromkeys(chan_ids, GUILD_ID)
+    else:
+        bot = ShardedBot(command_prefix='dont care', worker=worker, workers=workers,
+                         shard_ids=worker_shards(worker, workers, shard_count), shard_count=shard_count)
+        guild_ids = {}
+        for guild_id, guild_chan_ids in shard_guilds(channels, shard_count).items():
+            # discord only sends us the guilds on our shards
+            if shard_for(guild_id, shard_count) in bot.shard_ids:
+                bot._connection._add_guild_from_data(guild_data(guild_id))
+                guild_ids.update(dict.fromkeys(guild_chan_ids, guild_id))
+        chan_ids = list(guild_ids)
+        bot.peer = Peer(conn, bot.handlers)
+        bot.peer.start(asyncio.get_running_loop())
+    bot._connection.http = http
+    bot._connection.user = ClientUser(state=bot._connection, data={
+        'id': BOT_ID, 'username': 'pugbot', 'discriminator': '0000', 'avatar': None })
+    bot.owner_id = OWNER_ID
+    bot.load_extension('src.pug')
+    pug = bot.extensions['src.pug']
+    # the owner starts every channel with a command, which is where the bot
+    # gets their name from
+    names.remember(OWNER_ID, 'owner')
+
+    async def sync():
+        # wait for every worker to get here. the loop keeps running meanwhile,
+        # so that broadcasts still get answered.
+        if barrier is not None:
+            await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+    def react_event(chan_id, msg_id, user_id, emoji, added):
+        if shard_count is None:
+            bot.dispatch('raw_reaction_add' if added else 'raw_reaction_remove', RawReactionActionEvent(
+                { 'message_id': msg_id, 'channel_id': chan_id, 'user_id': user_id, 'guild_id': GUILD_ID },
+                PartialEmoji(name=emoji), 'REACTION_ADD' if added else 'REACTION_REMOVE'))
+            return
+        # the same as what the gateway sends
+        data = { 'message_id': str(msg_id), 'channel_id': str(chan_id), 'user_id': str(user_id),
+                 'guild_id': str(guild_ids[chan_id]), 'emoji': { 'name': emoji, 'id': None } }
+        if added:
+            data['member'] = { 'user': user(user_id), 'roles': [], 'joined_at': '2020-01-01T00:00:00+00:00',
+                               'deaf': False, 'mute': False }
+            bot._connection.parse_message_reaction_add(data)
+        else:
+            bot._connection.parse_message_reaction_remove(data)
+
+    """
+    Time how long it takes for events to show up on discord. An event counts as
+    rendered once the next update_state() that starts after it's been received
+    finishes. Events that don't end up changing anything get counted when the
+    channel's next render finishes.
+    """
+    received = defaultdict(list)
+    if latencies is None:
+        latencies = []
+    transitions = n_nondeterministic = 0
+    # the state each channel last finished updating to, and its messages.
+    # 'ctx.state' can't be used as the old state, since react batches get
+    # applied to it before their update starts.
+    sent = {}
+    real_update_state = pug.update_state
+    async def update_state(bot, ctx, chan_id, next_state_fn):
+        nonlocal transitions, n_nondeterministic
+        events, received[chan_id] = received[chan_id], []
+        transitions += 1
+        if (state := await real_update_state(bot, ctx, chan_id, next_state_fn)) is None:
+            # a newer update took over, so these events are done when it is
+            received[chan_id][:0] = events
+            return
+        done = monotonic()
+        latencies.extend(done - t for t in events)
+        if chan_id in sent:
+            n_nondeterministic += nondeterministic_edits(*sent[chan_id], state, ctx.messages)
+        sent[chan_id] = (state, ctx.messages)
+        return state
+    pug.update_state = update_state
+
+    try:
+        await asyncio.gather(*(
+            update_state(bot, mem.chan_ctxs[chan_id], chan_id,
+                         lambda c: IdleState.make(c.state, admin_ids=c.state.admin_ids | { OWNER_ID }))
+            for chan_id in chan_ids))
+        setup_calls = sum(http.calls.values())
+        setup_429s, http.rate_limited = http.rate_limited, 0
+        http.calls.clear()
+        latencies.clear()
+        transitions = n_nondeterministic = 0
+        await sync()
+
+        async def storm(chan_id):
+            user_ids = range(100, 100 + users)
+            end = monotonic() + duration
+            while monotonic() < end:
+                await asyncio.sleep(rand.expovariate(rate))
+                msg_id = first(mem.chan_ctxs[chan_id].msg_id_map.values())
+                user_id, emoji = rand.choice(user_ids), rand.choice(USER_EMOJIS)
+
+                # toggle the react on discord's side, then tell the bot about it
+                reacted = http.messages[msg_id].reactions[emoji]
+                added = user_id not in reacted
+                (reacted.add if added else reacted.discard)(user_id)
+                received[chan_id].append(monotonic())
+                react_event(chan_id, msg_id, user_id, emoji, added)
+
+        async def reload():
+            for _ in range(reloads):
+                await asyncio.sleep(duration / (reloads + 1))
+                empty_render_caches()
+
+        start, start_cpu = monotonic(), process_time()
+        await asyncio.gather(reload(), *map(storm, chan_ids))
+        n_events = len(latencies) + sum(map(len, received.values()))
+
+        # let the bot catch up
+        while any(mem.chan_ctxs[c].react_task or mem.chan_ctxs[c].lock.locked() or c in mem.update_tasks
+                  for c in chan_ids):
+            await asyncio.sleep(0.01)
+        elapsed, cpu = monotonic() - start, process_time() - start_cpu
+
+        results = {
+            'channels': len(chan_ids),
+            'events': n_events,
+            'events/s': n_events / elapsed,
+            'cpu seconds': cpu,
+            'latency p50 (ms)': percentile(latencies, 50) * 1000,
+            'latency p90 (ms)': percentile(latencies, 90) * 1000,
+            'latency p99 (ms)': percentile(latencies, 99) * 1000,
+            'latency max (ms)': max(latencies, default=float('nan')) * 1000,
+            'transitions': transitions,
+            'api calls': sum(http.calls.values()),
+            'api calls/transition': sum(http.calls.values()) / max(transitions, 1),
+            'api calls by method': dict(http.calls.most_common()),
+            'nondeterministic edits': n_nondeterministic,
+            '429s': http.rate_limited,
+            'setup api calls': setup_calls,
+            'setup 429s': setup_429s,
+            'bytes/channel': sum(deep_sizeof(mem.chan_ctxs[c]) for c in chan_ids) / max(len(chan_ids), 1),
+        }
+        if shard_count is not None:
+            # check that the status command sees every worker's channels
+            await sync()
+            if worker == 0:
+                status = await bot.broadcast('status')
+                results['channels in status'] = sum(len(rows) for rows, _ in filter(None, status))
+            await sync()
+        return results
+    finally:
+        pug.update_state = real_update_state
+        states.DETERMINISTIC_RENDERS = was_deterministic
+        for chan_id in chan_ids:
+            mem.chan_ctxs.pop(chan_id, None)
+
+
+def storm_worker(worker, workers, conn, results_conn, barrier, kwargs):
+    """ Runs in each worker process, see run_workers() """
+    asyncio.set_event_loop(loop := asyncio.new_event_loop())
+    latencies = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(sys.stdout if kwargs.pop('verbose') else devnull):
+        results = loop.run_until_complete(run(worker=worker, workers=workers, conn=conn, barrier=barrier,
+                                              latencies=latencies, **kwargs))
+    results_conn.send((results, latencies))
+
+def run_workers(workers, shard_count=None, verbose=False, **kwargs):
+    """
+    Runs the storm split across 'workers' processes, with a router between
+    them like main.py does, and returns the combined results
+    """
+    shard_count = shard_count or workers
+    barrier = Barrier(workers)
+    pipes, results_pipes = [Pipe() for _ in range(workers)], [Pipe(duplex=False) for _ in range(workers)]
+    procs = [Process(target=storm_worker, name=f'worker-{i}',
+                     args=(i, workers, worker_conn, results_conn, barrier,
+                           dict(kwargs, shard_count=shard_count, verbose=verbose)))
+             for i, ((_, worker_conn), (_, results_conn)) in enumerate(zip(pipes, results_pipes))]
+    for proc in procs:
+        proc.start()
+    for (_, worker_conn), (_, results_conn) in zip(pipes, results_pipes):
+        # so that the router sees EOF once the worker exits
+        worker_conn.close()
+        results_conn.close()
+    router = Thread(target=Router(router_conn for router_conn, _ in pipes).run)
+    router.start()
+
+    results, latencies = [], []
+    for results_conn, _ in results_pipes:
+        worker_results, worker_latencies = results_conn.recv()
+        results.append(worker_results)
+        latencies += worker_latencies
+    for proc in procs:
+        proc.join()
+    router.join()
+
+    total = lambda name: sum(r[name] for r in results)
+    return {
+        'workers': workers,
+        'shards': shard_count,
+        'channels': total('channels'),
+        'events': total('events'),
+        # the workers run at the same time, so their rates add up
+        'events/s': total('events/s'),
+        'max cpu seconds/worker': max(r['cpu seconds'] for r in results),
+        'latency p50 (ms)': percentile(latencies, 50) * 1000,
+        'latency p99 (ms)': percentile(latencies, 99) * 1000,
+        'api calls': total('api calls'),
+        '429s': total('429s'),
+        'channels in status': results[0]['channels in status'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--users', type=int, default=MIN_PLAYERS - 1, help='users reacting in each channel')
+    parser.add_argument('--rate', type=float, default=20, help='events per second in each channel')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send events for')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake api latency, in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nondeterministic', dest='deterministic', action='store_false',
+                        help='turn off DETERMINISTIC_RENDERS')
+    parser.add_argument('--reloads', type=int, default=0, help='times to empty the render caches, like a reload does')
+    parser.add_argument('--workers', type=int, nargs='+', help='numbers of worker processes to compare')
+    parser.add_argument('--shards', type=int, dest='shard_count',
+                        help='gateway shards to split between the workers, defaults to the most workers')
+    parser.add_argument('--verbose', action='store_true', help="show the bot's output")
+    args = parser.parse_args()
+
+    if (worker_counts := vars(args).pop('workers')):
+        args.shard_count = args.shard_count or max(worker_counts)
+        rows = [run_workers(n, **vars(args)) for n in worker_counts]
+        columns = list(rows[0])
+        print('  '.join(f"{name:>{max(len(name), 8)}}" for name in columns))
+        for row in rows:
+            print('  '.join(f"{row[name]:>{max(len(name), 8)}.2f}" if isinstance(row[name], float) else
+                            f"{row[name]:>{max(len(name), 8)}}" for name in columns))
+        return
+    if vars(args).pop('shard_count'):
+        parser.error('--shards needs --workers')
+
+    verbose = vars(args).pop('verbose')
+    with open(os.devnull, 'w') as devnull, redirect_stdout(sys.stdout if verbose else devnull):
+        results = asyncio.get_event_loop().run_until_complete(run(**vars(args)))
+    width = max(map(len, results))
+    for name, value in results.items():
+        value = f"{value:.2f}" if isinstance(value, float) else value
+        print(f"{name.ljust(width)}  {value}")
+
+if __name__ == '__main__':
+    main()
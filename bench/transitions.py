@@ -0,0 +1,98 @@
+"""
+Measures how long state transitions take, without touching discord.
+
+A stream of random react adds/removes is applied to an idle state, and each
+event's transitions are run the synchronous way (reduce_sequence(), which
+doesn't need an event loop) and the old async way (draining on_update(), then
+calling on_update() again on the final state to see if it's stable).
+
+usage: python -m bench.transitions [--events N] [--users N] [--seed N]
+"""
+import argparse
+import asyncio
+from dataclasses import replace
+import random
+from time import perf_counter
+
+from discord import ClientUser
+
+from src.bot_stuff import Bot
+from src.pug import reduce_sequence
+from src.states import CAPT_EMOJI, HOST_EMOJI, MIN_PLAYERS, OPTION_EMOJIS, IdleState, React, Reacts, State
+
+USER_EMOJIS = [HOST_EMOJI, CAPT_EMOJI, *OPTION_EMOJIS[:4]]
+
+
+async def probe_sequence(start_state):
+    state_seq = start_state.on_update()
+    while True:
+        async for state in state_seq:
+            yield state
+        state_seq = state.on_update()
+        if state == (next_state := await state_seq.__anext__()):
+            await state_seq.aclose()
+            return
+        yield (state := next_state)
+
+def make_events(n, users, seed):
+    """ Returns a list of reacts to toggle """
+    rand = random.Random(seed)
+    return [Reacts([React(100 + rand.randrange(users), rand.choice(USER_EMOJIS))]) for _ in range(n)]
+
+def toggle(reacts, react):
+    return reacts - react if react <= reacts else reacts | react
+
+def run(events=10_000, users=MIN_PLAYERS - 1, seed=0):
+    """ Returns a dict of results """
+    bot = Bot(command_prefix='dont care')
+    bot._connection.user = ClientUser(state=bot._connection, data={
+        'id': 1, 'username': 'pugbot', 'discriminator': '0000', 'avatar': None })
+    start_state = IdleState.make(State(bot, { 2 }, frozenset(), ()))
+    events_seq = make_events(events, users, seed)
+
+    # each event starts from the state the last one ended up in, like in
+    # update_state(), so that states can reuse work from earlier ones
+    start = perf_counter()
+    n_sync, state = 0, start_state
+    for react in events_seq:
+        for state in reduce_sequence(replace(state, reacts=toggle(state.reacts, react))):
+            n_sync += 1
+    sync_time = perf_counter() - start
+
+    async def run_async():
+        n, state = 0, start_state
+        for react in events_seq:
+            async for state in probe_sequence(replace(state, reacts=toggle(state.reacts, react))):
+                n += 1
+        return n
+    loop = asyncio.new_event_loop()
+    start = perf_counter()
+    n_async = loop.run_until_complete(run_async())
+    async_time = perf_counter() - start
+    loop.close()
+
+    assert n_sync == n_async
+    return {
+        'events': events,
+        'states': n_sync,
+        'sync us/event': sync_time / events * 1e6,
+        'async us/event': async_time / events * 1e6,
+        'speedup': async_time / sync_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, default=10_000)
+    parser.add_argument('--users', type=int, default=MIN_PLAYERS - 1, help='users reacting')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = run(**vars(args))
+    width = max(map(len, results))
+    for name, value in results.items():
+        value = f"{value:.2f}" if isinstance(value, float) else value
+        print(f"{name.ljust(width)}  {value}")
+
+if __name__ == '__main__':
+    main()
@@ -4,34 +4,83 @@ import sys
 from discord.ext import commands
 
 BOT_TOKEN  = os.environ['BOT_TOKEN']
-MODULES    = ['src.bot_stuff', 'src.states', 'src.utils']  # TODO: use sys.modules to generate this?
+MODULES    = ['src.animation', 'src.bot_stuff', 'src.metrics', 'src.names', 'src.persist', 'src.reacts', 'src.scheduler', 'src.shards', 'src.states', 'src.utils']  # TODO: use sys.modules to generate this?
 EXTENSIONS = ['src.pug', 'src.eggs']
 
+# how many processes to split the bot across, and how many gateway shards to
+# split between them. see src/shards.py.
+WORKERS     = int(os.environ.get('WORKERS', 1))
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', WORKERS))
+# if set, only ask discord for the events the extensions need, and turn off
+# the caches they don't use
+LEAN = bool(int(os.environ.get('LEAN', 0)))
+
 
 # from src import PRELOADED_MODULES
 # print(f"i see {len(PRELOADED_MODULES)} preloaded modules")
 
-if __name__ == '__main__':
-    from src.bot_stuff import Bot
-    bot = Bot(command_prefix=commands.when_mentioned)
-
+def run_bot(bot):
     @bot.listen()
     async def on_ready():
         print(f'We have logged in as {bot.user}')
 
-    @bot.command(aliases=['r'], hidden=True)
-    @commands.is_owner()
-    async def reload(ctx):
-        await ctx.send('Reloading.')
+    async def reload_worker():
         try:
             bot.reload_extension('main')
         except commands.ExtensionNotLoaded:
             bot.load_extension('main')
+    bot.handlers['reload'] = reload_worker
+
+    @bot.command(aliases=['r'], hidden=True)
+    @commands.is_owner()
+    async def reload(ctx):
+        await ctx.send('Reloading.')
+        await bot.broadcast('reload')
 
     bot.load_extension('main')
     bot.run(BOT_TOKEN)
     print(f"done with {bot.user}")
 
+    # flush the saved channel states
+    from src import mem
+    if mem.store is not None:
+        mem.store.close()
+
+
+def run_worker(worker, conn):
+    from src.bot_stuff import ShardedBot, bot_options
+    from src.shards import Peer, worker_shards
+    shard_ids = worker_shards(worker, WORKERS, SHARD_COUNT)
+    print(f"worker {worker} running shards {shard_ids}")
+
+    bot = ShardedBot(command_prefix=commands.when_mentioned, worker=worker, workers=WORKERS,
+                     shard_ids=shard_ids, shard_count=SHARD_COUNT, **bot_options(EXTENSIONS, LEAN))
+    bot.peer = Peer(conn, bot.handlers)
+    bot.peer.start(bot.loop)
+    run_bot(bot)
+
+
+if __name__ == '__main__':
+    if WORKERS == 1:
+        from src.bot_stuff import Bot, bot_options
+        run_bot(Bot(command_prefix=commands.when_mentioned, **bot_options(EXTENSIONS, LEAN)))
+    else:
+        # each worker runs some of the shards, and the router lets the workers
+        # talk to each other. see src/shards.py.
+        from multiprocessing import Pipe, Process
+        from src.shards import Router
+        pipes = [Pipe() for _ in range(WORKERS)]
+        procs = [Process(target=run_worker, args=(i, worker_conn), name=f'worker-{i}')
+                 for i, (_, worker_conn) in enumerate(pipes)]
+        for proc in procs:
+            proc.start()
+        for _, worker_conn in pipes:
+            # so that the router sees EOF once the worker exits
+            worker_conn.close()
+        Router(router_conn for router_conn, _ in pipes).run()
+        for proc in procs:
+            proc.join()
+
 
 def setup(bot):
     print()
@@ -0,0 +1,86 @@
+"""
+A shared clock for animated states (e.g. DanceState). Instead of each one
+editing on its own timer, they all get their frames from here, out of a
+budget that's shared by every channel. The more animations there are, the
+lower each one's frame rate, and frames that can't be drawn in time are
+skipped rather than queued up. Animations also give way to everything else:
+no frames are handed out while other requests are waiting to be sent, and
+their edits are sent with the lowest priority.
+"""
+import asyncio
+from bisect import bisect_right
+from itertools import accumulate
+from time import monotonic
+
+from . import mem, metrics
+from .scheduler import ANIMATE, Bucket
+
+# how many frames can be drawn every so many seconds, across every channel
+FRAME_BUDGET = (5, 1)
+# the fastest and slowest each animation can go, in seconds per frame
+MIN_FRAME_INTERVAL = 1
+MAX_FRAME_INTERVAL = 10
+# how long to wait before checking again when other requests are waiting
+BUSY_WAIT = 0.25
+
+_budget = Bucket(*FRAME_BUDGET)
+
+
+def frame_interval():
+    """ Returns how long each animation has to wait between frames right now """
+    limit, per = FRAME_BUDGET
+    return min(MAX_FRAME_INTERVAL, max(MIN_FRAME_INTERVAL, len(mem.animations) * per / limit))
+
+def frame_start(idx, durations):
+    """ Returns when frame 'idx' starts, for frames that last 'durations' """
+    return sum(durations[:idx])
+
+def _locate(t, durations):
+    """ Returns (loops, idx, ends) for 't' seconds into a looping animation """
+    ends = list(accumulate(durations))
+    # the epsilon is so that a frame that's due shows even with rounding errors
+    loops, offset = divmod(t + 1e-6, ends[-1])
+    return loops, bisect_right(ends, offset), ends
+
+def frame_at(t, durations):
+    """ Returns which frame is showing 't' seconds into a looping animation """
+    return _locate(t, durations)[1]
+
+def frame_end(t, durations):
+    """ Returns when the frame that's showing at 't' ends """
+    loops, idx, ends = _locate(t, durations)
+    return loops * ends[-1] + ends[idx]
+
+
+class Animation:
+    """ The frames of one running animation, see next_frame() """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.last = monotonic()
+
+    async def next_frame(self, due):
+        """
+        Waits until the next frame can be drawn, which is no sooner than 'due'
+        (a monotonic() time). Returns the time it's drawn at, which can be
+        much later than 'due' when there's a lot going on.
+        """
+        # animations only count towards the budget while they're waiting,
+        # so ones that have stopped don't need to be cleaned up
+        mem.animations.add(self)
+        try:
+            while True:
+                now = monotonic()
+                wait = max(due - now, self.last + frame_interval() - now, _budget.wait_time(now))
+                if wait <= 0:
+                    if not self.bot.scheduler.waiting(ANIMATE):
+                        _budget.take()
+                        self.last = now
+                        metrics.inc('animation_frames')
+                        return now
+                    # something more important needs the rate limit
+                    metrics.inc('animation_frames_deferred')
+                    wait = BUSY_WAIT
+                await asyncio.sleep(wait)
+        finally:
+            mem.animations.discard(self)
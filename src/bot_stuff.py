@@ -1,187 +1,315 @@
 import asyncio
-from collections import defaultdict
-from itertools import chain, starmap
+from collections import OrderedDict
+from functools import cached_property, partial
+import hashlib
+from importlib import import_module
+import json
 from operator import attrgetter as get
 
-from discord import Embed, Message
+from discord import Embed, Intents, MemberCacheFlags, Message, PartialEmoji
 from discord.ext import commands
+try:
+    from discord.message import convert_emoji_reaction
+except ImportError:
+    # older versions of discord.py
+    convert_emoji_reaction = Message._emoji_reaction
 
-from .utils import as_fut, create_index, first, invert_dict, retval_as_fut
+from . import metrics
+from .scheduler import GLOBAL_LIMIT, Scheduler, EDIT, SEND, REACT, DELETE, CLEANUP, SYNC
+from .utils import as_fut, create_index, first, min_cost_assignment, retval_as_fut
 
 # TODO: rename file to discord_stuff?
 
+# how many api calls losing a user's reaction is worth. see update_discord().
+LOST_USER_REACT_COST = 1000
+INVALID_COST = float('inf')
+
+# how many messages to remember the payloads/fingerprints of
+PAYLOAD_CACHE_SIZE = 1024
+
+
+def bot_options(extensions, lean=False):
+    """
+    Returns extra options to make a Bot with. In lean mode, we only ask discord
+    for the events that 'extensions' need (see their INTENTS), and turn off
+    the caches they don't use.
+    """
+    if not lean:
+        return {}
+    intents = Intents.none()
+    for ext in extensions:
+        intents.value |= import_module(ext).INTENTS.value
+    # the extensions never look at old messages or guild members
+    return { 'intents': intents, 'max_messages': None, 'chunk_guilds_at_startup': False,
+             'member_cache_flags': MemberCacheFlags.none() }
+
 
 class Bot(commands.Bot):
     @property
     def user_id(self):
         return self._connection.self_id
 
+    @cached_property
+    def scheduler(self):
+        return Scheduler()
+
+    # set when running as one of several worker processes, see shards.py
+    peer = None
+    worker, workers = 0, 1
+
+    @cached_property
+    def handlers(self):
+        """ Async functions that can be run in every worker with broadcast() """
+        return {}
+
+    async def broadcast(self, name, *args):
+        """ Returns a list with the result of running a handler in each worker """
+        if self.peer is None:
+            return [await self.handlers[name](*args)]
+        return await self.peer.broadcast(name, *args)
+
+    def owns_channel(self, chan_id):
+        return True
+
+    def request(self, priority, route, chan_id, method, *args, **kwargs):
+        """
+        Send a request through the scheduler instead of directly to the http
+        client. Nothing is queued until the returned coroutine is awaited.
+        """
+        return self.scheduler.request(priority, (route, chan_id), partial(method, *args, **kwargs))
+
     def send_message(self, chan_id, content_or_embed=None, /, *, content=None, embed=None):
         if content_or_embed:
             assert content is embed is None
-            (embed := content_or_embed) if isinstance(content_or_embed, Embed) else (content := content_or_embed)
+            (embed := content_or_embed) if isinstance(content_or_embed, (Embed, dict)) else (content := content_or_embed)
 
         # see: https://github.com/Rapptz/discord.py/blob/master/discord/abc.py#L781
         content = str(content) if content is not None else None
-        embed   = embed.to_dict() if embed is not None else None
+        embed   = payload(embed) if embed is not None else None
 
         assert content or embed
-        result  = self._connection.http.send_message(chan_id, content, embed=embed)
+        result  = self.request(SEND, 'message', chan_id, self._connection.http.send_message, chan_id, content, embed=embed)
         async def msg_id():
             return int((await result)['id'])
         return msg_id()
 
-    def edit_message(self, chan_id, msg_id, content_or_embed=None, /, *, content=None, embed=None):
+    def edit_message(self, chan_id, msg_id, content_or_embed=None, /, *, content=None, embed=None, priority=EDIT):
         if content_or_embed:
             assert content is embed is None
-            (embed := content_or_embed) if isinstance(content_or_embed, Embed) else (content := content_or_embed)
+            (embed := content_or_embed) if isinstance(content_or_embed, (Embed, dict)) else (content := content_or_embed)
 
         # see: https://github.com/Rapptz/discord.py/blob/master/discord/message.py#L754
         content = str(content) if content is not None else None
-        embed   = embed.to_dict() if embed is not None else None
+        embed   = payload(embed) if embed is not None else None
 
         assert content or embed
-        return self._connection.http.edit_message(chan_id, msg_id, content=content, embed=embed)
+        # only the latest edit to a message matters, so a newer one replaces
+        # an older one that hasn't been sent yet
+        return self.scheduler.request(priority, ('message', chan_id), key=('edit', msg_id),
+                                      make_coro=partial(self._connection.http.edit_message, chan_id, msg_id,
+                                                        content=content, embed=embed))
 
     def delete_message(self, chan_id, msg_id):
-        return self._connection.http.delete_message(chan_id, msg_id)
+        return self.request(DELETE, 'delete', chan_id, self._connection.http.delete_message, chan_id, msg_id)
 
     def add_reaction(self, chan_id, msg_id, emoji):
-        return self._connection.http.add_reaction(chan_id, msg_id, Message._emoji_reaction(emoji))
+        return self.request(REACT, 'reaction', chan_id, self._connection.http.add_reaction, chan_id, msg_id, convert_emoji_reaction(emoji))
 
     def remove_reaction(self, chan_id, msg_id, emoji, user_id):
-        emoji = Message._emoji_reaction(emoji)
+        emoji = convert_emoji_reaction(emoji)
         if user_id == self.user_id:
-            return self._connection.http.remove_own_reaction(chan_id, msg_id, emoji)
+            return self.request(CLEANUP, 'reaction', chan_id, self._connection.http.remove_own_reaction, chan_id, msg_id, emoji)
         else:
-            return self._connection.http.remove_reaction(chan_id, msg_id, emoji, user_id)
+            return self.request(CLEANUP, 'reaction', chan_id, self._connection.http.remove_reaction, chan_id, msg_id, emoji, user_id)
 
     def clear_reaction(self, chan_id, msg_id, emoji):
-        return self._connection.http.clear_single_reaction(chan_id, msg_id, Message._emoji_reaction(emoji))
+        return self.request(CLEANUP, 'reaction', chan_id, self._connection.http.clear_single_reaction, chan_id, msg_id, convert_emoji_reaction(emoji))
 
     def clear_reactions(self, chan_id, msg_id):
-        return self._connection.http.clear_reactions(chan_id, msg_id)
-
-
-async def update_discord(bot, chan_id, msg_ids, key_to_msg, key_to_new_msg, old_reacts, new_reacts):
+        return self.request(CLEANUP, 'reaction', chan_id, self._connection.http.clear_reactions, chan_id, msg_id)
+
+    async def reaction_counts(self, chan_id, msg_id):
+        """ Returns a mapping from emoji -> number of reactions on a message """
+        msg = await self.request(SYNC, 'fetch', chan_id, self._connection.http.get_message, chan_id, msg_id)
+        return { str(PartialEmoji(name=r['emoji']['name'], id=r['emoji'].get('id'),
+                                  animated=r['emoji'].get('animated', False))): r['count']
+                 for r in msg.get('reactions', []) }
+
+    async def reaction_users(self, chan_id, msg_id, emoji):
+        """ Returns the ids of every user that reacted to a message with an emoji """
+        user_ids, after = [], None
+        while True:
+            users = await self.request(SYNC, 'fetch', chan_id, self._connection.http.get_reaction_users,
+                                       chan_id, msg_id, convert_emoji_reaction(emoji), 100, after=after)
+            user_ids += (int(u['id']) for u in users)
+            if len(users) < 100:
+                return user_ids
+            after = user_ids[-1]
+
+    async def fetch_name(self, user_id):
+        """ Returns a user's name, fetched from discord """
+        user = await self.request(SYNC, 'user', None, self._connection.http.get_user, user_id)
+        return user.get('global_name') or user['username']
+
+
+class ShardedBot(Bot, commands.AutoShardedBot):
+    """ A Bot that's one of several worker processes, each running some of the shards """
+
+    def __init__(self, *args, worker=0, workers=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker = worker
+        self.workers = workers
+
+    @cached_property
+    def scheduler(self):
+        # discord's global rate limit is shared by every worker
+        limit, per = GLOBAL_LIMIT
+        return Scheduler(global_limit=(limit / self.workers, per))
+
+    def owns_channel(self, chan_id):
+        # we only get guilds (and their channels) for the shards we're running
+        return self.get_channel(chan_id) is not None
+
+
+async def update_discord(bot, chan_id, msg_ids, key_to_msg, key_to_new_msg, old_reacts, new_reacts, labels=None,
+                         edit_priority=EDIT, on_main_sent=None):
+    """
+    Updates discord to go from the old messages/reacts to the new ones, and
+    returns the new message id map. 'labels' are added to the metrics recorded
+    for the api calls made, and edits are sent with 'edit_priority'. If a new
+    main message gets sent, 'on_main_sent' is called with its id as soon as
+    it's known, since users can react to it before the rest is done.
+    """
     assert msg_ids.keys() == key_to_msg.keys()
-
-    # create a mapping from message content -> keys of messages with that content
-    msg_to_keys = defaultdict(set, invert_dict(key_to_msg))
+    labels = { 'chan_id': chan_id, **(labels or {}) }
 
     # awaitables to run. we'll only run these at the very end, so that if an
     # error happens halfway through this function we won't leave discord in a
     # half-updated state.
     aws = []
 
-    """
-    Each of these functions takes the key and content of a message that will be
-    sent, and tries to find the key of an existing message for it to use.
-    """
-    # key, msg -> key, msg
-    def no_change(key, msg, free_keys):
-        if key in free_keys and msg == key_to_msg[key]:
-            print(f"{key} -> {key} (no_change)")
-            return key
-
-    # different_key, msg -> key, msg
-    def change_key(key, msg, free_keys):
-        if (cand_keys := msg_to_keys[msg] & free_keys):
-            # prioritize keys that can't be used by change_msg(). there
-            # might still be broken edge cases here, not sure...
-            key_to_use = next(chain(cand_keys - key_to_new_msg.keys(), cand_keys))
-            print(f"{key_to_use} -> {key} (change_key)")
-            return key_to_use
-
-    # key, different_msg -> key, msg
-    def change_msg(key, msg, free_keys):
-        if key in free_keys:
-            assert msg != key_to_msg[key]
-            aws.append(bot.edit_message(chan_id, msg_ids[key], msg))
-            print(f"{key} -> {key} (change_msg)")
-            return key
-
-
-    def try_map(map_func, unmapped, free_keys, msg_id_futs):
-        """
-        Take a mapping function and try and apply it to a set of unmapped messages.
-        Returns the keys of messages it wasn't able to map.
-        """
-        # copy inputs so we can modify them
-        free_keys, msg_id_futs = set(free_keys), dict(msg_id_futs)
-
-        def attempt_map(key):
-            if (key_to_use := map_func(key, key_to_new_msg[key], free_keys)) is None:
-                return True
-            free_keys.remove(key_to_use)
-            msg_id_futs[key] = as_fut(msg_ids[key_to_use])
-            return False
-
-        return list(filter(attempt_map, unmapped)), free_keys, msg_id_futs
+    # we only track reacts for the "main" message
+    main_key     = first(key_to_msg)
+    new_main_key = first(key_to_new_msg)
+    main_id      = msg_ids.get(main_key)
 
-    unmapped     = key_to_new_msg.keys()  # keys of new messages needing to be mapped
-    free_keys    = key_to_msg.keys()      # keys of existing messages we can reuse
-    msg_id_futs  = {}                     # mapping from new message key -> id future
+    # plan how to remove reactions from the old main message. this depends on
+    # whether it's still the main message afterwards, and the calls are only
+    # needed if the old main message is kept around.
+    live_plan = plan_react_removal(bot, chan_id, main_id, old_reacts, new_reacts, live=True)
+    dead_plan = plan_react_removal(bot, chan_id, main_id, old_reacts, new_reacts, live=False)
 
     """
-    Apply the mapping strategies. We want to try a single strategy on all
-    messages before moving on to the next strategy, so that the 'best' one is
-    applied as often as possible.
+    Find the cheapest way to turn the old messages into the new ones. Each new
+    message can either reuse an existing message (editing it if the content is
+    different), or be sent as a new message. Existing messages that don't get
+    reused are deleted. This is an assignment problem, where the costs are the
+    number of api calls needed. Messages are only ever edited under the same
+    key, since a message edited to look like a different one doesn't notify
+    anyone (e.g. a ping for the next captain).
+
+    The old main message is special. Reusing it means we also have to clean up
+    its reactions. If it's reused as the new main message, or kept as-is for
+    some other key (e.g. it was moved into the history), the reactions we want
+    to keep are where they should be. Otherwise they're lost, and we'd have to
+    add the bot's reactions again. Users' reactions can't be re-added at all,
+    so losing them is made very expensive.
     """
-    unmapped, free_keys, msg_id_futs = try_map(no_change,  unmapped, free_keys, msg_id_futs)
-    unmapped, free_keys, msg_id_futs = try_map(change_key, unmapped, free_keys, msg_id_futs)
-    unmapped, free_keys, msg_id_futs = try_map(change_msg, unmapped, free_keys, msg_id_futs)
-
-    # create new messages for anything that wasn't mapped to an existing message
-    for key in unmapped:
-        print(f"None -> {key} (send_msg)")
-        msg_id_futs[key], coro = retval_as_fut(bot.send_message(chan_id, key_to_new_msg[key]))
-        aws.append(coro)
+    old_keys, new_keys = list(key_to_msg), list(key_to_new_msg)
+    old_fps = { key: fingerprint(msg) for key, msg in key_to_msg.items() }
+    # states give back the same messages dict if nothing in it changed (see
+    # states.renders), in which case every message just stays where it is
+    same_msgs = (key_to_new_msg is key_to_msg)
+    new_fps = old_fps if same_msgs else { key: fingerprint(msg) for key, msg in key_to_new_msg.items() }
+    kept_reacts = old_reacts & new_reacts
+    lost_reacts_cost = sum(1 if r.user_id == bot.user_id else LOST_USER_REACT_COST
+                           for r in kept_reacts)
+
+    # costs are scaled so that ties can be broken by preferring to keep
+    # messages under the same key, which makes the mapping predictable.
+    scale = len(new_keys) + 1
+    def reuse_cost(new_key, old_key):
+        changed = (new_fps[new_key] != old_fps[old_key])
+        if changed and new_key != old_key:
+            return INVALID_COST
+        calls = changed - 1  # an edit if the content changed, but no delete
+        if old_key == main_key:
+            calls += plan_cost(live_plan if new_key == new_main_key else dead_plan)
+            if new_key == new_main_key or not changed:
+                calls -= lost_reacts_cost
+        return calls * scale + (new_key != old_key)
+
+    if same_msgs:
+        assignment = range(len(old_keys))
+    else:
+        send_costs = [scale] * len(new_keys)
+        costs = [[reuse_cost(new_key, old_key) for old_key in old_keys] + send_costs
+                 for new_key in new_keys]
+        assignment = min_cost_assignment(costs)
+
+    async def main_sent(send):
+        # before anything waiting on the message's id gets it
+        on_main_sent(msg_id := await send)
+        return msg_id
+
+    msg_id_futs = {}  # mapping from new message key -> id future
+    free_keys   = set(old_keys)
+    react_plan  = []
+    for new_key, col in zip(new_keys, assignment):
+        new_msg = key_to_new_msg[new_key]
+        if col >= len(old_keys):
+            # create new messages for anything that wasn't mapped to an existing message
+            print(f"None -> {new_key} (send_msg)")
+            metrics.inc('api_calls', kind='send', **labels)
+            send = bot.send_message(chan_id, new_msg)
+            if new_key == new_main_key and on_main_sent is not None:
+                send = main_sent(send)
+            msg_id_futs[new_key], coro = retval_as_fut(send)
+            aws.append(coro)
+            continue
+
+        old_key = old_keys[col]
+        free_keys.remove(old_key)
+        if old_key == main_key:
+            react_plan = live_plan if new_key == new_main_key else dead_plan
+        msg_id_futs[new_key] = as_fut(msg_ids[old_key])
+        if new_fps[new_key] != old_fps[old_key]:
+            print(f"{old_key} -> {new_key} (change_msg)")
+            metrics.inc('api_calls', kind='edit', **labels)
+            aws.append(bot.edit_message(chan_id, msg_ids[old_key], new_msg, priority=edit_priority))
+        elif old_key != new_key:
+            print(f"{old_key} -> {new_key} (change_key)")
+            metrics.inc('edits_skipped', **labels)
+        else:
+            print(f"{old_key} -> {new_key} (no_change)")
+            metrics.inc('edits_skipped', **labels)
 
     # delete unused messages
     for key in free_keys:
         print(f"{key} -> {None} (del_msg)")
+        metrics.inc('api_calls', kind='delete', **labels)
         aws.append(bot.delete_message(chan_id, msg_ids[key]))
 
 
-    # we only track reacts for the "main" message
-    main_key     = first(key_to_msg)
-    new_main_key = first(key_to_new_msg)
-    main_id      = msg_ids.get(main_key)
-    main_id_fut  = msg_id_futs.get(new_main_key, as_fut(None))
-
     # add new reactions to the new main message.
     # sort them so they get added in a consistent order.
+    main_id_fut = msg_id_futs.get(new_main_key, as_fut(None))
     async def add_react(msg_id_fut, emoji):
         assert (msg_id := await msg_id_fut) is not None
         await bot.add_reaction(chan_id, msg_id, emoji)
 
     for user_id, emoji in sorted(new_reacts - old_reacts):
         assert user_id == bot.user_id  # we can only add reactions from the bot
+        metrics.inc('api_calls', kind='react', **labels)
         aws.append(add_react(main_id_fut, emoji))
 
-    # remove reactions from the old main message
-    def remove_reacts(reacts):
-        reacts_by_emoji = create_index(reacts, get('emoji'))
-        # use clear_reactions() if we're deleting all reactions. calling it is a
-        # bit risky since we might accidentally remove a new reaction as it
-        # comes in, so we only use if we're removing more than 1 set of reacts.
-        if len(new_reacts) == 0 and len(reacts_by_emoji) > 1:
-            return [bot.clear_reactions(chan_id, main_id)]
-        return chain(*starmap(remove_reacts_by_emoji, reacts_by_emoji.items()))
-
-    new_emojis = { r.emoji for r in new_reacts }
-    def remove_reacts_by_emoji(emoji, reacts):
-        # use_clear reactions() if we're deleting all reacts with a certain emoji
-        # and deleting more than one react.
-        if emoji not in new_emojis and len(reacts) > 1:
-            return [bot.clear_reaction(chan_id, main_id, emoji)]
-        return starmap(remove_react_by_user, reacts)
-
-    def remove_react_by_user(user_id, emoji):
-        return bot.remove_reaction(chan_id, main_id, emoji, user_id)
-
-    aws.extend(remove_reacts(old_reacts - new_reacts))
+    # remove reactions from the old main message, unless it's being deleted
+    async def run_calls(calls):
+        for call in calls:
+            await call()
+    aws.extend(map(run_calls, react_plan))
+    if react_plan:
+        metrics.inc('api_calls', plan_cost(react_plan), kind='react_cleanup', **labels)
 
     # run all the tasks now
     await asyncio.gather(*aws)
@@ -192,5 +320,97 @@ async def update_discord(bot, chan_id, msg_ids, key_to_msg, key_to_new_msg, old_
     return { key: msg_id_futs[key].result() for key in key_to_new_msg }
 
 
+def plan_react_removal(bot, chan_id, msg_id, old_reacts, new_reacts, live):
+    """
+    Plans the cheapest way to remove 'old_reacts - new_reacts' from a message.
+    'live' is whether the message will be the main message afterwards. Returns
+    a list of call sequences, where each sequence is a list of functions that
+    create awaitables, which need to be awaited in order.
+
+    Reactions can be removed one at a time, all at once for an emoji using
+    clear_reaction(), or all at once using clear_reactions(). Clearing also
+    removes reactions we want to keep, so the bot's reactions get added back
+    afterwards. Clearing can't be used if that would remove a user's reaction
+    we want to keep, or if a user could be adding a reaction that would get
+    cleared at the same time. That can only happen on the main message, for
+    emojis that are still in use. Any emoji can be added there, so the main
+    message never gets all its reactions cleared.
+    """
+    removed = old_reacts - new_reacts
+    kept    = old_reacts & new_reacts
+    in_use  = { r.emoji for r in new_reacts } if live else set()
+
+    def can_clear(kept, emojis):
+        return all(r.user_id == bot.user_id for r in kept) and not (emojis & in_use)
+
+    def readd(reacts):
+        # add them in a consistent order
+        return [partial(bot.add_reaction, chan_id, msg_id, emoji) for emoji in sorted(r.emoji for r in reacts)]
+
+    kept_by_emoji = create_index(kept, get('emoji'))
+    plan = []
+    for emoji, reacts in create_index(removed, get('emoji')).items():
+        emoji_plan = [[partial(bot.remove_reaction, chan_id, msg_id, emoji, user_id)]
+                      for user_id, _ in reacts]
+        emoji_kept = kept_by_emoji.get(emoji, set())
+        if can_clear(emoji_kept, { emoji }):
+            clear_plan = [[partial(bot.clear_reaction, chan_id, msg_id, emoji), *readd(emoji_kept)]]
+            if plan_cost(clear_plan) < plan_cost(emoji_plan):
+                emoji_plan = clear_plan
+        plan += emoji_plan
+
+    if plan and not live and can_clear(kept, { r.emoji for r in old_reacts }):
+        clear_plan = [[partial(bot.clear_reactions, chan_id, msg_id), *readd(kept)]]
+        if plan_cost(clear_plan) < plan_cost(plan):
+            plan = clear_plan
+    return plan
+
+def plan_cost(plan):
+    """ Returns the number of api calls in a plan from plan_react_removal() """
+    return sum(map(len, plan))
+
+
+_payload_cache = OrderedDict()
+def _cached(msg):
+    """
+    Returns the serialized payload and fingerprint of a message, caching them
+    by the message's identity. Cache entries hold a reference to the message,
+    so its id() can't get reused while it's cached.
+    """
+    if (entry := _payload_cache.get(id(msg))) is not None:
+        _payload_cache.move_to_end(id(msg))
+        return entry[1:]
+
+    if isinstance(msg, Embed):
+        data = msg.to_dict()
+    elif isinstance(msg, dict):
+        data = msg  # an already serialized embed
+    else:
+        data = str(msg)
+    kind = 'content' if isinstance(data, str) else 'embed'
+    serialized = json.dumps([kind, data], sort_keys=True, separators=(',', ':'))
+    fp = hashlib.blake2b(serialized.encode(), digest_size=16).digest()
+
+    _payload_cache[id(msg)] = (msg, data, fp)
+    if len(_payload_cache) > PAYLOAD_CACHE_SIZE:
+        _payload_cache.popitem(last=False)
+    return data, fp
+
+def payload(msg):
+    """
+    Returns what gets sent to discord for a message: the content string, or
+    the embed as a dict.
+    """
+    return _cached(msg)[0]
+
+def fingerprint(msg):
+    """
+    Returns a hash of a message's serialized content. Messages that would look
+    the same on discord have the same fingerprint, even if they're different
+    objects (Embeds don't compare equal by value).
+    """
+    return _cached(msg)[1]
+
+
 def mention(user_id):
     return f'<@{user_id}>'
@@ -1,15 +1,24 @@
-import asyncio
 from dataclasses import dataclass, replace
-import random
+from time import monotonic
 from typing import FrozenSet, Tuple
 
-from discord import Embed, File, Streaming, TextChannel, User
+from discord import Embed, File, Intents, Streaming, TextChannel, User
 
+from .animation import Animation, frame_at, frame_end, frame_start
 from .bot_stuff import mention
+from .names import display_name
 from .pug import update_state
-from .states import State, StoppedState, React, EMPTY, DONE_EMOJI
+from .states import State, StoppedState, React, EMPTY, DONE_EMOJI, render_rng
 from .utils import fset
 
+# the gateway events this extension needs, see bot_options() in bot_stuff.py
+INTENTS = Intents(guilds=True, guild_messages=True, guild_reactions=True)
+
+# how many sets of dancers to keep the frames of, see DanceState.frames().
+# frames get dropped when their dance stops, so this only needs to be more
+# than the number of dances at once
+DANCE_CACHE_SIZE = 64
+
 def setup(bot):
     from src.mem import chan_ctxs
 
@@ -19,6 +28,11 @@ def setup(bot):
                               url='https://www.youtube.com/watch?v=VXVAfx5WQno')
         await bot.change_presence(activity=streaming)
 
+    @bot.listen()
+    async def on_names_fetched(user_ids):
+        # the frames have the dancers' names in them, so they need rendering again
+        forget_frames(user_ids)
+
     @bot.command()
     async def dance(ctx, channel: TextChannel = None):
         if channel is None:
@@ -105,17 +119,17 @@ class WallState(State):
             'main': Embed(
                 title=title.strip() or ' ',
                 description=description.strip() or ' ',
-                colour = random.Random(hash(state.text)).randint(0, 0xffffff)
+                colour = render_rng(state.text).randint(0, 0xffffff)
             ).set_footer(text=(
                 f"react with a letter to add it to this message.\n"
                 f"{NEWLINE_EMOJI} to start a new line, "
                 f"{SPACE_EMOJI} for space, "
                 f"{BACKSPACE_EMOJI} for backspace."
             )),
-            **dict(enumerate(state.history))
+            **state.history.keyed()
         }
 
-    async def on_update(state):
+    def reduce(state):
         reacts = state.reacts | { React(state.bot.user_id, e) for e in (SPACE_EMOJI, BACKSPACE_EMOJI, NEWLINE_EMOJI) }
         text = state.text
         for r in reacts:
@@ -135,7 +149,7 @@ class WallState(State):
                 text = text + '\n'
                 reacts = reacts - { r }
 
-            print(f"{state.bot.get_user(r.user_id)}: {text}")
+            print(f"{display_name(state.bot, r.user_id)}: {text}")
         yield replace(state, reacts=reacts, text=text)
 
 
@@ -144,35 +158,81 @@ class DanceState(State):
     dance_idx: int = 0
     users: FrozenSet[int] = frozenset()
 
+    animated = True
+    # the rendered frames for each set of dancers and history, see frames()
+    frame_cache = {}
+
     @property
     def messages(state):
-        title = ' '.join(str(state.bot.get_user(u)) for u in state.users)
-        mentions = ' '.join(map(mention, state.users))
-        description = (('\n' + mentions + EMPTY.join([' ']*5))
-                       .join(DANCE[state.dance_idx].split('\n')))
-        description = description[:2048]  # embed description has a character limit
-        return {
-            'main': Embed(
-                title=title,
-                description=description,
-                colour = random.randint(0, 0xffffff)
-            ).set_footer(text='React to this message to stop the dance.'),
-            **dict(enumerate(state.history))
-        }
+        return state.frames()[state.dance_idx]
+
+    def frames(state):
+        """
+        The messages for every frame of the dance with the current dancers.
+        Every frame only depends on who's dancing (and the history), so they
+        all get rendered at once when the dancers change and a tick is just a
+        lookup. Channels with the same dancers and history share them.
+        """
+        cache = DanceState.frame_cache
+        if (frames := cache.get(key := (state.users, state.history))) is not None:
+            return frames
+
+        user_ids = sorted(state.users)
+        title = ' '.join(display_name(state.bot, u) for u in user_ids)
+        mentions = ' '.join(map(mention, user_ids))
+        history = state.history.keyed()
+        frames = []
+        for dance_idx, frame in enumerate(DANCE):
+            description = (('\n' + mentions + EMPTY.join([' ']*5))
+                           .join(frame.split('\n')))
+            description = description[:2048]  # embed description has a character limit
+            frames.append({
+                'main': Embed(
+                    title=title,
+                    description=description,
+                    colour = render_rng(dance_idx, user_ids).randint(0, 0xffffff)
+                ).set_footer(text='React to this message to stop the dance.'),
+                **history
+            })
+
+        cache[key] = frames
+        while len(cache) > DANCE_CACHE_SIZE:
+            del cache[next(iter(cache))]
+        return frames
 
     async def on_update(state):
         if state.reacts & { (u, DONE_EMOJI) for u in state.admin_ids }:
+            DanceState.frame_cache.pop((state.users, state.history), None)
             yield StoppedState.make(state)
             return
 
         users = state.users | { r.user_id for r in state.reacts }
+        if users != state.users:
+            # nobody's going to see the old dancers' frames again, unless
+            # another channel has the same ones, which just renders them again
+            DanceState.frame_cache.pop((state.users, state.history), None)
         yield (state := replace(state, users=users))
+
+        # the dance follows the clock, so frames that can't be drawn in time
+        # get skipped. 't' is how far into the dance we are, from 'start'.
+        anim = Animation(state.bot)
+        durations = dance_durations()
+        t = frame_start(state.dance_idx, durations)
+        start = monotonic() - t
         while True:
-            await asyncio.sleep(1)
-            next_idx = (state.dance_idx + 1) % len(DANCE)
-            if next_idx == 0:
-                await asyncio.sleep(1)
-            yield (state := replace(state, dance_idx=next_idx))
+            t = await anim.next_frame(start + frame_end(t, durations)) - start
+            if (next_idx := frame_at(t, durations)) != state.dance_idx:
+                yield (state := replace(state, dance_idx=next_idx))
+
+def forget_frames(user_ids):
+    """ Drops the dance frames showing any of these users, e.g. when they get renamed """
+    cache = DanceState.frame_cache
+    for key in [key for key in cache if not user_ids.isdisjoint(key[0])]:
+        del cache[key]
+
+def dance_durations():
+    """ How long each frame of the dance lasts. It pauses before it loops. """
+    return [1] * (len(DANCE) - 1) + [2]
 
 @dataclass(frozen=True)
 class TagState(State):
@@ -183,9 +243,6 @@ class TagState(State):
     def messages(state):
         return {}
 
-    async def on_update(state):
-        yield state
-
 PASTA = \
 """
 92% of people who see this will not
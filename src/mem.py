@@ -1,5 +1,32 @@
-from collections import defaultdict
+from collections import OrderedDict
+from time import monotonic
 
 # this is stored in a seperate module so that
-# it persists even when 'pug' is reloaded
-chan_ctxs = defaultdict()
+# it persists even when 'pug' is reloaded.
+# it's a pug.ChanCtxs, which gets made in pug.setup()
+chan_ctxs = None
+
+# the main message id of every channel, see pug.set_msg_ids()
+watched_msg_ids = set()
+
+# the update_state() tasks running in each channel, see pug.supersede_updates()
+update_tasks = {}
+
+# the animations waiting for a frame, see animation.py
+animations = set()
+
+# the log that chan_ctxs gets saved to, see persist.py
+store = None
+
+# counters and histograms, see metrics.py
+metrics = {}
+started = monotonic()
+metrics_server = None
+
+# interned emojis, see reacts.py
+react_emojis, react_emoji_idxs = [], {}
+
+# user id -> (display name, when it expires), see names.py
+names = OrderedDict()
+name_misses = set()
+name_task = None
@@ -0,0 +1,155 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+from time import monotonic
+
+from . import mem
+
+# if set, metrics are served at http://localhost:METRICS_PORT/metrics. when
+# running multiple workers, each one uses METRICS_PORT + its worker number.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+"""
+Metrics are kept in 'mem.metrics', so that they survive reloads. It maps
+(name, labels) to a number for counters, or a Histogram for histograms, where
+'labels' is a sorted tuple of (label, value) pairs. Series labelled with a
+chan_id only last as long as the channel's context, see forget().
+"""
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    """ Adds 'value' to a counter """
+    key = _key(name, labels)
+    mem.metrics[key] = mem.metrics.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """ Records 'value' in a histogram """
+    key = _key(name, labels)
+    if key not in mem.metrics:
+        mem.metrics[key] = Histogram()
+    mem.metrics[key].observe(value)
+
+@contextmanager
+def timer(name, **labels):
+    """ Records how long the body of a 'with' statement takes in a histogram """
+    start = monotonic()
+    try:
+        yield
+    finally:
+        observe(name, monotonic() - start, **labels)
+
+
+class Histogram:
+    def __init__(self):
+        # the last bucket is for values above BUCKETS[-1]
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """ Returns an upper bound on the q'th quantile """
+        if self.count == 0:
+            return 0.0
+        seen = 0
+        for bound, n in zip((*BUCKETS, float('inf')), self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return bound
+
+
+def forget(label, values):
+    """
+    Drops the series whose 'label' is one of 'values' (e.g. channels that have
+    gone away), so they don't pile up forever. They get folded into the same
+    series without that label, so totals stay the same.
+    """
+    values = set(values)
+    for (name, labels), value in list(mem.metrics.items()):
+        if not any(k == label and v in values for k, v in labels):
+            continue
+        del mem.metrics[name, labels]
+        rest = (name, tuple((k, v) for k, v in labels if k != label))
+        if isinstance(value, Histogram):
+            mem.metrics.setdefault(rest, Histogram()).merge(value)
+        else:
+            mem.metrics[rest] = mem.metrics.get(rest, 0) + value
+
+
+def matching(name, **labels):
+    """ Yields the (labels, value) pairs of a metric whose labels include 'labels' """
+    for (key_name, key_labels), value in list(mem.metrics.items()):
+        if key_name == name and labels.items() <= dict(key_labels).items():
+            yield dict(key_labels), value
+
+def total(name, **labels):
+    """ Returns the sum of a counter over every label value not given """
+    return sum(value for _, value in matching(name, **labels))
+
+def merged(name, **labels):
+    """ Returns the merge of a histogram over every label value not given """
+    hist = Histogram()
+    for _, value in matching(name, **labels):
+        hist.merge(value)
+    return hist
+
+
+def rss_bytes():
+    """ Returns how much memory this process is using """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # not on linux, so settle for the peak (which is in kilobytes on most platforms)
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def render():
+    """ Returns every metric in prometheus' text format """
+    def fmt(labels):
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+    lines = []
+    for (name, labels), value in sorted(mem.metrics.items(), key=lambda e: e[0]):
+        name = f"pugbot_{name}"
+        if isinstance(value, (int, float)):
+            lines.append(f"{name}{fmt(labels)} {value}")
+            continue
+        seen = 0
+        for bound, n in zip((*BUCKETS, '+Inf'), value.counts):
+            seen += n
+            lines.append(f"{name}_bucket{fmt((*labels, ('le', bound)))} {seen}")
+        lines.append(f"{name}_sum{fmt(labels)} {value.sum}")
+        lines.append(f"{name}_count{fmt(labels)} {value.count}")
+    lines.append(f"pugbot_resident_memory_bytes {rss_bytes()}")
+    for chan_id, tasks in sorted(mem.update_tasks.items()):
+        lines.append(f"pugbot_update_tasks{fmt((('chan_id', chan_id),))} {len(tasks)}")
+    return '\n'.join(lines) + '\n'
+
+async def serve(port):
+    """ Starts serving metrics over http. Returns the server's runner. """
+    from aiohttp import web
+    async def handle(request):
+        return web.Response(text=render())
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    print(f"Serving metrics on port {port}")
+    return runner
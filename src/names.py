@@ -0,0 +1,92 @@
+"""
+Display names for users, so that rendering never has to wait on discord, and
+doesn't need discord.py's user cache (which lean mode turns off). Names get
+remembered from the events we already get (reacts and commands), and names we
+don't know yet get fetched in the background. Until then, users are shown as
+mentions.
+
+The names are per user, not per guild, so a user with different nicknames in
+different guilds shows up with whichever one we saw last.
+"""
+import asyncio
+from itertools import islice
+from time import monotonic
+
+from . import mem, metrics
+from .bot_stuff import mention
+
+# how many names to keep, and for how long
+NAME_CACHE_SIZE = 10_000
+NAME_TTL = 24 * 60 * 60
+# how long to wait before trying again when a name can't be fetched
+NAME_RETRY = 5 * 60
+# how many names to fetch at once, and how long to wait for misses to pile up
+# before fetching them
+FETCH_BATCH = 10
+FETCH_DELAY = 1
+
+
+def remember(user_id, name, ttl=NAME_TTL):
+    names = mem.names
+    names.pop(user_id, None)
+    names[user_id] = (name, monotonic() + ttl)
+    while len(names) > NAME_CACHE_SIZE:
+        del names[next(iter(names))]
+
+def display_name(bot, user_id):
+    """
+    Returns a user's name if we know it. Otherwise returns a mention, and
+    fetches their name in the background. This never blocks.
+    """
+    if (entry := mem.names.get(user_id)) is not None:
+        name, expires = entry
+        if monotonic() >= expires:
+            # an old name is still better than a mention
+            want(bot, user_id)
+        return name
+    if (user := bot.get_user(user_id)) is not None:
+        remember(user_id, name := str(user.name))
+        return name
+    metrics.inc('name_misses')
+    want(bot, user_id)
+    return mention(user_id)
+
+def want(bot, user_id):
+    """ Queue up a user's name to be fetched """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # e.g. rendering in a benchmark, with nothing to fetch names with
+        return
+    mem.name_misses.add(user_id)
+    if mem.name_task is None or mem.name_task.done():
+        mem.name_task = asyncio.ensure_future(fetch_names(bot))
+
+async def fetch_names(bot):
+    """
+    Fetches the names in mem.name_misses, a batch at a time. Once a batch is
+    done, 'names_fetched' gets dispatched with the ids of the users whose
+    names changed, so anything showing them can be rendered again.
+    """
+    await asyncio.sleep(FETCH_DELAY)
+    misses = mem.name_misses
+    while misses:
+        # the batch stays in 'misses' until it's fetched, so that rendering
+        # the users again in the meantime doesn't fetch them twice
+        batch = list(islice(misses, FETCH_BATCH))
+        results = await asyncio.gather(*map(bot.fetch_name, batch), return_exceptions=True)
+        misses.difference_update(batch)
+        changed = set()
+        for user_id, name in zip(batch, results):
+            old_name = mem.names.get(user_id, (None,))[0]
+            if isinstance(name, Exception):
+                print(f"Couldn't fetch the name of {user_id}: {name!r}")
+                # keep showing whatever we were showing, and try again later
+                remember(user_id, old_name or mention(user_id), ttl=NAME_RETRY)
+                continue
+            metrics.inc('names_fetched')
+            remember(user_id, name)
+            if name != old_name:
+                changed.add(user_id)
+        if changed:
+            bot.dispatch('names_fetched', changed)
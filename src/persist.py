@@ -0,0 +1,246 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields
+import json
+import os
+import sqlite3
+import sys
+
+from discord import Embed
+
+from .bot_stuff import payload
+from .states import History, React, Reacts, State
+
+DB_PATH = os.environ.get('DB_PATH', 'pugbot.db')
+# how many log entries to write before folding them into the snapshot
+COMPACT_EVERY = 500
+# how long to queue up writes for before writing them all at once, in seconds
+WRITE_DELAY = 1
+
+
+"""
+States and messages get stored as json. Anything json can't represent
+directly is tagged with its type, e.g. a tuple is stored as {"tuple": [...]}.
+"""
+def encode(obj):
+    if isinstance(obj, React):
+        return { 'react': [obj.user_id, obj.emoji] }
+    if isinstance(obj, History):
+        return { 'history': [obj.base, list(map(encode, obj))] }
+    if isinstance(obj, tuple):
+        return { 'tuple': list(map(encode, obj)) }
+    if isinstance(obj, (set, frozenset, Reacts)):
+        return { 'set': list(map(encode, obj)) }
+    if isinstance(obj, dict):
+        return { 'dict': [[encode(k), encode(v)] for k, v in obj.items()] }
+    if isinstance(obj, Embed):
+        return { 'embed': payload(obj) }
+    if isinstance(obj, State):
+        return { 'state': type(obj).__name__,
+                 'fields': { f.name: encode(getattr(obj, f.name))
+                             for f in fields(obj) if f.name != 'bot' and f.compare } }
+    assert obj is None or isinstance(obj, (str, int, float)), f"can't encode {obj!r}"
+    return obj
+
+def decode(data, bot):
+    if not isinstance(data, dict):
+        return data
+    [(tag, val)] = [(k, v) for k, v in data.items() if k != 'fields']
+    if tag == 'react':
+        return React(*val)
+    if tag == 'history':
+        base, items = val
+        return History((decode(e, bot) for e in items), base)
+    if tag == 'tuple':
+        return tuple(decode(e, bot) for e in val)
+    if tag == 'set':
+        return frozenset(decode(e, bot) for e in val)
+    if tag == 'dict':
+        return { decode(k, bot): decode(v, bot) for k, v in val }
+    if tag == 'embed':
+        # embeds are kept in their serialized form, which can be sent as-is
+        return val
+    if tag == 'state':
+        state_fields = { k: decode(v, bot) for k, v in data['fields'].items() }
+        return state_classes()[val](bot=bot, **state_fields)
+    raise ValueError(f"unknown tag '{tag}'")
+
+def state_classes():
+    # the latest definition of each State subclass, so that this still works
+    # after the modules defining them have been reloaded
+    classes, todo = {}, [State]
+    while todo:
+        cls = todo.pop(0)
+        classes[cls.__name__] = cls
+        todo += cls.__subclasses__()
+    return classes
+
+
+def ctx_record(ctx):
+    """ Returns the parts of a ChanCtx that need to be saved, as a json string """
+    return json.dumps({
+        'state':      encode(ctx.state),
+        'msg_id_map': encode(ctx.msg_id_map),
+        'messages':   encode(ctx.messages),
+        'reacts':     encode(ctx.reacts),
+    }, separators=(',', ':'))
+
+def load_record(record, bot):
+    """ Returns the ChanCtx fields saved by ctx_record() """
+    return { k: decode(v, bot) for k, v in json.loads(record).items() }
+
+
+def worker_db_path(worker, path=DB_PATH):
+    """
+    Returns the db that a worker process saves its channels to. Each worker
+    has its own, so they don't all contend for the same file. Worker 0 uses
+    'path' itself, so running a single worker is the same as before.
+    """
+    if worker == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker}{ext}"
+
+
+class Store:
+    """
+    An append-only log of channel contexts, which is periodically compacted
+    into a snapshot that only has the latest record for each channel.
+
+    Writes are queued up and done in the background, in a single transaction
+    every WRITE_DELAY seconds, so that disk latency stays off the event loop.
+    Only the latest queued record for each channel gets written. Everything
+    that touches the db runs on the store's one thread, in the order it was
+    queued, so a newer record can never be written before an older one.
+    Without a running event loop (e.g. at shutdown), writes are waited on.
+    """
+
+    def __init__(self, path=DB_PATH):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS log (seq INTEGER PRIMARY KEY AUTOINCREMENT, chan_id INTEGER, record TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS snapshot (chan_id INTEGER PRIMARY KEY, record TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS archive (chan_id INTEGER, key INTEGER, msg_id INTEGER, message TEXT, '
+                        'PRIMARY KEY (chan_id, key))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.writes = 0
+        # chan_id -> its latest record, and archive rows, that haven't been
+        # written yet
+        self.pending = {}
+        self.pending_archive = []
+        self.write_task = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store')
+
+    def submit(self, fn, *args):
+        """ Runs 'fn' on the store's thread after everything before it, returning a future """
+        return self.executor.submit(fn, *args)
+
+    def append(self, chan_id, record):
+        """ Log a channel's record. A record of None means the channel was removed. """
+        self.pending[chan_id] = record
+        self.write_later()
+
+    def archive(self, chan_id, entries):
+        """
+        Stores history messages that channel states don't keep anymore, as
+        (key, message id, message) tuples.
+        """
+        self.pending_archive += [(chan_id, key, msg_id, json.dumps(encode(msg))) for key, msg_id, msg in entries]
+        self.write_later()
+
+    def write_later(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush().result()
+            return
+        if self.write_task is None or self.write_task.done():
+            self.write_task = loop.create_task(self.write_pending())
+
+    async def write_pending(self):
+        await asyncio.sleep(WRITE_DELAY)
+        await asyncio.wrap_future(self.flush())
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        archive, self.pending_archive = self.pending_archive, []
+        return pending, archive
+
+    def write(self, pending, archive):
+        if pending or archive:
+            with self.db:
+                self.db.execute('BEGIN')
+                self.db.executemany('INSERT INTO log (chan_id, record) VALUES (?, ?)', pending.items())
+                self.db.executemany('INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?)', archive)
+            self.writes += len(pending)
+        if self.writes >= COMPACT_EVERY:
+            self._compact()
+
+    def flush(self):
+        """ Queues up a write of everything that's pending, returning a future for it """
+        return self.submit(self.write, *self.take_pending())
+
+    async def archived(self, chan_id):
+        """ Returns a channel's archived history as (key, message id, message) tuples """
+        self.flush()
+        rows = await asyncio.wrap_future(self.submit(self._archived, chan_id))
+        return [(key, msg_id, decode(json.loads(msg), None)) for key, msg_id, msg in rows]
+
+    def _archived(self, chan_id):
+        return self.db.execute('SELECT key, msg_id, message FROM archive WHERE chan_id = ? ORDER BY key', (chan_id,)).fetchall()
+
+    def compact(self):
+        self.flush()
+        self.submit(self._compact).result()
+
+    def _compact(self):
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.execute('INSERT OR REPLACE INTO snapshot SELECT chan_id, record FROM log '
+                            'WHERE seq IN (SELECT MAX(seq) FROM log GROUP BY chan_id)')
+            self.db.execute('DELETE FROM snapshot WHERE record IS NULL')
+            self.db.execute('DELETE FROM log')
+        self.writes = 0
+
+    def load(self, layout=None):
+        """
+        Returns the latest record for each channel. 'layout' is how the bot
+        is split up, as (workers, shard count). Which channels are in which
+        worker's db depends on it, so if it's changed since the records were
+        saved, they're dropped and every channel starts over.
+        """
+        self.compact()
+        return self.submit(self._load, layout).result()
+
+    def _load(self, layout):
+        if layout is not None:
+            layout = json.dumps(layout)
+            saved = self.db.execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()
+            if saved is not None and saved[0] != layout:
+                print(f"The workers/shards changed from {saved[0]} to {layout}, so saved channels "
+                      f"can't be restored", file=sys.stderr)
+                self._clear(archive=False)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('layout', ?)", (layout,))
+        return dict(self.db.execute('SELECT chan_id, record FROM snapshot'))
+
+    def clear(self):
+        if self.write_task is not None:
+            self.write_task.cancel()
+        self.take_pending()
+        self.submit(self._clear)
+
+    def _clear(self, archive=True):
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.execute('DELETE FROM log')
+            self.db.execute('DELETE FROM snapshot')
+            if archive:
+                self.db.execute('DELETE FROM archive')
+        self.writes = 0
+
+    def close(self):
+        # anything that's queued up gets written first
+        self.compact()
+        self.executor.shutdown(wait=True)
+        self.db.close()
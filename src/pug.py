@@ -1,19 +1,30 @@
 import asyncio
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
 from dataclasses import dataclass, field, replace
 from itertools import chain
+import os
 import random
 import sys
 import textwrap
+from time import monotonic
 import traceback
-from typing import Any, Dict, FrozenSet, Union
+from typing import Any, Dict, Optional, Tuple, Union
 import zlib
 
-from discord import ChannelType, Colour, Embed, Object, TextChannel
+from discord import ChannelType, Colour, Embed, Intents, Object, TextChannel
 from discord.ext import commands
 
-from .bot_stuff import Bot, update_discord
-from .states import React, State, StoppedState, IdleState
-from .utils import fset, first, anext
+from . import animation, mem, metrics, names
+from .bot_stuff import update_discord
+from .persist import Store, ctx_record, load_record, worker_db_path
+from .scheduler import ANIMATE, EDIT
+from .states import React, Reacts, State, StoppedState, IdleState
+from .utils import fset, first, anext, paginate
+
+# the gateway events this extension needs, see bot_options() in bot_stuff.py.
+# messages are for commands.
+INTENTS = Intents(guilds=True, guild_messages=True, dm_messages=True, guild_reactions=True)
 
 MAP_LIST = [
     # tier 1: classics
@@ -106,6 +117,16 @@ MAP_LIST = [
     ]
 ]
 
+# how long to wait for more react events before applying a batch of them, in
+# seconds. higher values mean fewer state updates (and discord api calls) when
+# lots of people react at once, at the cost of slower responses.
+REACT_BATCH_LATENCY = 0.05
+
+# discord's message length limit, minus some room for the code block
+STATUS_PAGE_LEN = 1990
+# the shortest a status page's lines can get, however long its header is
+STATUS_MIN_PAGE_LEN = 500
+
 @dataclass
 class ChanCtx:
     state: State
@@ -113,22 +134,115 @@ class ChanCtx:
     # current discord state:
     msg_id_map: Dict[Any, int] = field(default_factory=dict)
     messages: Dict[Any, Union[str, Embed]] = field(default_factory=dict)
-    reacts: FrozenSet[React] = fset()
+    reacts: Reacts = field(default_factory=Reacts)
+    # react events that haven't been applied yet, see update_reacts()
+    react_events: Dict[Tuple[int, React], bool] = field(default_factory=dict)
+    react_task: Optional[asyncio.Task] = None
+    # when this was last looked up or updated, see ChanCtxs
+    last_used: float = field(default_factory=monotonic)
+
+    def __post_init__(self):
+        self.reacts = Reacts(self.reacts)
+
+
+# how many channel contexts to keep in memory. past this, contexts of stopped
+# channels, and of channels that have been idle for CTX_IDLE_SECONDS, get
+# evicted. contexts used in the last CTX_GRACE_SECONDS are never evicted, since
+# commands might still be holding onto them.
+MAX_CHAN_CTXS     = int(os.environ.get('MAX_CHAN_CTXS', 1000))
+CTX_IDLE_SECONDS  = 60 * 60
+CTX_GRACE_SECONDS = 60
+
+class ChanCtxs(OrderedDict):
+    """
+    Maps channel ids to their ChanCtx, least recently used first. Looking up a
+    channel that doesn't have one makes a new one. Evicted contexts are kept
+    in 'evicted' as their (much smaller) saved records, and get loaded again
+    when they're looked up, so they still count as being in here.
+    """
+    def __init__(self, bot):
+        super().__init__()
+        self.bot = bot
+        self.evicted = {}
+
+    def __missing__(self, chan_id):
+        if (record := self.evicted.pop(chan_id, None)) is not None:
+            ctx = ChanCtx(**load_record(record, self.bot))
+        else:
+            ctx = ChanCtx(StoppedState(bot=self.bot, admin_ids={ self.bot.owner_id },
+                                       reacts=fset(), history=tuple()))
+        self[chan_id] = ctx
+        self.evict()
+        return ctx
+
+    def __getitem__(self, chan_id):
+        ctx = super().__getitem__(chan_id)
+        ctx.last_used = monotonic()
+        self.move_to_end(chan_id)
+        return ctx
+
+    def __contains__(self, chan_id):
+        return super().__contains__(chan_id) or chan_id in self.evicted
+
+    def __delitem__(self, chan_id):
+        if self.evicted.pop(chan_id, None) is None:
+            super().__delitem__(chan_id)
+        metrics.forget('chan_id', [chan_id])
+        # so that it doesn't come back when the bot restarts
+        if mem.store is not None:
+            mem.store.append(chan_id, None)
+
+    def clear(self):
+        metrics.forget('chan_id', [*self.keys(), *self.evicted])
+        super().clear()
+        self.evicted.clear()
+
+    def evictable(self, ctx, now):
+        # don't evict contexts that are being updated, or that have anything
+        # left to do
+        if ctx.lock.locked() or ctx.react_task is not None or ctx.react_events:
+            return False
+        idle_for = now - ctx.last_used
+        if isinstance(ctx.state, StoppedState):
+            return idle_for > CTX_GRACE_SECONDS
+        # states that use on_update() might be waiting on a timer
+        return ctx.state.reduces() and idle_for > max(CTX_IDLE_SECONDS, CTX_GRACE_SECONDS)
+
+    def evict(self):
+        """ Evicts contexts until there's at most MAX_CHAN_CTXS of them, if possible """
+        if len(self) <= MAX_CHAN_CTXS:
+            return
+        now = monotonic()
+        evicted = []
+        # the most recently used context is never evicted, since that's the
+        # one being looked up in __missing__()
+        for chan_id, ctx in list(self.items())[:-1]:
+            if len(self) <= MAX_CHAN_CTXS:
+                break
+            if self.evictable(ctx, now):
+                self.evicted[chan_id] = ctx_record(ctx)
+                super().__delitem__(chan_id)
+                evicted.append(chan_id)
+                metrics.inc('ctxs_evicted')
+        # the status command only shows channels that are in memory anyway
+        metrics.forget('chan_id', evicted)
 
 
 def setup(bot):
-    from src.mem import chan_ctxs
-    chan_ctxs.default_factory = lambda: ChanCtx(StoppedState(
-        bot=bot, admin_ids={ bot.owner_id },
-        reacts=fset(), history=tuple(),
-    ))
+    if mem.chan_ctxs is None:
+        mem.chan_ctxs = ChanCtxs(bot)
+    chan_ctxs = mem.chan_ctxs
+    # this module might've been reloaded, see below
+    chan_ctxs.__class__ = ChanCtxs
+    chan_ctxs.bot = bot
 
     """
     This is big hack to support hot reloading code while the bot is running.
     When this module is reloaded, we try and track down every instance we've
     created and update its class to the new definition.
     """
-    bot.__class__ = Bot
+    import src.bot_stuff
+    bot.__class__ = getattr(src.bot_stuff, type(bot).__name__)
 
     import src.states
     for chan_id, ctx in list(chan_ctxs.items()):
@@ -140,28 +254,56 @@ def setup(bot):
             ctx.state = None
             del chan_ctxs[chan_id]
             print(f"Patching {chan_id} ctx failed, resetting state. Error:\n{err}")
+    # in case the contexts were made before 'watched_msg_ids' was kept up to date
+    mem.watched_msg_ids.update(first(ctx.msg_id_map.values()) for ctx in chan_ctxs.values())
+    mem.watched_msg_ids.discard(None)
+
+    """
+    When running as multiple worker processes, each one only has the channels
+    on its own shards. These handlers get run in every worker, see shards.py.
+    """
+    async def worker_status():
+        rows = []
+        for chan_id, chan_ctx in chan_ctxs.items():
+            count = lambda name: metrics.total(name, chan_id=chan_id)
+            rows.append(f"{chan_id:<18} | {type(chan_ctx.state).__name__:<13} | {count('api_calls'):>5} | "
+                        f"{count('edits_skipped'):>5} | {count('react_events'):>6} | {count('aborted_updates'):>5} | "
+                        f"{len(mem.update_tasks.get(chan_id, ())):>5}")
+        sched = bot.scheduler
+        discord_time, lock_wait = metrics.merged('update_discord_seconds'), metrics.merged('lock_wait_seconds')
+        return (rows,
+                f"requests: {sched.queue_depth} queued, {sched.sent} sent, {sched.superseded} superseded, "
+                f"{sched.mean_wait * 1000:.0f}ms avg wait, {sched.max_wait * 1000:.0f}ms max wait\n"
+                f"update_discord: {discord_time.quantile(0.5) * 1000:g}ms p50, {discord_time.quantile(0.99) * 1000:g}ms p99, "
+                f"lock wait: {lock_wait.quantile(0.5) * 1000:g}ms p50, {lock_wait.quantile(0.99) * 1000:g}ms p99\n"
+                f"reacts: {metrics.total('react_events')} handled, {metrics.total('reacts_ignored')} ignored\n"
+                f"animations: {len(mem.animations)} running, a frame every {animation.frame_interval():g}s each\n"
+                f"names: {len(mem.names)} cached, {metrics.total('name_misses')} misses, {len(mem.name_misses)} being fetched\n"
+                f"process: {metrics.rss_bytes() / 2**20:.0f}MB rss, "
+                f"{metrics.total('gateway_events') / (monotonic() - mem.started):.1f} gateway events/s")
+    bot.handlers['status'] = worker_status
+
+    async def worker_reset():
+        for tasks in mem.update_tasks.values():
+            for task in tasks:
+                task.cancel()
+        chan_ctxs.clear()
+        mem.watched_msg_ids.clear()
+        if mem.store is not None:
+            mem.store.clear()
+    bot.handlers['reset'] = worker_reset
 
     @commands.is_owner()
     @bot.command(hidden=True)
-    async def status(ctx):
-        s = ""
-        for chan_id, chan_ctx in chan_ctxs.items():
-            state = type(chan_ctx.state).__name__
-            s += f"{chan_id} | {state}\n"
-        s = (
-            "```\n"
-            "chan_id            | state\n"
-            "-------------------+----------\n"
-            f"{s}\n"
-            "```\n"
-        )
-        await ctx.send(s)
+    async def status(ctx, page: int = 1):
+        """ Shows every channel's state, and how many api calls it's made """
+        pages = status_pages(await bot.broadcast('status'))
+        await ctx.send(pages[min(max(page, 1), len(pages)) - 1])
 
     @commands.is_owner()
     @bot.command(hidden=True)
     async def reset(ctx):
-        for chan_id in list(chan_ctxs):
-            del chan_ctxs[chan_id]
+        await bot.broadcast('reset')
 
     @commands.is_owner()
     @bot.command(hidden=True)
@@ -237,13 +379,18 @@ def setup(bot):
         Defaults to picking from tier 2 and above.
         """) + '\n'.join(tier_list))
     async def randmap(ctx, lowest_tier: int = 2):
-        await ctx.send(embed=map_to_embed(rand_map(lowest_tier)))
+        global last_map
+        map_name = rand_map(lowest_tier)
+        await ctx.send(embed=map_to_embed(map_name, last_map))
+        last_map = map_name
 
     @bot.command(hidden=True)
     async def maps(ctx, tier: int):
         """ Shows all the options the randmap command can choose from """
+        global last_map
         for m in MAP_LIST[tier-1]:
-            await ctx.send(embed=map_to_embed(m))
+            await ctx.send(embed=map_to_embed(m, last_map))
+            last_map = m
 
     @bot.listen()
     async def on_ready():
@@ -251,6 +398,39 @@ def setup(bot):
         await bot.is_owner(Object(None))
         print(f"Bot owner is {bot.get_user(bot.owner_id)}")
 
+        # restore the channels saved before the bot last restarted. their
+        # messages are reused, and any running states get started back up.
+        if (restoring := mem.store is None):
+            mem.store = Store(worker_db_path(bot.worker))
+            for chan_id, record in mem.store.load(layout=(bot.workers, bot.shard_count or 1)).items():
+                if not bot.owns_channel(chan_id):
+                    # another worker will restore this one
+                    continue
+                try:
+                    chan_ctxs[chan_id] = ctx = ChanCtx(**load_record(record, bot))
+                    mem.watched_msg_ids.add(first(ctx.msg_id_map.values()))
+                except Exception as err:
+                    print(f"Restoring {chan_id} ctx failed. Error:\n{err}")
+            print(f"Restored {len(chan_ctxs)} channels")
+            chan_ctxs.evict()
+
+        if metrics.METRICS_PORT and mem.metrics_server is None:
+            mem.metrics_server = await metrics.serve(metrics.METRICS_PORT + bot.worker)
+
+        # we might have missed reacts while we were disconnected
+        await reconcile_all(bot, chan_ctxs, restart=restoring)
+
+    @bot.listen()
+    async def on_resumed():
+        await reconcile_all(bot, chan_ctxs)
+
+    @commands.is_owner()
+    @bot.command(hidden=True)
+    async def resync(ctx):
+        """ Checks every channel's reacts against discord """
+        n_fixed = await reconcile_all(bot, chan_ctxs)
+        await ctx.send(f"fixed reacts in {n_fixed} channels")
+
     @bot.listen()
     async def on_command_error(ctx, error):
         if isinstance(error, commands.CommandInvokeError):
@@ -261,6 +441,25 @@ def setup(bot):
 
         await ctx.send(error)
 
+    @bot.listen()
+    async def on_command(ctx):
+        names.remember(ctx.author.id, ctx.author.display_name)
+
+    @bot.listen()
+    async def on_names_fetched(user_ids):
+        # render the channels showing these users again, now that we have
+        # their names instead of mentions. the new state is a copy so that its
+        # messages get looked up again.
+        for chan_id, ctx in list(chan_ctxs.items()):
+            state = ctx.state
+            if not isinstance(state, StoppedState) and user_ids & (state.reacts.user_ids() | set(state.admin_ids)):
+                asyncio.ensure_future(update_state(bot, ctx, chan_id, lambda c: replace(c.state)))
+
+    @bot.listen()
+    async def on_socket_response(msg):
+        # count everything the gateway sends, to see what's worth turning off
+        metrics.inc('gateway_events', type=msg.get('t') or f"op {msg.get('op')}")
+
     @bot.listen('on_raw_reaction_add')
     @bot.listen('on_raw_reaction_remove')
     async def on_raw_reaction(event):
@@ -269,18 +468,24 @@ def setup(bot):
             print("ignored bot")
             return
 
+        # ignore reactions to messages we aren't watching. this is checked
+        # first since most reactions are to random messages.
+        if event.message_id not in mem.watched_msg_ids:
+            metrics.inc('reacts_ignored')
+            return
+
         # ignore reactions to channels we aren't watching
         if event.channel_id not in chan_ctxs:
             return
 
-        react = React(event.user_id, str(event.emoji))
-        if event.event_type == 'REACTION_ADD':
-            update = lambda reacts: reacts | { react }
-        else:
-            update = lambda reacts: reacts - { react }
+        # reacts to a guild message come with the member, so we get their
+        # name for free
+        if event.member is not None:
+            names.remember(event.user_id, event.member.display_name)
 
-        await update_reacts(bot, chan_ctxs[event.channel_id],
-                            event.channel_id, event.message_id, update)
+        react = React(event.user_id, str(event.emoji))
+        update_reacts(bot, chan_ctxs[event.channel_id], event.channel_id,
+                      event.message_id, react, event.event_type == 'REACTION_ADD')
 
 
 def rand_map(lowest_tier):
@@ -288,13 +493,12 @@ def rand_map(lowest_tier):
     maps = list(chain(*tiers))
     return random.choice(maps)
 
+# the map that was picked last, which gets shown in the next map's title
 last_map = rand_map(-1)
-def map_to_embed(map_name):
-    global last_map
-
+def map_to_embed(map_name, prev_map):
     hue = (zlib.adler32(map_name.encode()) & 0xff) / 0xff
     colour = Colour.from_hsv(hue, 0.5, 0.9)
-    embed = Embed(title=f"Fuck {last_map.split('_', 1)[-1].capitalize()} All My Homies Play",
+    embed = Embed(title=f"Fuck {prev_map.split('_', 1)[-1].capitalize()} All My Homies Play",
                   description=map_name,
                   colour=colour)
 
@@ -310,12 +514,40 @@ def map_to_embed(map_name):
     }[map_name.split('_')[0].lower()]
     img_url = f"https://raw.githubusercontent.com/Derpduck/GG2-Map-Archive/master/{mode}/{map_name}.png"
     embed = embed.set_image(url=img_url)
-
-    last_map = map_name
     return embed
 
+def reduce_sequence(start_state):
+    """
+    Like state_sequence(), but for states that can be reduced synchronously,
+    so it doesn't need an event loop. Stops early if it gets to a state that
+    can't be reduced.
+    """
+    state = start_state
+    while True:
+        steps = state.reduce()
+        if (first_state := next(steps, None)) is None:
+            return
+        # if reducing a state gives back the same state first, then it's stable
+        # and so is whatever's equal to it, which saves reducing it again below
+        known_stable = (first_state == state)
+        yield (state := first_state)
+        for state in steps:
+            known_stable = False
+            yield state
+        if known_stable or not state.reduces() or state.is_stable:
+            return
+
 async def state_sequence(start_state):
-    state_seq = start_state.on_update()
+    state = start_state
+    if state.reduces():
+        for state in reduce_sequence(state):
+            yield state
+        if state.reduces():
+            return
+        # we ended up in a state that has to wait on things, so carry on from
+        # there the slow way
+
+    state_seq = state.on_update()
     while True:
         async for state in state_seq:
             yield state
@@ -329,49 +561,356 @@ async def state_sequence(start_state):
         yield (state := next_state)
 
 
+# how long update_state() can hold onto a state before sending it to discord,
+# while waiting to see if there's a newer one to send instead
+EDIT_MAX_STALENESS = float(os.environ.get('EDIT_MAX_STALENESS', 0.25))
+
+@asynccontextmanager
+async def locked(ctx, chan_id):
+    """ Acquires a channel's lock, recording how long that took """
+    with metrics.timer('lock_wait_seconds', chan_id=chan_id):
+        await ctx.lock.acquire()
+    try:
+        yield
+    finally:
+        ctx.lock.release()
+
+"""
+The update tasks running for each channel are kept in 'mem.update_tasks', as
+a mapping from chan_id -> { task: whether it's been cancelled }. Starting an
+update supersedes the ones already running in the channel, so they get
+cancelled right away, instead of running until they notice (e.g. a dance that
+was stopped would keep rendering frames until then). It's in 'mem' so that
+updates started before a reload still get cancelled.
+"""
+def supersede_updates(chan_id):
+    """ Registers the current task as updating a channel, and cancels the others """
+    tasks = mem.update_tasks.setdefault(chan_id, {})
+    for task, cancelled in tasks.items():
+        if not cancelled:
+            task.cancel()
+            tasks[task] = True
+            metrics.inc('updates_cancelled', chan_id=chan_id)
+    task = asyncio.current_task()
+    tasks[task] = False
+    return task
+
+def end_update(chan_id, task):
+    tasks = mem.update_tasks.get(chan_id, {})
+    tasks.pop(task, None)
+    if not tasks:
+        mem.update_tasks.pop(chan_id, None)
+
 async def update_state(bot, ctx, chan_id, next_state_fn):
+    """
+    Changes a channel's state to 'next_state_fn(ctx)', and runs the state
+    sequence from there. Returns the last state, or None if another update
+    took over before it was done. The update runs in its own task, so that a
+    newer update can cancel it without cancelling whoever's waiting on it.
+    """
+    task = asyncio.ensure_future(run_update(bot, ctx, chan_id, next_state_fn))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            # a newer update superseded this one
+            return None
+        raise
+
+async def run_update(bot, ctx, chan_id, next_state_fn):
     # TODO: this whole function is kinda wack, should probably rethink this at
     #       some point
 
-    async with ctx.lock:
+    async with locked(ctx, chan_id):
         # TODO: don't do this. it's better if ctx.state.messages and
         #       ctx.msg_id_map stay in sync
         ctx.state = curr_state = next_state_fn(ctx)
+        task = supersede_updates(chan_id)
 
+    """
+    States get committed to 'ctx.state' as soon as we get them, but they're
+    only sent to discord (flushed) once there's no newer state within
+    EDIT_MAX_STALENESS, so states that would be stale right away don't get
+    sent at all. 'held_since' is when the oldest state that hasn't been sent
+    yet was committed, and 'next_fut' is the next state being worked out.
+    """
     state_seq = state_sequence(curr_state)
-    while (next_state := await anext(state_seq, None)) is not None:
-        async with ctx.lock:
+    next_fut = held_since = None
+    saved = False
+
+    async def flush():
+        """ Sends 'curr_state' to discord. Returns whether it was still current. """
+        nonlocal state_seq, next_fut, held_since, saved
+        async with locked(ctx, chan_id):
             if ctx.state is not curr_state:
                 # someone changed the state while we were getting the next one,
                 # so we can stop here
-                return
-
-            # NOTE: we use the messages and reacts from 'ctx', NOT 'curr_state'
-            #       since we don't know whether that state was fully applied.
-            next_msg_id_map = await update_discord(bot, chan_id, ctx.msg_id_map,
-                                                  ctx.messages, next_state.messages,
-                                                  ctx.reacts, next_state.reacts)
-            ctx.messages = next_state.messages
-            ctx.state    = next_state
+                metrics.inc('aborted_updates', chan_id=chan_id, state=type(curr_state).__name__)
+                return False
+
+            # NOTE: we use the messages and reacts from 'ctx', NOT the state
+            #       before 'curr_state', since that might not have been sent.
+            archive_history(ctx, chan_id, curr_state)
+            labels = { 'chan_id': chan_id, 'state': type(curr_state).__name__ }
+            if curr_state.messages is ctx.messages and curr_state.reacts == ctx.reacts:
+                # nothing to change on discord
+                metrics.inc('updates_skipped', **labels)
+                next_msg_id_map = ctx.msg_id_map
+            else:
+                with metrics.timer('update_discord_seconds', **labels):
+                    next_msg_id_map = await update_discord(bot, chan_id, ctx.msg_id_map,
+                                                          ctx.messages, curr_state.messages,
+                                                          ctx.reacts, curr_state.reacts, labels=labels,
+                                                          edit_priority=ANIMATE if curr_state.animated else EDIT,
+                                                          # users can react to a new main message while
+                                                          # the bot's reacts are still being added
+                                                          on_main_sent=mem.watched_msg_ids.add)
+            ctx.messages  = curr_state.messages
+            ctx.last_used = monotonic()
             if first(ctx.msg_id_map.values()) == first(next_msg_id_map.values()):
-                ctx.reacts = next_state.reacts
+                ctx.reacts = curr_state.reacts
             else:
                 # the main message changed, which means we should remove the old
                 # reacts. we also remake the state sequence with the updated reacts.
-                ctx.reacts = next_state.reacts - ctx.reacts
-                state_seq = state_sequence(replace(next_state, reacts=ctx.reacts))
+                ctx.reacts = curr_state.reacts - ctx.reacts
+                if next_fut is not None:
+                    next_fut.cancel()
+                    next_fut = None
+                state_seq = state_sequence(replace(curr_state, reacts=ctx.reacts))
                 print("restarting seq")
-            ctx.msg_id_map = next_msg_id_map
-        curr_state = next_state
-    return curr_state
-
+            # an animation's frames aren't worth saving every time, since a
+            # restart just starts it back up from wherever it was saved at
+            frame = saved and curr_state.animated and next_msg_id_map == ctx.msg_id_map
+            set_msg_ids(ctx, next_msg_id_map)
+            if not frame:
+                save_ctx(chan_id, ctx)
+                saved = True
+        held_since = None
+        return True
+
+    try:
+        while True:
+            if next_fut is None:
+                next_fut = asyncio.ensure_future(anext(state_seq, None))
+            if held_since is not None:
+                # bot reacts only get held back if the next state is already
+                # here, since users can't react with them until they're added
+                new_reacts = curr_state.reacts - ctx.reacts
+                timeout = (0 if new_reacts.with_users((bot.user_id,)) else
+                           held_since + EDIT_MAX_STALENESS - monotonic())
+                await asyncio.wait({ next_fut }, timeout=max(timeout, 0))
+                if not next_fut.done():
+                    # the next state is taking a while, so send this one
+                    if not await asyncio.shield(flush()):
+                        return
+                    continue
+
+            next_state = await next_fut
+            next_fut = None
+            if next_state is None:
+                if held_since is None:
+                    break
+                # send the last state. if that changed the main message, the
+                # sequence got restarted, so carry on with the new one
+                state_seq_before = state_seq
+                if not await asyncio.shield(flush()):
+                    return
+                if state_seq is state_seq_before:
+                    break
+                await state_seq_before.aclose()
+                continue
+            if held_since is not None:
+                # the held state is stale now, so it never gets sent
+                metrics.inc('states_debounced', chan_id=chan_id)
+            async with locked(ctx, chan_id):
+                if ctx.state is not curr_state:
+                    metrics.inc('aborted_updates', chan_id=chan_id, state=type(curr_state).__name__)
+                    return
+                ctx.state = curr_state = next_state
+            if held_since is None:
+                held_since = monotonic()
+
+        return curr_state
+    finally:
+        # NOTE: flushes are shielded, so if this gets cancelled, the api calls
+        #       that have been started still finish and get recorded in 'ctx'.
+        #       anything after that (like a state that's waiting) is dropped.
+        if next_fut is not None:
+            next_fut.cancel()
+            await asyncio.wait({ next_fut })
+            if not next_fut.cancelled():
+                next_fut.exception()
+        await state_seq.aclose()
+        end_update(chan_id, task)
+
+
+def status_pages(results):
+    """
+    Returns the pages of the status command, from each worker's status. The
+    workers' summaries go after the channels and get paginated along with
+    them, since with enough workers they wouldn't fit on every page.
+    """
+    rows = [row for rows, _ in filter(None, results) for row in rows]
+    summaries = [""]
+    for i, result in enumerate(results):
+        prefix = f"worker {i} " if len(results) > 1 else ""
+        summaries += f"{prefix}{result[1] if result else 'not responding'}".split('\n')
+    header = (
+        "chan_id            | state         | calls | skips | reacts | abort | tasks\n"
+        "-------------------+---------------+-------+-------+--------+-------+------\n"
+    )
+    page_footer = "\n\npage 999/999\n"
+    pages = paginate(rows + summaries, max(STATUS_PAGE_LEN - len(header) - len(page_footer), STATUS_MIN_PAGE_LEN))
+    return [f"```\n{header}{page}\n\npage {i}/{len(pages)}\n```" for i, page in enumerate(pages, 1)]
+
+
+def set_msg_ids(ctx, msg_id_map):
+    """
+    Sets a ctx's message ids, keeping 'mem.watched_msg_ids' up to date. That's
+    the set of main message ids, which on_raw_reaction() uses to ignore reacts
+    to any other message without having to look at the channel. A new main
+    message gets watched as soon as it's sent (see run_update()), since
+    users can react to it before this is called.
+    """
+    mem.watched_msg_ids.discard(first(ctx.msg_id_map.values()))
+    if (main_id := first(msg_id_map.values())) is not None:
+        mem.watched_msg_ids.add(main_id)
+    ctx.msg_id_map = msg_id_map
 
-async def update_reacts(bot, ctx, chan_id, msg_id, update_reacts_fn):
-    async with ctx.lock:
-        # we only care about reacts to the main message
-        # TODO: track reacts to all messages?
-        if msg_id != first(ctx.msg_id_map.values()):
-            return
-        ctx.reacts = frozenset(update_reacts_fn(ctx.reacts))
 
+def archive_history(ctx, chan_id, state):
+    """
+    Drops the history messages that 'state' doesn't keep anymore from 'ctx'
+    (see HISTORY_LEN), so that update_discord() leaves them alone instead of
+    diffing them every time. They're saved to the store if there is one.
+    """
+    old_keys = [key for key in ctx.msg_id_map
+                    if isinstance(key, int) and key < state.history.base]
+    if not old_keys:
+        return
+    if first(ctx.msg_id_map) in old_keys:
+        # the reacts we know about are on a message that's going away
+        ctx.reacts = Reacts()
+    if mem.store is not None:
+        mem.store.archive(chan_id, [(key, ctx.msg_id_map[key], ctx.messages[key]) for key in old_keys])
+    # NOTE: 'ctx.messages' can be shared with states (see renders), so these
+    #       are copied instead of being modified
+    set_msg_ids(ctx, { k: v for k, v in ctx.msg_id_map.items() if k not in old_keys })
+    ctx.messages   = { k: v for k, v in ctx.messages.items() if k not in old_keys }
+    metrics.inc('history_archived', len(old_keys), chan_id=chan_id)
+
+
+async def reconcile_reacts(bot, ctx, chan_id):
+    """
+    Fixes 'ctx.reacts' if it's drifted from the reacts that are actually on the
+    main message, e.g. because we missed some events while the gateway was
+    disconnected. To save on api calls, the reaction counts are checked first
+    and users are only fetched for emojis whose counts don't match.
+    Returns whether anything needed fixing.
+    """
+    if (main_id := first(ctx.msg_id_map.values())) is None:
+        return False
+
+    counts = await bot.reaction_counts(chan_id, main_id)
+    expected = Counter(r.emoji for r in ctx.reacts)
+    drifted = { e for e in counts.keys() | expected.keys() if counts.get(e, 0) != expected[e] }
+    if not drifted:
+        return False
+
+    actual = { React(user_id, emoji) for emoji in drifted if counts.get(emoji)
+                                     for user_id in await bot.reaction_users(chan_id, main_id, emoji) }
+    async with locked(ctx, chan_id):
+        if main_id != first(ctx.msg_id_map.values()):
+            # the main message changed, so these reacts don't matter anymore
+            return False
+        ctx.reacts = Reacts(ctx.reacts).without_emoji(*drifted) | actual
+
+    print(f"fixed reacts for {', '.join(drifted)} in {chan_id}")
     await update_state(bot, ctx, chan_id, lambda ctx: replace(ctx.state, reacts=ctx.reacts))
+    return True
+
+async def reconcile_all(bot, chan_ctxs, restart=False):
+    """
+    Runs reconcile_reacts() on every running channel, one at a time so that
+    live pugs still get most of the rate limit. If 'restart' is set, channels
+    that didn't need fixing get updated anyway, to restart their states.
+    Returns how many channels needed fixing.
+    """
+    n_fixed = 0
+    for chan_id, ctx in list(chan_ctxs.items()):
+        if isinstance(ctx.state, StoppedState):
+            continue
+        try:
+            if await reconcile_reacts(bot, ctx, chan_id):
+                n_fixed += 1
+            elif restart:
+                asyncio.ensure_future(update_state(bot, ctx, chan_id, lambda c: c.state))
+        except Exception:
+            print(f"Exception occured while reconciling reacts in {chan_id}", file=sys.stderr)
+            traceback.print_exc()
+    return n_fixed
+
+
+def save_ctx(chan_id, ctx):
+    # log the channel's committed state, so that it can be restored if the
+    # bot restarts
+    if mem.store is not None:
+        mem.store.append(chan_id, ctx_record(ctx))
+
+
+def update_reacts(bot, ctx, chan_id, msg_id, react, added):
+    """
+    Queue up a react event for a channel. Each channel has a single task that
+    applies the queued events in batches, so a burst of reacts only causes one
+    state update.
+    """
+    # only the latest event for each react matters, so an add followed by a
+    # remove of the same react cancels out
+    ctx.react_events.pop((msg_id, react), None)
+    ctx.react_events[msg_id, react] = added
+    if ctx.react_task is None:
+        ctx.react_task = asyncio.ensure_future(drain_reacts(bot, ctx, chan_id))
+
+
+async def drain_reacts(bot, ctx, chan_id):
+    try:
+        while ctx.react_events:
+            # give other events in the burst a chance to come in
+            await asyncio.sleep(REACT_BATCH_LATENCY)
+
+            async with locked(ctx, chan_id):
+                events, ctx.react_events = ctx.react_events, {}
+                metrics.inc('react_events', len(events), chan_id=chan_id)
+                # we only care about reacts to the main message
+                # TODO: track reacts to all messages?
+                main_id = first(ctx.msg_id_map.values())
+                added   = { r for (msg_id, r), add in events.items() if msg_id == main_id and add }
+                removed = { r for (msg_id, r), add in events.items() if msg_id == main_id and not add }
+                reacts  = (ctx.reacts | added) - removed
+                if reacts == ctx.reacts:
+                    continue
+                ctx.reacts = reacts
+                if first(ctx.state.messages) != first(ctx.messages):
+                    # the state has moved on to a new main message that hasn't
+                    # been sent yet. these reacts are on the old one, so the
+                    # update that's sending it takes them off (see run_update())
+                    continue
+                # only the reacts are applied here, so the next batch builds on
+                # them even if this update gets superseded. reducing is left to
+                # the update, which sends any new main message before reducing
+                # the state against the reacts on it.
+                ctx.state = replace(ctx.state, reacts=reacts)
+
+            # the update isn't waited on, since states like DanceState never
+            # finish updating and the batches after this one would be stuck
+            # behind it. a newer batch's update supersedes it instead.
+            asyncio.ensure_future(apply_reacts(bot, ctx, chan_id))
+    finally:
+        ctx.react_task = None
+
+async def apply_reacts(bot, ctx, chan_id):
+    try:
+        await update_state(bot, ctx, chan_id, lambda ctx: ctx.state)
+    except Exception:
+        print(f"Exception occured while updating reacts in {chan_id}", file=sys.stderr)
+        traceback.print_exc()
@@ -0,0 +1,360 @@
+from collections.abc import Set
+from typing import NamedTuple, Union
+
+from discord import Emoji
+
+from . import mem
+
+
+class React(NamedTuple):
+    user_id: int
+    emoji: Union[Emoji, str]
+
+
+"""
+Emojis get interned into a table that maps them to small indices. It lives in
+'mem' so that the indices stay valid when this module is reloaded, and it's
+bounded by the number of emojis that have been reacted with since the bot
+started. Users are interned into tables that are shared by a Reacts and every
+set made from it (see Users), so in practice each channel has its own.
+"""
+def _intern(table, index, value):
+    if (i := index.get(value)) is None:
+        i = index[value] = len(table)
+        table.append(value)
+    return i
+
+def _bits(mask):
+    """ Yields the indices of the set bits in 'mask' """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+# int.bit_count() is new in python 3.10
+_popcount = getattr(int, 'bit_count', None) or (lambda mask: bin(mask).count('1'))
+
+# when a set's user table has this many times more users than the set has
+# reacts (and at least USER_TABLE_MIN), the set gets a fresh table
+USER_TABLE_SLACK = 4
+USER_TABLE_MIN = 64
+
+
+class Users:
+    """
+    A table of interned user ids. Sets made from a Reacts share its table, so
+    set operations between them can work on the masks directly. Tables only
+    grow, but a set whose table gets too wide for it is moved to a new one.
+    """
+    __slots__ = ('ids', 'idxs')
+
+    def __init__(self):
+        self.ids, self.idxs = [], {}
+
+    def intern(self, user_id):
+        return _intern(self.ids, self.idxs, user_id)
+
+
+class Reacts(Set):
+    """
+    An immutable set of React's. It's stored as a bitset of users for each
+    emoji, so set operations between Reacts don't have to touch individual
+    reacts. It can be used anywhere a frozenset of React's can, including in
+    set operations with regular sets, which go react by react so that adding
+    or removing a few is cheap.
+    """
+    __slots__ = ('_masks', '_users', '_len', '_hash')
+
+    def __init__(self, reacts=()):
+        if isinstance(reacts, Reacts):
+            self._init(reacts._masks, reacts._users, reacts._len)
+            return
+        users, masks = Users(), {}
+        for user_id, emoji in reacts:
+            e = _intern(mem.react_emojis, mem.react_emoji_idxs, emoji)
+            masks[e] = masks.get(e, 0) | (1 << users.intern(user_id))
+        self._init(masks, users, sum(map(_popcount, masks.values())))
+
+    def _init(self, masks, users, n):
+        # empty masks are never stored, so that equal sets have equal masks
+        self._masks = masks
+        self._users = users
+        self._len = n
+        self._hash = None
+
+    @classmethod
+    def _make(cls, masks, users, n):
+        reacts = cls.__new__(cls)
+        reacts._init(masks, users, n)
+        return reacts
+
+    def _compact(self):
+        """
+        Moves this set to a table of just its own users, if most of the one
+        it's got are users that aren't in it (anymore), which would make every
+        mask wider than it needs to be. It's still the same set. This is done
+        before users get added to the table, so that sets made from this one
+        don't need it.
+        """
+        if (n_users := len(self._users.ids)) > USER_TABLE_MIN and n_users > USER_TABLE_SLACK * self._len:
+            old_ids, users = self._users.ids, Users()
+            self._masks = { e: sum(1 << users.intern(old_ids[u]) for u in _bits(m)) for e, m in self._masks.items() }
+            self._users = users
+
+    def _filtered(self, masks):
+        """ Makes a set with this one's users from 'masks', which can have empty masks """
+        masks = { e: m for e, m in masks.items() if m }
+        return Reacts._make(masks, self._users, sum(map(_popcount, masks.values())))
+
+    @classmethod
+    def _from_iterable(cls, it):
+        # used by the Set mixin methods when the other operand isn't a Reacts
+        return cls(it)
+
+    def _masks_of(self, other, intern):
+        """
+        Returns the masks of 'other' (a Reacts or a set of reacts) in terms of
+        this set's users, and whether all of it could be. Users this set's
+        table doesn't have yet are added if 'intern' is set, and left out
+        otherwise, which is fine when they can't be in this set anyway.
+        """
+        if isinstance(other, Reacts):
+            if other._users is self._users:
+                return other._masks, True
+            other_ids = other._users.ids
+            reacts = ((other_ids[u], e) for e, m in other._masks.items() for u in _bits(m))
+        else:
+            emoji_idxs = mem.react_emoji_idxs
+            try:
+                reacts = [(user_id, emoji_idxs.get(emoji) if not intern else
+                                    _intern(mem.react_emojis, emoji_idxs, emoji))
+                          for user_id, emoji in other]
+            except (TypeError, ValueError):
+                return None, False
+
+        users, masks, complete = self._users, {}, True
+        for user_id, e in reacts:
+            if intern:
+                u = users.intern(user_id)
+            elif e is None or (u := users.idxs.get(user_id)) is None:
+                complete = False
+                continue
+            masks[e] = masks.get(e, 0) | (1 << u)
+        return masks, complete
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        emojis, users = mem.react_emojis, self._users.ids
+        for e, mask in self._masks.items():
+            for u in _bits(mask):
+                yield React(users[u], emojis[e])
+
+    def __contains__(self, react):
+        try:
+            user_id, emoji = react
+            e, u = mem.react_emoji_idxs.get(emoji), self._users.idxs.get(user_id)
+        except (TypeError, ValueError):
+            return False
+        return e is not None and u is not None and bool(self._masks.get(e, 0) >> u & 1)
+
+    def __hash__(self):
+        # same as a frozenset with the same elements, since they compare equal
+        if self._hash is None:
+            self._hash = self._hash_impl()
+        return self._hash
+    _hash_impl = Set._hash
+
+    def __repr__(self):
+        return f"Reacts({set(self)!r})"
+
+    def __reduce__(self):
+        return (Reacts, (list(self),))
+
+    def __eq__(self, other):
+        if isinstance(other, Reacts):
+            if other._users is self._users:
+                return self._masks == other._masks
+            return self._len == other._len and self <= other
+        return super().__eq__(other)
+
+    def __le__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        if len(self) > len(other):
+            return False
+        if not isinstance(other, Reacts):
+            return all(react in other for react in self)
+        # look at it from the other side, so that users it doesn't have
+        # mean this isn't a subset
+        masks, complete = other._masks_of(self, intern=False)
+        other_masks = other._masks
+        return complete and all(m & ~other_masks.get(e, 0) == 0 for e, m in masks.items())
+
+    def __ge__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        if isinstance(other, Reacts):
+            return other <= self
+        return len(self) >= len(other) and all(react in self for react in other)
+
+    def __lt__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return len(self) < len(other) and self <= other
+
+    def __gt__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return len(self) > len(other) and self >= other
+
+    def __or__(self, other):
+        # checking for the builtin sets first skips the slower abc check
+        if isinstance(other, (set, frozenset)):
+            return self._add(other)
+        if not isinstance(other, Set):
+            return NotImplemented
+        if not isinstance(other, Reacts):
+            return self._add(other)
+        if other._users is not self._users and len(other) > len(self):
+            # go from the bigger set, so there's less to move between tables
+            return other | self
+        self._compact()
+        other_masks, _ = self._masks_of(other, intern=True)
+        if other_masks is None:
+            return NotImplemented
+        old_masks, masks, n = self._masks, None, self._len
+        for e, m in other_masks.items():
+            if added := m & ~old_masks.get(e, 0):
+                if masks is None:
+                    masks = dict(old_masks)
+                masks[e] = masks.get(e, 0) | added
+                n += _popcount(added)
+        return self if masks is None else Reacts._make(masks, self._users, n)
+
+    def __and__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        other_masks, _ = self._masks_of(other, intern=False)
+        if other_masks is None:
+            return NotImplemented
+        masks = self._masks
+        return self._filtered({ e: m & masks.get(e, 0) for e, m in other_masks.items() })
+
+    def __sub__(self, other):
+        if isinstance(other, (set, frozenset)):
+            return self._remove(other)
+        if not isinstance(other, Set):
+            return NotImplemented
+        if not isinstance(other, Reacts):
+            return self._remove(other)
+        other_masks, _ = self._masks_of(other, intern=False)
+        old_masks, masks, n = self._masks, None, self._len
+        for e, m in other_masks.items():
+            if removed := m & old_masks.get(e, 0):
+                if masks is None:
+                    masks = dict(old_masks)
+                if mask := masks[e] & ~removed:
+                    masks[e] = mask
+                else:
+                    del masks[e]
+                n -= _popcount(removed)
+        return self if masks is None else Reacts._make(masks, self._users, n)
+
+    def _add(self, reacts):
+        """ | for a regular set, which is usually just a react or two """
+        self._compact()
+        users, emoji_idxs = self._users, mem.react_emoji_idxs
+        user_idxs = users.idxs
+        old_masks = masks = self._masks
+        n = self._len
+        try:
+            for user_id, emoji in reacts:
+                if (e := emoji_idxs.get(emoji)) is None:
+                    e = _intern(mem.react_emojis, emoji_idxs, emoji)
+                if (u := user_idxs.get(user_id)) is None:
+                    u = users.intern(user_id)
+                if not (old := masks.get(e, 0)) & (bit := 1 << u):
+                    if masks is old_masks:
+                        masks = dict(old_masks)
+                    masks[e] = old | bit
+                    n += 1
+        except (TypeError, ValueError):
+            return NotImplemented
+        return self if masks is old_masks else Reacts._make(masks, users, n)
+
+    def _remove(self, reacts):
+        """ - for a regular set, which is usually just a react or two """
+        user_idxs, emoji_idxs = self._users.idxs, mem.react_emoji_idxs
+        old_masks = masks = self._masks
+        n = self._len
+        try:
+            for user_id, emoji in reacts:
+                if (e := emoji_idxs.get(emoji)) is None or (u := user_idxs.get(user_id)) is None:
+                    continue
+                if (old := masks.get(e, 0)) >> u & 1:
+                    if masks is old_masks:
+                        masks = dict(old_masks)
+                    if mask := old & ~(1 << u):
+                        masks[e] = mask
+                    else:
+                        del masks[e]
+                    n -= 1
+        except (TypeError, ValueError):
+            return NotImplemented
+        return self if masks is old_masks else Reacts._make(masks, self._users, n)
+
+    def __rsub__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return Reacts(other) - self
+
+    def __xor__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        return (self - other) | (Reacts(other) - self)
+
+    __ror__, __rand__, __rxor__ = __or__, __and__, __xor__
+
+    """
+    Fast paths for the queries the states make a lot of.
+    """
+    def emojis(self):
+        """ Returns the set of emojis that have been reacted with """
+        return frozenset(mem.react_emojis[e] for e in self._masks)
+
+    def user_ids(self):
+        """ Returns the set of users that have reacted """
+        mask = 0
+        for m in self._masks.values():
+            mask |= m
+        users = self._users.ids
+        return frozenset(users[u] for u in _bits(mask))
+
+    def with_emoji(self, *emojis):
+        """ Returns the reacts that use one of 'emojis' """
+        idxs = mem.react_emoji_idxs
+        return self._filtered({ e: self._masks[e] for e in map(idxs.get, emojis) if e in self._masks })
+
+    def without_emoji(self, *emojis):
+        """ Returns the reacts that don't use any of 'emojis' """
+        idxs = { mem.react_emoji_idxs.get(emoji) for emoji in emojis }
+        return self._filtered({ e: m for e, m in self._masks.items() if e not in idxs })
+
+    def with_users(self, user_ids):
+        """ Returns the reacts by any of 'user_ids' """
+        mask = self._user_mask(user_ids)
+        return self._filtered({ e: m & mask for e, m in self._masks.items() })
+
+    def without_users(self, user_ids):
+        """ Returns the reacts not by any of 'user_ids' """
+        mask = self._user_mask(user_ids)
+        return self._filtered({ e: m & ~mask for e, m in self._masks.items() })
+
+    def _user_mask(self, user_ids):
+        idxs, mask = self._users.idxs, 0
+        for user_id in user_ids:
+            if (u := idxs.get(user_id)) is not None:
+                mask |= 1 << u
+        return mask
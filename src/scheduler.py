@@ -0,0 +1,191 @@
+import asyncio
+from dataclasses import dataclass, field
+import heapq
+from itertools import count
+from time import monotonic
+from typing import Callable, Hashable, List
+
+# request priorities. lower values get sent first.
+EDIT    = 0  # edits to messages people are looking at
+SEND    = 1
+REACT   = 2  # adding reactions
+DELETE  = 3
+CLEANUP = 4  # removing reactions
+SYNC    = 5  # fetching things to check we're in sync with discord
+ANIMATE = 6  # frames of animations, which give way to everything else
+
+# request budgets, as (number of requests, per seconds). these are a bit under
+# discord's actual limits so that we (hopefully) never hit a 429.
+# see: https://discord.com/developers/docs/topics/rate-limits
+GLOBAL_LIMIT = (45, 1)
+ROUTE_LIMITS = {
+    'message':  (5, 5),    # per channel
+    'delete':   (5, 1),    # per channel
+    'reaction': (1, 0.25), # per channel
+    'fetch':    (5, 1),    # per channel
+    'user':     (5, 1),    # shared by every channel
+}
+
+
+class Bucket:
+    """ A token bucket that allows 'limit' requests every 'per' seconds """
+
+    def __init__(self, limit, per):
+        self.capacity = self.tokens = limit
+        self.rate = limit / per
+        self.last = monotonic()
+
+    def wait_time(self, now):
+        """ Returns how long until a request can be made """
+        if now > self.last:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+
+@dataclass(order=True)
+class Request:
+    priority: int
+    seq: int
+    route: Hashable = field(compare=False)
+    make_coro: Callable = field(compare=False)
+    # the futures of everyone waiting on this request. there's more than one
+    # if it superseded other requests.
+    futs: List[asyncio.Future] = field(compare=False)
+    queued_at: float = field(compare=False)
+    key: Hashable = field(compare=False, default=None)
+
+    def abandoned(self):
+        """ Whether everyone waiting on this request gave up on it """
+        return all(fut.done() for fut in self.futs)
+
+
+class Scheduler:
+    """
+    Sits between the bot and discord's http client, and decides which requests
+    get sent when. Requests are sent in priority order, as long as their route
+    and the global budget have room for them.
+    """
+
+    def __init__(self, global_limit=GLOBAL_LIMIT, route_limits=ROUTE_LIMITS):
+        self.route_limits = route_limits
+        self.global_bucket = Bucket(*global_limit)
+        self.buckets = {}
+        self.queue = []
+        self.seq = count()
+        self.task = None
+        self.wakeup = None
+        # queued requests by key, see request()
+        self.keyed = {}
+
+        # stats
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.superseded = 0
+
+    @property
+    def queue_depth(self):
+        return len(self.queue)
+
+    def waiting(self, priority):
+        """ Returns how many queued requests are more important than 'priority' """
+        return sum(req.priority < priority for req in self.queue)
+
+    @property
+    def mean_wait(self):
+        return self.total_wait / self.sent if self.sent else 0.0
+
+    def bucket(self, route):
+        if route not in self.buckets:
+            name, *_ = route
+            self.buckets[route] = Bucket(*self.route_limits[name])
+        return self.buckets[route]
+
+    async def request(self, priority, route, make_coro, key=None):
+        """
+        Queue up a request and wait for its result. 'route' is a tuple starting
+        with one of the names in ROUTE_LIMITS, and 'make_coro' is called to
+        create the coroutine that actually sends the request.
+
+        If a request with the same 'key' is still queued, this one supersedes
+        it: the old one is dropped, and this one takes its place in the queue.
+        Whoever was waiting on the old one gets this one's result.
+        """
+        fut = asyncio.get_event_loop().create_future()
+        req = Request(priority, next(self.seq), route, make_coro, [fut], monotonic(), key)
+        if key is not None:
+            if (old := self.keyed.get(key)) is not None:
+                self.queue.remove(old)
+                heapq.heapify(self.queue)
+                req.seq, req.queued_at, req.futs = old.seq, old.queued_at, old.futs + req.futs
+                self.superseded += 1
+            self.keyed[key] = req
+        heapq.heappush(self.queue, req)
+
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return await fut
+
+    async def run(self):
+        while self.queue:
+            self.wakeup.clear()
+            now = monotonic()
+            wait = self.global_bucket.wait_time(now)
+            if wait == 0:
+                # take the highest priority request whose route isn't exhausted
+                for req in sorted(self.queue):
+                    if req.abandoned():
+                        # whoever made the request gave up on it
+                        self.dequeue(req)
+                        continue
+                    if (route_wait := self.bucket(req.route).wait_time(now)) == 0:
+                        break
+                    wait = min(route_wait, wait or route_wait)
+                else:
+                    req = None
+
+                if req is not None:
+                    self.dequeue(req)
+                    heapq.heapify(self.queue)
+                    self.global_bucket.take()
+                    self.bucket(req.route).take()
+                    self.sent += 1
+                    self.total_wait += now - req.queued_at
+                    self.max_wait = max(self.max_wait, now - req.queued_at)
+                    asyncio.ensure_future(self.send(req))
+                    continue
+
+                heapq.heapify(self.queue)
+                if not self.queue:
+                    break
+
+            # nothing can be sent right now. sleep until something can, or
+            # until a new request comes in.
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def dequeue(self, req):
+        self.queue.remove(req)
+        if req.key is not None and self.keyed.get(req.key) is req:
+            del self.keyed[req.key]
+
+    async def send(self, req):
+        try:
+            result = await req.make_coro()
+        except Exception as err:
+            for fut in req.futs:
+                if not fut.done():
+                    fut.set_exception(err)
+        else:
+            for fut in req.futs:
+                if not fut.done():
+                    fut.set_result(result)
@@ -0,0 +1,135 @@
+import asyncio
+from itertools import count
+from multiprocessing.connection import wait
+import sys
+import traceback
+
+# how long to wait for every worker to answer a broadcast, in seconds
+BROADCAST_TIMEOUT = 10
+
+
+def shard_for(guild_id, shard_count):
+    """ Returns the shard that discord sends a guild's events to """
+    # see: https://discord.com/developers/docs/topics/gateway#sharding
+    return (guild_id >> 22) % shard_count
+
+def worker_shards(worker, workers, shard_count):
+    """ Returns the shards that a worker process is responsible for """
+    return list(range(worker, shard_count, workers))
+
+
+"""
+When the bot is split across multiple processes, each worker only knows about
+the channels on its own shards. Commands that need to see every channel (like
+'status') are broadcast to all the workers through a router running in the
+parent process, and get back a list with each worker's result.
+
+Messages are tuples of (kind, request id, ...):
+    worker -> router: ('broadcast', id, name, args)
+    router -> worker: ('call',      id, name, args)
+    worker -> router: ('reply',     id, result)
+    router -> worker: ('result',    id, results)
+"""
+
+class Router:
+    """ Passes broadcasts between worker processes. Runs in the parent process. """
+
+    def __init__(self, conns):
+        self.workers = list(conns)
+        self.conns = list(self.workers)
+        self.ids = count()
+        # call id -> (conn that sent the broadcast, its request id, { conn: result })
+        self.pending = {}
+
+    def run(self):
+        """ Route messages until every worker has disconnected """
+        while self.conns:
+            for conn in wait(self.conns):
+                self.handle(conn)
+
+    def handle(self, conn):
+        try:
+            kind, req_id, *rest = conn.recv()
+        except EOFError:
+            self.drop(conn)
+            return
+
+        if kind == 'broadcast':
+            name, args = rest
+            call_id = next(self.ids)
+            self.pending[call_id] = (conn, req_id, {})
+            for worker in self.conns:
+                worker.send(('call', call_id, name, args))
+        elif kind == 'reply':
+            [result] = rest
+            if req_id in self.pending:
+                self.pending[req_id][2][conn] = result
+                self.finish(req_id)
+        else:
+            print(f"router got unknown message kind '{kind}'", file=sys.stderr)
+
+    def drop(self, conn):
+        # a worker went away, so don't wait for it to answer anything
+        self.conns.remove(conn)
+        for call_id in list(self.pending):
+            self.finish(call_id)
+
+    def finish(self, call_id):
+        origin, req_id, results = self.pending[call_id]
+        if any(c not in results for c in self.conns):
+            return
+        del self.pending[call_id]
+        if origin in self.conns:
+            origin.send(('result', req_id, [results.get(c) for c in self.workers]))
+
+
+class Peer:
+    """ A worker's connection to the router """
+
+    def __init__(self, conn, handlers):
+        self.conn = conn
+        # name -> async function that answers broadcasts with that name
+        self.handlers = handlers
+        self.ids = count()
+        self.pending = {}
+
+    def start(self, loop):
+        self.loop = loop
+        loop.add_reader(self.conn.fileno(), self.on_readable)
+
+    def on_readable(self):
+        while self.conn.poll():
+            try:
+                kind, req_id, *rest = self.conn.recv()
+            except EOFError:
+                self.loop.remove_reader(self.conn.fileno())
+                return
+
+            if kind == 'call':
+                asyncio.ensure_future(self.call(req_id, *rest))
+            elif kind == 'result':
+                [results] = rest
+                if (fut := self.pending.pop(req_id, None)) and not fut.done():
+                    fut.set_result(results)
+
+    async def call(self, call_id, name, args):
+        try:
+            result = await self.handlers[name](*args)
+        except Exception:
+            print(f"Exception occured while handling broadcast '{name}'", file=sys.stderr)
+            traceback.print_exc()
+            result = None
+        self.conn.send(('reply', call_id, result))
+
+    async def broadcast(self, name, *args):
+        """
+        Run a handler in every worker (including this one), and return a list
+        of their results. Workers that died or errored give a result of None.
+        """
+        req_id = next(self.ids)
+        self.pending[req_id] = fut = self.loop.create_future()
+        self.conn.send(('broadcast', req_id, name, args))
+        try:
+            return await asyncio.wait_for(fut, timeout=BROADCAST_TIMEOUT)
+        finally:
+            self.pending.pop(req_id, None)
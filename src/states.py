@@ -1,30 +1,152 @@
-from collections import defaultdict, Counter
-from dataclasses import dataclass, fields, replace
+from collections import Counter
+from dataclasses import dataclass, field, fields, replace
 from itertools import chain
 from functools import cached_property
 from operator import attrgetter as get
 import random
-from typing import Tuple, FrozenSet, NamedTuple, Union
+from typing import Dict, FrozenSet, Optional, Tuple, Union
 
-from discord import Embed, Emoji
+from discord import Embed
 from flag import flag
 
 from .bot_stuff import Bot, mention
-from .utils import create_index, fset, user_set
+from .names import display_name
+from .reacts import React, Reacts
+from .utils import fset
 
 
-class React(NamedTuple):
-    user_id: int
-    emoji: Union[Emoji, str]
+FROZEN = True
+
+# how many history messages states keep. older ones get archived, see
+# archive_history() in pug.py
+HISTORY_LEN = 12
+
+class History(tuple):
+    """
+    The messages left behind by earlier states. Only the last HISTORY_LEN are
+    kept, and 'base' is how many have been dropped, so that each message's
+    key (its position in the whole history) stays the same.
+    """
+    def __new__(cls, items=(), base=0):
+        items = tuple(items)
+        if len(items) > HISTORY_LEN:
+            base, items = base + len(items) - HISTORY_LEN, items[-HISTORY_LEN:]
+        history = super().__new__(cls, items)
+        history.base = base
+        return history
+
+    def __getnewargs__(self):
+        return (tuple(self), self.base)
+
+    def __add__(self, other):
+        if not isinstance(other, tuple):
+            return NotImplemented
+        return History((*self, *other), self.base)
+
+    def __eq__(self, other):
+        if not isinstance(other, tuple):
+            return NotImplemented
+        return getattr(other, 'base', 0) == self.base and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        # same as a tuple when nothing's been dropped, since they compare equal
+        return tuple.__hash__(self) if self.base == 0 else hash((tuple(self), self.base))
+
+    def __repr__(self):
+        return f"History({tuple(self)!r}, base={self.base})"
+
+    def keyed(self):
+        """ Returns the messages by key, to include in a state's messages """
+        return { self.base + i: msg for i, msg in enumerate(self) }
+
+
+# how many renders each state class keeps around, see renders
+RENDER_CACHE_SIZE = 1024
+# if set, messages are a pure function of their state: any randomness in them
+# is seeded from the state, so rendering the same state twice (e.g. after the
+# render cache is emptied by a reload) never causes an edit
+DETERMINISTIC_RENDERS = True
+
+def render_rng(*seed):
+    """ Returns the random number generator for a render to use """
+    if not DETERMINISTIC_RENDERS:
+        return random
+    # seeding with a str uses all of it, and doesn't depend on PYTHONHASHSEED
+    # like hash() does, so this is the same across restarts too
+    return random.Random(repr(seed))
+
+class renders:
+    """
+    Decorator for a state's 'messages'. The messages get memoized by the
+    values of 'deps', which have to include every attribute (fields or
+    properties) that the messages depend on. States that only differ in other
+    fields, e.g. reacts that don't show up in the messages, get the exact same
+    dict back, so update_state() can tell nothing needs to be edited without
+    rendering or diffing anything.
+    """
+    def __init__(self, *deps):
+        self.deps = deps
+        self.cache = {}
+
+    def __call__(self, render):
+        self.render = render
+        self.__doc__ = render.__doc__
+        return self
+
+    def __set_name__(self, cls, name):
+        self.name = name
+
+    def key(self, state):
+        def freeze(value):
+            # a dict's values matter too. if they aren't hashable, the render
+            # just doesn't get cached (see __get__())
+            if isinstance(value, dict):
+                return fset(value.items())
+            return fset(value) if isinstance(value, set) else value
+        return (type(state), state.bot, *(freeze(getattr(state, dep)) for dep in self.deps))
+
+    def __get__(self, state, cls):
+        if state is None:
+            return self
+        try:
+            key = self.key(state)
+            messages = self.cache.pop(key, None)
+        except TypeError:
+            # something in 'deps' isn't hashable, so just don't cache this one
+            key, messages = None, None
+        if messages is None:
+            messages = self.render(state)
+            if len(self.cache) >= RENDER_CACHE_SIZE:
+                del self.cache[next(iter(self.cache))]
+        if key is not None:
+            # (re)insert it, so that the least recently used render is first
+            self.cache[key] = messages
+        # like cached_property, so that this is only looked up once per state
+        state.__dict__[self.name] = messages
+        return messages
 
 
-FROZEN = True
 @dataclass(frozen=FROZEN)
 class State:
     bot: Bot
     admin_ids: Tuple[int]
     reacts: FrozenSet[React]
-    history: Tuple[Union[str, Embed]]
+    history: History
+
+    # whether this is an animation, which gets its frames from animation.py
+    # and whose edits give way to everything else
+    animated = False
+
+    def __post_init__(state):
+        # store reacts compactly, no matter what kind of set they're given as
+        if not isinstance(state.reacts, Reacts):
+            object.__setattr__(state, 'reacts', Reacts(state.reacts))
+        if not isinstance(state.history, History):
+            object.__setattr__(state, 'history', History(state.history))
 
     @classmethod
     def make(cls, from_state, *args, **kwargs):
@@ -32,15 +154,39 @@ class State:
                        for f in fields(State)]
         return cls(*base_fields, *args, **kwargs)
 
-    async def on_update(state):
+    def reduce(state):
+        """
+        Yields the states that this one goes through on its way to the next
+        stable state. States that only depend on their fields (i.e. most of
+        them) override this. States that have to wait on something override
+        on_update() instead.
+        """
         yield state
 
+    async def on_update(state):
+        for next_state in state.reduce():
+            yield next_state
+
+    @classmethod
+    def reduces(cls):
+        """ Returns whether this state's transitions can be done with reduce() """
+        return cls.on_update is State.on_update
+
+    @cached_property
+    def is_stable(state):
+        """ Whether reducing this state doesn't change it """
+        return next(state.reduce(), state) == state
+
+    @property
+    def admin_names(state):
+        return tuple(display_name(state.bot, user_id) for user_id in sorted(state.admin_ids))
+
 
 @dataclass(frozen=FROZEN)
 class StoppedState(State):
-    @property
+    @renders('history')
     def messages(state):
-        return { **dict(enumerate(state.history)) }
+        return { **state.history.keyed() }
 
 
 MIN_HOSTS = 1
@@ -60,40 +206,131 @@ FLAG_EMOJIS   = ['\U0001F3F3\U0000FE0F\U0000200D\U0001F308', '\U0001F3F4\U000020
 OPTION_EMOJIS = [f'{i}\N{COMBINING ENCLOSING KEYCAP}' for i in range(10)] + [chr(i) for i in range(ord('\N{REGIONAL INDICATOR SYMBOL LETTER A}'), ord('\N{REGIONAL INDICATOR SYMBOL LETTER A}') + 26)]
 DONE_EMOJI = '\N{WHITE HEAVY CHECK MARK}'
 
+# check that IdleViews.update() gives the same results as IdleViews.compute()
+VERIFY_VIEWS = False
+
+@dataclass(frozen=True)
+class IdleViews:
+    """
+    Things that an IdleState derives from its reacts. These get carried over
+    to the states made from it, and updated using just the reacts that were
+    added/removed, since an idle pug can have lots of reacts.
+    """
+    reacts: Reacts
+    admin_ids: FrozenSet[int]
+    admin_wait: Reacts
+    admin_skip: Reacts
+    host_ids: FrozenSet[int]
+    capt_ids: FrozenSet[int]
+    player_ids: FrozenSet[int]
+    # how many of the reacts that make someone a player they have
+    player_counts: Dict[int, int]
+
+    @classmethod
+    def compute(cls, state):
+        """ Derives everything from scratch """
+        bot_id = state.bot.user_id
+        admin_wait = state.reacts.with_emoji(WAIT_EMOJI).with_users(state.admin_ids)
+        admin_skip = state.reacts.with_emoji(SKIP_EMOJI).with_users(state.admin_ids)
+        player_reacts = state.reacts.without_emoji(HOST_EMOJI) - admin_wait - admin_skip
+        player_counts = Counter(r.user_id for r in player_reacts if r.user_id != bot_id)
+        return cls(
+            reacts=state.reacts,
+            admin_ids=fset(state.admin_ids),
+            admin_wait=admin_wait,
+            admin_skip=admin_skip,
+            host_ids=state.reacts.with_emoji(HOST_EMOJI).user_ids() - { bot_id },
+            capt_ids=state.reacts.with_emoji(CAPT_EMOJI).user_ids() - { bot_id },
+            player_ids=fset(player_counts),
+            player_counts=dict(player_counts),
+        )
+
+    @classmethod
+    def update(cls, views, state):
+        """ Updates 'views' (which may be None) to match 'state' """
+        if views is None or views.admin_ids != state.admin_ids:
+            return cls.compute(state)
+        if views.reacts == state.reacts:
+            return views
+
+        added, removed = state.reacts - views.reacts, views.reacts - state.reacts
+        if len(added) + len(removed) > len(state.reacts):
+            # it's quicker to start over
+            return cls.compute(state)
+
+        bot_id = state.bot.user_id
+        is_admin = views.admin_ids.__contains__
+        host_ids, capt_ids, touched = {}, {}, set()
+        player_counts = dict(views.player_counts)
+        for reacts, sign in [(removed, -1), (added, 1)]:
+            for user_id, emoji in reacts:
+                if user_id == bot_id or (emoji in (WAIT_EMOJI, SKIP_EMOJI) and is_admin(user_id)):
+                    continue
+                if emoji == HOST_EMOJI:
+                    host_ids[user_id] = sign
+                    continue
+                if emoji == CAPT_EMOJI:
+                    capt_ids[user_id] = sign
+                touched.add(user_id)
+                player_counts[user_id] = player_counts.get(user_id, 0) + sign
+                if player_counts[user_id] == 0:
+                    del player_counts[user_id]
+
+        def apply(ids, changes):
+            if not changes:
+                return ids
+            return (ids - { u for u, sign in changes.items() if sign < 0 }) | { u for u, sign in changes.items() if sign > 0 }
+
+        player_changes = { u: 1 if u in player_counts else -1 for u in touched
+                           if (u in player_counts) != (u in views.player_counts) }
+        return cls(
+            reacts=state.reacts,
+            admin_ids=views.admin_ids,
+            admin_wait=state.reacts.with_emoji(WAIT_EMOJI).with_users(views.admin_ids),
+            admin_skip=state.reacts.with_emoji(SKIP_EMOJI).with_users(views.admin_ids),
+            host_ids=apply(views.host_ids, host_ids),
+            capt_ids=apply(views.capt_ids, capt_ids),
+            player_ids=apply(views.player_ids, player_changes),
+            player_counts=player_counts,
+        )
+
+
 @dataclass(frozen=True)
 class IdleState(State):
-    async def on_update(state):
+    # the views of an earlier state, see views()
+    prev_views: Optional[IdleViews] = field(default=None, compare=False, repr=False)
+
+    def reduce(state):
         # add default reacts
-        bot_reacts = { React(state.bot.user_id, e) for e in (HOST_EMOJI, CAPT_EMOJI) }
-        yield (state := replace(state, reacts=state.reacts | bot_reacts))
+        bot_reacts = Reacts(React(state.bot.user_id, e) for e in (HOST_EMOJI, CAPT_EMOJI))
+        if not bot_reacts <= state.reacts:
+            state = replace(state, reacts=state.reacts | bot_reacts)
+        yield state
 
         # pug admins can use reacts to wait/skip this state
         # TODO: remove admin skipping?
         if (state.enough_ppl and not state.admin_wait) or state.admin_skip:
             # go to voting state
-            state = replace(state, history=(*state.history, state.messages['idle']))
+            state = replace(state, history=state.history + (state.messages['idle'],))
             yield VoteState.make(state, state.host_ids, state.capt_ids, state.player_ids)
 
-    @cached_property
+    @renders('admin_names', 'history', 'admin_wait', 'pauser_names', 'admin_skip',
+             'host_ids', 'capt_ids', 'player_ids', 'player_emojis')
     def messages(state):
         # for the player emoji, pick a random one that someone's reacted with,
         # with a default if there's no player reacts yet
-        choices = { r.emoji for r in state.reacts } - { HOST_EMOJI, CAPT_EMOJI , SKIP_EMOJI, WAIT_EMOJI }
-        player_emoji = random.choice(list(choices) or [PLAYER_EMOJI])
+        player_emojis = sorted(state.player_emojis) or [PLAYER_EMOJI]
+        player_emoji = render_rng(player_emojis).choice(player_emojis)
 
         if state.admin_wait:
-            # TODO: use get_member() so we can use display_name.
-            #       for that we need to get the channel id from somewhere...
-            pauser_names = (str(state.bot.get_user(r.user_id).name) for r in state.admin_wait)
-            footer = f"PUG paused by {', '.join(pauser_names)}. Waiting for them to unpause..."
+            footer = f"PUG paused by {', '.join(state.pauser_names)}. Waiting for them to unpause..."
         elif state.enough_ppl or state.admin_skip:
             footer = 'PUG starting now...'
         else:
-            admin_names = (str(state.bot.get_user(user_id)) for user_id in state.admin_ids)
             footer = (
                 f"The PUG will automatically start when there are {MIN_PLAYERS} players.\n"
                 f"If there aren't enough hosts/captains, a vote including all players will start.\n"
-                f"{' and '.join(admin_names)} can react with {WAIT_EMOJI} to stop the PUG from starting, or {SKIP_EMOJI} to start it immediately.\n"
+                f"{' and '.join(state.admin_names)} can react with {WAIT_EMOJI} to stop the PUG from starting, or {SKIP_EMOJI} to start it immediately.\n"
             )
         plural = lambda num, noun: f"{num} {noun}" + ('s' if num != 1 else '')
         return {
@@ -106,44 +343,54 @@ class IdleState(State):
                     f"React with anything else to play.\n"
                 ))
                 .add_field(name=f"{HOST_EMOJI}  {plural(len(state.host_ids), 'host')}",
-                           value=EMPTY + ' '.join(map(mention, state.host_ids)))
+                           value=EMPTY + ' '.join(map(mention, sorted(state.host_ids))))
                 .add_field(name=f"{CAPT_EMOJI}  {plural(len(state.capt_ids), 'captain')}",
-                           value=EMPTY + ' '.join(map(mention, state.capt_ids)))
+                           value=EMPTY + ' '.join(map(mention, sorted(state.capt_ids))))
                 .add_field(inline=False,
                            name=f"{player_emoji}  {plural(len(state.player_ids), 'player')}",
-                           value=EMPTY + ' '.join(map(mention, state.player_ids)))
+                           value=EMPTY + ' '.join(map(mention, sorted(state.player_ids))))
                 .set_footer(text=footer)
             ),
-            **dict(enumerate(state.history))
+            **state.history.keyed()
         }
 
     @cached_property
-    def reacts_by_emoji(state):
-        reacts_without_bot = (r for r in state.reacts if r.user_id != state.bot.user_id)
-        return defaultdict(set, create_index(reacts_without_bot, get('emoji')))
+    def views(state):
+        views = IdleViews.update(state.prev_views, state)
+        # store them so that states made from this one with replace() get them
+        object.__setattr__(state, 'prev_views', views)
+        if VERIFY_VIEWS:
+            assert views == IdleViews.compute(state), "incrementally updated views are wrong"
+        return views
 
-    @cached_property
+    @property
+    def player_emojis(state):
+        return state.reacts.emojis() - { HOST_EMOJI, CAPT_EMOJI , SKIP_EMOJI, WAIT_EMOJI }
+
+    @property
     def admin_wait(state):
-        return state.reacts & { React(a_id, WAIT_EMOJI) for a_id in state.admin_ids }
+        return state.views.admin_wait
 
-    @cached_property
+    @property
+    def pauser_names(state):
+        return tuple(display_name(state.bot, r.user_id) for r in sorted(state.admin_wait))
+
+    @property
     def admin_skip(state):
-        return state.reacts & { React(a_id, SKIP_EMOJI) for a_id in state.admin_ids }
-        return state.reacts & r(state.admin_ids, SKIP_EMOJI)
+        return state.views.admin_skip
 
-    @cached_property
+    @property
     def host_ids(state):
-        return user_set(state.reacts_by_emoji[HOST_EMOJI])
+        return state.views.host_ids
 
-    @cached_property
+    @property
     def capt_ids(state):
-        return user_set(state.reacts_by_emoji[CAPT_EMOJI])
+        return state.views.capt_ids
 
-    @cached_property
+    @property
     def player_ids(state):
-        return (user_set(state.reacts - state.reacts_by_emoji[HOST_EMOJI]
-                                      - state.admin_wait - state.admin_skip)
-                                      - { state.bot.user_id })
+        return state.views.player_ids
+
     @property
     def enough_ppl(state):
         return len(state.player_ids) >= MIN_PLAYERS
@@ -165,24 +412,24 @@ class VoteState(State):
             capt_ids = set(capt_ids) | set(player_ids)
 
         assert len(host_ids) >= 1 and len(capt_ids) >= 2
-        state = super().make(from_state, tuple(host_ids), tuple(capt_ids), fset(player_ids))
+        # sorted, so the same people always get the same vote emojis
+        state = super().make(from_state, tuple(sorted(host_ids)), tuple(sorted(capt_ids)), fset(player_ids))
         # skip voting if there's nothing to vote on
         if not state.host_voting and not state.capt_voting:
             [host_id] = host_ids
-            return PickState.make(state, host_id, tuple(capt_ids), fset(player_ids) - set(capt_ids))
+            return PickState.make(state, host_id, state.capt_ids, fset(player_ids) - set(capt_ids))
         return state
 
-    @property
+    @renders('admin_names', 'history', 'host_ids', 'capt_ids', 'player_ids', 'players_that_didnt_react')
     def messages(state):
-        admin_names = (str(state.bot.get_user(u)) for u in state.admin_ids)
-        players_that_didnt_react = (set(state.player_ids) - { r.user_id for r in state.reacts})
+        players_that_didnt_react = state.players_that_didnt_react
         embed = (Embed(
             title='**PUG voting**',
             colour=0xaa8ed6,
             description='React to vote for a host/captains')
             .set_footer(text=(
                 f"Waiting for {len(players_that_didnt_react)} more players to react.\n"
-                f"{' and '.join(admin_names)} can react with {SKIP_EMOJI} to end voting early, or {SHUFFLE_EMOJI} to randomize teams.\n")
+                f"{' and '.join(state.admin_names)} can react with {SKIP_EMOJI} to end voting early, or {SHUFFLE_EMOJI} to randomize teams.\n")
             ))
 
         if state.host_voting:
@@ -196,17 +443,15 @@ class VoteState(State):
 
         return {
             'vote': embed,
-            **dict(enumerate(state.history))
+            **state.history.keyed()
         }
 
 
-    async def on_update(state):
+    def reduce(state):
         yield state
 
         # add default reacts. we add the host and capt reacts seperately, so
         # that the host reacts show up first.
-        # TODO: these will cause unnecessary message edits, even though only
-        #       the reacts are changing. 
         for emojis, voting in [(state.host_emojis, state.host_voting),
                                (state.capt_emojis, state.capt_voting)]:
             bot_reacts = { React(state.bot.user_id, e) for e in emojis }
@@ -216,18 +461,18 @@ class VoteState(State):
         # remove any votes by people for themselves, or by people who aren't playing
         self_host_votes  = { React(i, e) for i, e in zip(state.host_ids, state.host_emojis) }
         self_capt_votes  = { React(i, e) for i, e in zip(state.capt_ids, state.capt_emojis) }
-        non_player_votes = { r for r in state.reacts if r.user_id not in (state.player_ids | { *state.admin_ids, state.bot.user_id }) }
-        yield (state := replace(state, reacts=state.reacts - self_host_votes - self_capt_votes - non_player_votes))
+        voters = state.player_ids | { *state.admin_ids, state.bot.user_id }
+        yield (state := replace(state, reacts=state.reacts.with_users(voters) - self_host_votes - self_capt_votes))
 
         # admins can choose to just randomize teams
-        admin_shuffle = state.reacts & { React(a_id, SHUFFLE_EMOJI) for a_id in state.admin_ids }
+        admin_shuffle = state.reacts.with_emoji(SHUFFLE_EMOJI).with_users(state.admin_ids)
         if admin_shuffle:
             yield RunningState.make_random(state, *state.capt_ids, *state.player_ids)
             return
 
         # admins can end this state early
-        admin_skip = state.reacts & { React(a_id, SKIP_EMOJI) for a_id in state.admin_ids }
-        all_players_have_reacted = ({ r.user_id for r in state.reacts } >= set(state.player_ids))
+        admin_skip = state.reacts.with_emoji(SKIP_EMOJI).with_users(state.admin_ids)
+        all_players_have_reacted = (state.reacts.user_ids() >= set(state.player_ids))
         if admin_skip or all_players_have_reacted:
             # tally up them votes
             def count_votes(emojis, ids):
@@ -245,6 +490,10 @@ class VoteState(State):
             [(blu_capt, _), (red_capt, _)] = capt_votes.most_common(2)  # "worse" captain gets first pick (red)
             yield PickState.make(state, host_id, (red_capt, blu_capt), state.player_ids - { red_capt, blu_capt })
 
+    @property
+    def players_that_didnt_react(state):
+        return fset(state.player_ids) - state.reacts.user_ids()
+
     @property
     def host_voting(state):
         return len(state.host_ids) != 1
@@ -284,7 +533,7 @@ class PickState(State):
         assert len(capt_ids) == 2
         return super().make(from_state, host_id, tuple(capt_ids), fset(player_ids))
 
-    @property
+    @renders('history', 'host_id', 'capt_ids', 'player_ids', 'team_ids', 'pick_idx')
     def messages(state):
         teams_full = (len(state.red_ids) == len(state.blu_ids) == state.team_size)
         if teams_full:
@@ -299,7 +548,7 @@ class PickState(State):
             # TODO: include the number of players to pick
             ping = { ('ping', state.pick_idx): f"{mention(picking_capt)} - pick some players" }
 
-        player_to_emoji = dict(zip(state.player_ids, OPTION_EMOJIS))
+        player_to_emoji = dict(zip(state.player_order, OPTION_EMOJIS))
         def format_player(player_id):
             if player_id in state.unpicked_ids:
                 return f"{player_to_emoji[player_id]} {mention(player_id)}"
@@ -326,31 +575,31 @@ class PickState(State):
                            value=' '.join(map(mention, state.capt_ids)),
                            inline=False)
                 .add_field(name=f"Players",
-                           value=EMPTY + '\n'.join(map(format_player, state.player_ids)))
+                           value=EMPTY + '\n'.join(map(format_player, state.player_order)))
                 .add_field(name=f"{RED_EMOJI} RED {RED_EMOJI}",
                            value=EMPTY + '\n'.join(map(mention, state.red_ids)))
                 .add_field(name=f"{BLU_EMOJI} BLU {BLU_EMOJI}",
                            value=EMPTY + '\n'.join(map(mention, state.blu_ids)))
             ),
             **ping,
-            **dict(enumerate(state.history))
+            **state.history.keyed()
         }
 
-    async def on_update(state):
+    def reduce(state):
         # if the teams are full, start the pug
         if len(state.red_ids) == len(state.blu_ids) == state.team_size:
             yield RunningState.make(state, state.host_id, state.red_ids, state.blu_ids)
             return
 
         # add bot reacts
-        pick_emojis = [e for e, u in zip(OPTION_EMOJIS, state.player_ids)
+        pick_emojis = [e for e, u in zip(OPTION_EMOJIS, state.player_order)
                          if u in state.unpicked_ids]
         reacts = state.reacts | { React(state.bot.user_id, e) for e in pick_emojis }
 
         # check if the current captain picked anyone
         picking_team = PICK_ORDER[state.pick_idx]
         capt_picks = reacts & { (state.capt_ids[picking_team], e)
-                                for e, u in zip(OPTION_EMOJIS, state.player_ids)
+                                for e, u in zip(OPTION_EMOJIS, state.player_order)
                                 if u in state.unpicked_ids }
         if not capt_picks:
             yield (state := replace(state, reacts=reacts))
@@ -359,7 +608,7 @@ class PickState(State):
 
         # add the picked player to the team
         _, picked_emoji = next(iter(capt_picks))
-        picked_id = next(u for u, e in zip(state.player_ids, OPTION_EMOJIS)
+        picked_id = next(u for u, e in zip(state.player_order, OPTION_EMOJIS)
                            if e == picked_emoji)
         print(f"team {picking_team} picked {picked_id}")
         team_ids = list(state.team_ids)  # modifying nested tuples... bleh
@@ -390,6 +639,12 @@ class PickState(State):
     def team_size(state):
         return min(MAX_PLAYERS, len(state.capt_ids) + len(state.player_ids)) // 2
 
+    @cached_property
+    def player_order(state):
+        # players get their pick emoji by id, not set order, so it doesn't
+        # change between renders or after a reload
+        return tuple(sorted(state.player_ids))
+
     @cached_property
     def unpicked_ids(state):
         return state.player_ids - fset(state.team_ids[0] + state.team_ids[1])
@@ -415,7 +670,7 @@ class RunningState(State):
         return cls.make(from_state, host_id, tuple(red_ids), tuple(blu_ids))
 
 
-    @cached_property
+    @renders('history', 'host_id', 'red_ids', 'blu_ids')
     def messages(state):
         return {
             'running': (
@@ -434,12 +689,11 @@ class RunningState(State):
                            f"{mention(state.red_ids[0])}\n{mention(state.blu_ids[0])}"))
             ),
             ('running', 'notify'): 'PUG started: ' + ' '.join(map(mention, chain([state.host_id], state.red_ids, state.blu_ids))),
-            **dict(enumerate(state.history))
+            **state.history.keyed()
         }
 
-    async def on_update(state):
+    def reduce(state):
         yield state
         # stop the bot
-        yield StoppedState.make(state, history=(*state.history,
-                                                state.messages['running'],
-                                                state.messages['running', 'notify']))
+        yield StoppedState.make(state, history=state.history + (state.messages['running'],
+                                                                state.messages['running', 'notify']))
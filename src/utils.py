@@ -17,6 +17,24 @@ async def anext(async_iterator, default):
 def first(iterable):
     return next(iter(iterable), None)
 
+def paginate(lines, max_len):
+    """
+    Joins 'lines' into pages of at most 'max_len' characters each, without
+    splitting any lines (unless a line is too long by itself). Always returns
+    at least one page.
+    """
+    pages, page = [], []
+    page_len = 0
+    for line in lines:
+        line = line[:max_len]
+        if page and page_len + 1 + len(line) > max_len:
+            pages.append('\n'.join(page))
+            page, page_len = [], 0
+        page_len += bool(page) + len(line)
+        page.append(line)
+    pages.append('\n'.join(page))
+    return pages
+
 def create_index(iterable, index_fn):
     """
     Return an index of 'iterable' using 'index_fn', i.e.
@@ -35,6 +53,55 @@ def invert_dict(d):
     vals = iter(d.values())
     return create_index(d, lambda _: next(vals))
 
+def min_cost_assignment(costs):
+    """
+    Solves the assignment problem for 'costs', a matrix with at least as many
+    columns as rows, using the hungarian algorithm. Returns a list 'assignment'
+    such that assigning row i to column assignment[i] has the minimum total
+    cost. Runs in O(rows^2 * cols), so it's only meant for small matrices.
+    see: https://cp-algorithms.com/graph/hungarian-algorithm.html
+    """
+    n = len(costs)
+    m = len(costs[0]) if n else 0
+    assert n <= m
+    inf = float('inf')
+
+    # potentials for rows/cols, and the row matched to each col (1-indexed)
+    u, v, match, way = [0] * (n + 1), [0] * (m + 1), [0] * (m + 1), [0] * (m + 1)
+    for i in range(1, n + 1):
+        match[0] = i
+        j0 = 0
+        min_v = [inf] * (m + 1)
+        used  = [False] * (m + 1)
+        while match[j0] != 0:
+            used[j0] = True
+            i0, delta, j1 = match[j0], inf, None
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = costs[i0 - 1][j - 1] - u[i0] - v[j]
+                    if cur < min_v[j]:
+                        min_v[j], way[j] = cur, j0
+                    if min_v[j] < delta:
+                        delta, j1 = min_v[j], j
+            for j in range(m + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_v[j] -= delta
+            j0 = j1
+        # follow the augmenting path back
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    assignment = [None] * n
+    for j in range(1, m + 1):
+        if match[j]:
+            assignment[match[j] - 1] = j - 1
+    return assignment
+
 def as_fut(obj):
     fut = asyncio.Future()
     fut.set_result(obj)
@@ -51,6 +118,8 @@ def retval_as_fut(coro):
     return fut, wrapped_coro()
 
 def user_set(reacts):
+    if hasattr(reacts, 'user_ids'):
+        return reacts.user_ids()
     return fset(r.user_id for r in reacts)
 
 def rs(user_ids, emojis):
@@ -1,6 +1,7 @@
 import pytest
 from unittest.mock import MagicMock, call, create_autospec
 
+import src.states
 from src.bot_stuff import Bot
 from src.utils import as_fut
 
@@ -26,3 +27,8 @@ def mock_bot(bot):
     return mock_bot
 
 
+
+@pytest.fixture(autouse=True)
+def verify_views(monkeypatch):
+    # check incrementally updated state views against computing them from scratch
+    monkeypatch.setattr(src.states, 'VERIFY_VIEWS', True)
@@ -0,0 +1,61 @@
+import asyncio
+from time import monotonic
+import pytest
+from unittest.mock import MagicMock
+
+from src import animation, mem
+from src.animation import Animation, frame_at, frame_end, frame_start
+from src.scheduler import Bucket, ANIMATE
+
+
+@pytest.fixture
+def fast_clock(monkeypatch):
+    # 10 frames every 0.1s in total, and at most 100 per second each
+    monkeypatch.setattr(animation, 'FRAME_BUDGET', (10, 0.1))
+    monkeypatch.setattr(animation, '_budget', Bucket(10, 0.1))
+    monkeypatch.setattr(animation, 'MIN_FRAME_INTERVAL', 0.01)
+    monkeypatch.setattr(animation, 'BUSY_WAIT', 0.01)
+    monkeypatch.setattr(mem, 'animations', set())
+    bot = MagicMock()
+    bot.scheduler.waiting.return_value = 0
+    return bot
+
+def test_frames():
+    durations = [1, 1, 2]
+    assert [frame_at(t, durations) for t in (0, 0.5, 1, 2, 3.9, 4, 5)] == [0, 0, 1, 2, 2, 0, 1]
+    assert [frame_start(i, durations) for i in range(3)] == [0, 1, 2]
+    # it loops
+    assert [frame_end(t, durations) for t in (0, 1, 2.5, 4, 9)] == [1, 2, 4, 5, 10]
+
+@pytest.mark.asyncio
+async def test_frame_budget_shared(fast_clock):
+    frames = []
+    async def animate(i):
+        anim = Animation(fast_clock)
+        end = monotonic() + 0.5
+        while (now := await anim.next_frame(monotonic())) < end:
+            frames.append((i, now))
+
+    await asyncio.gather(*(animate(i) for i in range(20)))
+    # the budget is 100 frames/s, shared between all of them, so each one
+    # gets a frame every 0.2s instead of every 0.01s
+    assert len(frames) <= 10 + 0.5 * 100
+    for i in range(20):
+        times = [t for j, t in frames if j == i]
+        assert 1 <= len(times) <= 3
+        assert all(b - a >= 0.19 for a, b in zip(times, times[1:]))
+    assert not mem.animations
+
+@pytest.mark.asyncio
+async def test_animations_give_way(fast_clock):
+    anim = Animation(fast_clock)
+    # something more important is waiting to be sent, so no frames are drawn
+    # until it's gone
+    fast_clock.scheduler.waiting.return_value = 1
+    frame = asyncio.ensure_future(anim.next_frame(monotonic()))
+    await asyncio.sleep(0.05)
+    assert not frame.done()
+    fast_clock.scheduler.waiting.assert_called_with(ANIMATE)
+
+    fast_clock.scheduler.waiting.return_value = 0
+    assert await asyncio.wait_for(frame, 1) >= monotonic() - 0.05
@@ -5,7 +5,8 @@ from unittest.mock import call
 from discord import Embed
 
 from src.pug import ChanCtx, React
-from src.bot_stuff import update_discord
+from src.bot_stuff import bot_options, fingerprint, payload, plan_cost, plan_react_removal, update_discord
+from src.scheduler import EDIT
 from src.utils import as_fut
 
 @pytest.fixture
@@ -40,6 +41,15 @@ def test_bot_methods(bot, chan_id):
 
     bot.clear_reactions(chan_id, msg_id)
 
+def test_fingerprint():
+    embed = Embed(title='cat', colour=0xffac33).add_field(name='dog', value='bird')
+    same_embed = Embed(title='cat', colour=0xffac33).add_field(name='dog', value='bird')
+    assert fingerprint(embed) == fingerprint(same_embed) == fingerprint(embed.to_dict())
+    assert fingerprint(embed) != fingerprint(Embed(title='cat'))
+    assert fingerprint('cat') == fingerprint(''.join(['c', 'at'])) != fingerprint('dog')
+    assert payload(embed) == embed.to_dict()
+    assert payload('cat') == 'cat'
+
 @pytest.mark.asyncio
 async def test_update_msgs_noop(mock_bot, chan_id):
     prev_msgs  = { 'cat': 'cat_msg', 'dog': 'dog_msg' }
@@ -53,6 +63,21 @@ async def test_update_msgs_noop(mock_bot, chan_id):
     assert mock_bot.send_message.call_count == 0
     assert mock_bot.delete_message.call_count == 0
 
+@pytest.mark.asyncio
+async def test_update_msgs_noop_embed(mock_bot, chan_id):
+    make_embed = lambda: Embed(title='cat').add_field(name='dog', value='bird')
+    prev_msgs  = { 'cat': make_embed(), 'dog': 'dog_msg' }
+    next_msgs  = { 'cat': make_embed(), 'dog': 'dog_msg' }
+    msg_id_map = { 'cat': 0, 'dog': 1 }
+    exp_id_map = msg_id_map
+
+    # the embeds are different objects, but have the same content
+    msg_id_map = await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, set(), set())
+    assert list(exp_id_map.items()) == list(msg_id_map.items())
+    assert mock_bot.edit_message.call_count == 0
+    assert mock_bot.send_message.call_count == 0
+    assert mock_bot.delete_message.call_count == 0
+
 @pytest.mark.asyncio
 async def test_update_msgs_swap_key(mock_bot, chan_id):
     prev_msgs  = { 'cat': 'cat_msg', 'dog': 'dog_msg' }
@@ -74,7 +99,7 @@ async def test_update_msgs_edit(mock_bot, chan_id):
     msg_id_map = { 'cat': 0, 'dog': 1 }
 
     exp_id_map = msg_id_map
-    exp_edits  = [call(chan_id, exp_id_map['cat'], next_msgs['cat'])]
+    exp_edits  = [call(chan_id, exp_id_map['cat'], next_msgs['cat'], priority=EDIT)]
 
     msg_id_map = await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, set(), set())
     assert list(exp_id_map.items()) == list(msg_id_map.items())
@@ -89,7 +114,7 @@ async def test_update_msgs_edit_duplicate(mock_bot, chan_id):
     msg_id_map = { 'cat': 0, 'dog_then_cat': 1 }
 
     exp_id_map = msg_id_map
-    exp_edits  = [call(chan_id, exp_id_map['dog_then_cat'], next_msgs['dog_then_cat'])]
+    exp_edits  = [call(chan_id, exp_id_map['dog_then_cat'], next_msgs['dog_then_cat'], priority=EDIT)]
 
     msg_id_map = await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, set(), set())
     assert list(exp_id_map.items()) == list(msg_id_map.items())
@@ -113,6 +138,23 @@ async def test_update_msgs_send(mock_bot, chan_id):
     assert mock_bot.send_message.call_args_list == exp_sends
     assert mock_bot.delete_message.call_count == 0
 
+@pytest.mark.asyncio
+async def test_update_msgs_main_sent(mock_bot, chan_id):
+    mock_bot.user_id = 1
+    mock_bot.send_message.side_effect = [as_fut('new_msg_id')]
+    sent, watched_before_react = [], []
+    def add_reaction(chan_id, msg_id, emoji):
+        watched_before_react.append(msg_id in sent)
+        return as_fut(None)
+    mock_bot.add_reaction.side_effect = add_reaction
+
+    # the new main message's id is known before the bot's reacts are added
+    next_msgs = { 'main': 'main_msg' }
+    msg_id_map = await update_discord(mock_bot, chan_id, {}, {}, next_msgs, set(), { React(1, 'XD') },
+                                      on_main_sent=sent.append)
+    assert msg_id_map == { 'main': 'new_msg_id' }
+    assert sent == ['new_msg_id'] and watched_before_react == [True]
+
 @pytest.mark.asyncio
 async def test_update_msgs_send_duplicate(mock_bot, chan_id):
     mock_bot.send_message.side_effect = [as_fut('new_msg_id')]
@@ -171,7 +213,7 @@ async def test_update_msgs_remap_optimal(mock_bot, chan_id):
     msg_id_map = { 'prev': 0, 'curr': 1, 'curr2': 2 }
 
     exp_id_map = { 'prev': 2, 'curr': 1 }
-    exp_edits  = [call(chan_id, exp_id_map['curr'], next_msgs['curr'])]
+    exp_edits  = [call(chan_id, exp_id_map['curr'], next_msgs['curr'], priority=EDIT)]
     exp_dels   = [call(chan_id, msg_id_map['prev'])]
 
     msg_id_map = await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, set(), set())
@@ -194,7 +236,7 @@ async def test_update_msgs_remap_optimal(mock_bot, chan_id):
     msg_id_map = { 'prev': 0, 'curr': 1, 'curr2': 2 }
 
     exp_id_map = { 'prev': 2, 'curr': 1 }
-    exp_edits  = [call(chan_id, exp_id_map['curr'], next_msgs['curr'])]
+    exp_edits  = [call(chan_id, exp_id_map['curr'], next_msgs['curr'], priority=EDIT)]
     exp_dels   = [call(chan_id, msg_id_map['prev'])]
 
     msg_id_map = await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, set(), set())
@@ -204,6 +246,44 @@ async def test_update_msgs_remap_optimal(mock_bot, chan_id):
     assert mock_bot.delete_message.call_args_list == exp_dels
 
 
+@pytest.mark.asyncio
+async def test_update_msgs_remap_edit_optimal(mock_bot, chan_id):
+    """
+    Moving 'cat_msg' from 'dog' to 'cat' forces a send and a delete, but moving
+    it to 'another_cat' and editing 'cat' only needs an edit.
+    """
+    prev_msgs  = { 'cat': 'old_cat_msg', 'dog': 'cat_msg' }
+    next_msgs  = { 'cat': 'cat_msg', 'another_cat': 'cat_msg' }
+    msg_id_map = { 'cat': 0, 'dog': 1 }
+
+    exp_id_map = { 'cat': 0, 'another_cat': 1 }
+    exp_edits  = [call(chan_id, exp_id_map['cat'], next_msgs['cat'], priority=EDIT)]
+
+    msg_id_map = await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, set(), set())
+    assert list(exp_id_map.items()) == list(msg_id_map.items())
+    assert mock_bot.edit_message.call_args_list == exp_edits
+    assert mock_bot.send_message.call_count == 0
+    assert mock_bot.delete_message.call_count == 0
+
+@pytest.mark.asyncio
+async def test_update_msgs_main_to_hist(mock_bot, chan_id):
+    mock_bot.send_message.side_effect = [as_fut('new_msg_id')]
+    prev_msgs  = { 'idle': 'idle_msg' }
+    next_msgs  = { 'vote': 'vote_msg', 0: 'idle_msg' }
+    msg_id_map = { 'idle': 0 }
+    reacts     = { React('bob', 'XD'), React(mock_bot.user_id, 'cap') }
+
+    # the old main message should become a history message, keeping its reacts
+    exp_id_map = { 'vote': 'new_msg_id', 0: 0 }
+    exp_sends  = [call(chan_id, next_msgs['vote'])]
+    msg_id_map = await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, reacts, reacts)
+    assert list(exp_id_map.items()) == list(msg_id_map.items())
+    assert mock_bot.edit_message.call_count == 0
+    assert mock_bot.send_message.call_args_list == exp_sends
+    assert mock_bot.delete_message.call_count == 0
+    assert mock_bot.remove_reaction.call_count == 0
+
+
 @pytest.mark.asyncio
 async def test_update_reacts_noop(mock_bot, chan_id):
     prev_msgs = next_msgs = { 'key': 'msg' }
@@ -249,16 +329,24 @@ async def test_update_reacts_nuke(mock_bot, chan_id):
     prev_msgs = next_msgs = { 'key': 'msg' }
     msg_id_map = { 'key': 'msg_id' }
 
-    prev_reacts = { React('bob', 'XD'), React('alice', ':)') }
+    prev_reacts = { React('bob', 'XD'), React('alice', ':)'), React('tom', ':)') }
     next_reacts = set()
 
-    exp_nuke = [call(chan_id, 'msg_id')]
-
+    # it's still the main message, so clearing everything could also clear a
+    # reaction that's being added
     await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, prev_reacts, next_reacts)
     assert mock_bot.add_reaction.call_count == 0
+    assert mock_bot.clear_reactions.call_count == 0
+    assert mock_bot.remove_reaction.call_args_list == [call(chan_id, 'msg_id', 'XD', 'bob')]
+    assert mock_bot.clear_reaction.call_args_list == [call(chan_id, 'msg_id', ':)')]
+
+    # once there's a new main message, the old one can be nuked
+    mock_bot.reset_mock()
+    next_msgs = { 'new': 'new msg', **prev_msgs }
+    await update_discord(mock_bot, chan_id, msg_id_map, prev_msgs, next_msgs, prev_reacts, next_reacts)
     assert mock_bot.remove_reaction.call_count == 0
     assert mock_bot.clear_reaction.call_count == 0
-    assert mock_bot.clear_reactions.call_args_list == exp_nuke
+    assert mock_bot.clear_reactions.call_args_list == [call(chan_id, 'msg_id')]
 
 @pytest.mark.asyncio
 async def test_update_reacts_dont_nuke(mock_bot, chan_id):
@@ -285,4 +373,54 @@ async def test_update_reacts_dont_nuke(mock_bot, chan_id):
     assert mock_bot.clear_reaction.call_count == 1
     assert mock_bot.clear_reactions.call_count == 0
 
-# TODO: tests for when main message changes
+
+def plan_calls(plan):
+    return [(call.func._mock_name, *call.args[2:]) for calls in plan for call in calls]
+
+def test_plan_react_removal_live(mock_bot, chan_id):
+    bot_id = mock_bot.user_id
+    old_reacts = { React(u, 'XD') for u in ('bob', 'alice', 'tom', bot_id) }
+
+    # the emoji is still in use, so clearing it could remove a reaction that's
+    # being added, even though we're only keeping the bot's reaction
+    new_reacts = { React(bot_id, 'XD') }
+    plan = plan_react_removal(mock_bot, chan_id, 'msg_id', old_reacts, new_reacts, live=True)
+    assert sorted(plan_calls(plan)) == [('remove_reaction', 'XD', u) for u in ('alice', 'bob', 'tom')]
+
+    # ...but once the emoji isn't used, it can be cleared
+    plan = plan_react_removal(mock_bot, chan_id, 'msg_id', old_reacts, set(), live=True)
+    assert plan_calls(plan) == [('clear_reaction', 'XD')]
+
+    # clearing every reaction would be cheaper, but it would also clear ones
+    # being added with new emojis, so each emoji gets cleared on its own
+    old_reacts |= { React(u, 'uwu') for u in ('bob', 'alice', 'tom') }
+    plan = plan_react_removal(mock_bot, chan_id, 'msg_id', old_reacts, set(), live=True)
+    assert sorted(plan_calls(plan)) == [('clear_reaction', 'XD'), ('clear_reaction', 'uwu')]
+    plan = plan_react_removal(mock_bot, chan_id, 'msg_id', old_reacts, set(), live=False)
+    assert plan_calls(plan) == [('clear_reactions',)]
+
+def test_plan_react_removal_dead(mock_bot, chan_id):
+    bot_id = mock_bot.user_id
+    old_reacts = { React(u, e) for u in ('bob', 'alice', 'tom', bot_id) for e in ('XD', 'uwu') }
+    new_reacts = { React(bot_id, 'XD'), React(bot_id, 'uwu') }
+
+    # no one's reacting to the message anymore, so it's cheaper to clear all
+    # the reactions and add the bot's reactions back
+    plan = plan_react_removal(mock_bot, chan_id, 'msg_id', old_reacts, new_reacts, live=False)
+    assert plan_calls(plan) == [('clear_reactions',), ('add_reaction', 'XD'), ('add_reaction', 'uwu')]
+    assert plan_cost(plan) == 3
+
+    # we can't add users' reactions back, so those can't be cleared
+    new_reacts = { React('bob', 'XD'), React(bot_id, 'uwu') }
+    plan = plan_react_removal(mock_bot, chan_id, 'msg_id', old_reacts, new_reacts, live=False)
+    assert sorted(plan_calls(plan), key=str) == sorted([('clear_reaction', 'uwu'), ('add_reaction', 'uwu'),
+                                                        *(('remove_reaction', 'XD', u) for u in ('alice', 'tom', bot_id))], key=str)
+
+
+def test_bot_options():
+    assert bot_options(['src.pug', 'src.eggs']) == {}
+    opts = bot_options(['src.pug', 'src.eggs'], lean=True)
+    intents = opts['intents']
+    assert intents.guilds and intents.guild_messages and intents.guild_reactions and intents.dm_messages
+    assert not (intents.members or intents.presences or intents.guild_typing)
+    assert opts['max_messages'] is None
@@ -0,0 +1,12 @@
+import pytest
+
+from bench.gateway import run
+
+
+@pytest.mark.asyncio
+async def test_gateway_smoke():
+    results = await run(guilds=2, duration=5)
+    default, lean = results['default'], results['lean']
+    # typing events aren't asked for in lean mode
+    assert 0 < lean['events/s'] < default['events/s']
+    assert lean['cached messages'] == 0 < default['cached messages']
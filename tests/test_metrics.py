@@ -0,0 +1,61 @@
+import pytest
+
+from src import mem, metrics
+from src.metrics import Histogram
+from src.utils import paginate
+
+@pytest.fixture(autouse=True)
+def clear_metrics(monkeypatch):
+    monkeypatch.setattr(mem, 'metrics', {})
+
+
+def test_counters():
+    metrics.inc('calls', chan_id=1, kind='edit')
+    metrics.inc('calls', 2, chan_id=1, kind='send')
+    metrics.inc('calls', chan_id=2, kind='edit')
+    assert metrics.total('calls') == 4
+    assert metrics.total('calls', chan_id=1) == 3
+    assert metrics.total('calls', kind='edit') == 2
+    assert metrics.total('calls', chan_id=3) == 0
+    assert metrics.total('other') == 0
+
+def test_histograms():
+    for value in [0.001, 0.002, 0.004, 0.2]:
+        metrics.observe('time', value, chan_id=1)
+    metrics.observe('time', 20, chan_id=2)
+
+    hist = metrics.merged('time', chan_id=1)
+    assert hist.count == 4
+    assert hist.sum == pytest.approx(0.207)
+    assert hist.quantile(0.25) == 0.001
+    assert hist.quantile(0.5) == 0.0025
+    assert hist.quantile(1) == 0.25
+    assert metrics.merged('time').quantile(1) == float('inf')
+    assert Histogram().quantile(0.5) == 0
+
+def test_forget():
+    metrics.inc('calls', chan_id=1, kind='edit')
+    metrics.inc('calls', 2, chan_id=2, kind='edit')
+    metrics.inc('calls', chan_id=3, kind='edit')
+    metrics.observe('time', 0.001, chan_id=1)
+    metrics.observe('time', 0.2, chan_id=2)
+    metrics.forget('chan_id', [1, 2])
+    # the channels' series are gone, but they still count towards the totals
+    assert sorted(labels for (name, labels) in mem.metrics if name == 'calls') == \
+           [(('chan_id', 3), ('kind', 'edit')), (('kind', 'edit'),)]
+    assert metrics.total('calls', chan_id=1) == 0 and metrics.total('calls', kind='edit') == 4
+    assert list(mem.metrics).count(('time', ())) == 1 and metrics.merged('time').count == 2
+
+def test_render():
+    metrics.inc('calls', chan_id=1, kind='edit')
+    with metrics.timer('time'):
+        pass
+    lines = metrics.render().splitlines()
+    assert 'pugbot_calls{chan_id="1",kind="edit"} 1' in lines
+    assert 'pugbot_time_bucket{le="+Inf"} 1' in lines
+    assert 'pugbot_time_count 1' in lines
+
+def test_paginate():
+    lines = ['a' * 4, 'b' * 4, 'c' * 4, 'd' * 20]
+    assert paginate(lines, 9) == ['aaaa\nbbbb', 'cccc', 'ddddddddd']
+    assert paginate([], 9) == ['']
@@ -0,0 +1,65 @@
+import pytest
+from unittest.mock import MagicMock
+
+from src import mem, names
+from src.bot_stuff import mention
+
+
+@pytest.fixture(autouse=True)
+def empty_names(monkeypatch):
+    monkeypatch.setattr(mem, 'names', type(mem.names)())
+    monkeypatch.setattr(mem, 'name_misses', set())
+    monkeypatch.setattr(mem, 'name_task', None)
+    monkeypatch.setattr(names, 'FETCH_DELAY', 0)
+
+@pytest.fixture
+def name_bot():
+    bot = MagicMock()
+    bot.get_user.return_value = None
+    fetched = []
+    async def fetch_name(user_id):
+        fetched.append(user_id)
+        if user_id < 0:
+            raise Exception('unknown user')
+        return f'user{user_id}'
+    bot.fetch_name = fetch_name
+    bot.fetched = fetched
+    return bot
+
+def test_remember_bounded(monkeypatch):
+    monkeypatch.setattr(names, 'NAME_CACHE_SIZE', 3)
+    for user_id in range(5):
+        names.remember(user_id, f'user{user_id}')
+    assert list(mem.names) == [2, 3, 4]
+    # remembering a name again makes it the most recent
+    names.remember(2, 'user2')
+    names.remember(5, 'user5')
+    assert list(mem.names) == [4, 2, 5]
+
+def test_display_name_no_loop(name_bot):
+    # without an event loop there's nothing to fetch with, but it still works
+    assert names.display_name(name_bot, 1) == mention(1)
+    assert not mem.name_misses
+
+@pytest.mark.asyncio
+async def test_display_name_fetches(name_bot):
+    names.remember(1, 'known')
+    assert names.display_name(name_bot, 1) == 'known'
+    assert [names.display_name(name_bot, u) for u in (2, 3, -4)] == [mention(2), mention(3), mention(-4)]
+    assert mem.name_misses == { 2, 3, -4 }
+
+    await mem.name_task
+    assert sorted(name_bot.fetched) == [-4, 2, 3]
+    name_bot.dispatch.assert_called_once_with('names_fetched', { 2, 3 })
+    assert [names.display_name(name_bot, u) for u in (1, 2, 3, -4)] == ['known', 'user2', 'user3', mention(-4)]
+    # the user that couldn't be fetched gets tried again later, not on every render
+    assert not mem.name_misses
+
+@pytest.mark.asyncio
+async def test_display_name_expired(name_bot):
+    names.remember(1, 'old', ttl=0)
+    # old names keep being used until the new one is fetched
+    assert names.display_name(name_bot, 1) == 'old'
+    await mem.name_task
+    assert names.display_name(name_bot, 1) == 'user1'
+    name_bot.dispatch.assert_called_once_with('names_fetched', { 1 })
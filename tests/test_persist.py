@@ -0,0 +1,131 @@
+import asyncio
+from dataclasses import replace
+import threading
+import pytest
+from discord import Embed
+
+from src import mem
+import src.persist
+from src.bot_stuff import fingerprint
+from src.persist import Store, ctx_record, decode, encode, load_record, worker_db_path
+from src.pug import ChanCtx, ChanCtxs
+from src.states import History, React, IdleState, PickState, StoppedState, HOST_EMOJI
+from src.utils import fset
+
+
+def test_encode_state(mock_bot):
+    history = (Embed(title='old pug'), 'PUG started: <@1>')
+    state = IdleState(mock_bot, frozenset({ 1, 2 }), fset({ React(3, HOST_EMOJI) }), history)
+    decoded = decode(encode(state), mock_bot)
+    assert isinstance(decoded, IdleState)
+    assert decoded.bot is mock_bot
+    assert decoded.admin_ids == state.admin_ids
+    assert decoded.reacts == state.reacts
+    assert decoded.host_ids == state.host_ids
+    # embeds come back in their serialized form, which looks the same to discord
+    assert list(map(fingerprint, decoded.history)) == list(map(fingerprint, history))
+
+    state = PickState.make(replace(state, history=('PUG started: <@1>',)), 10, (3, 9), range(1000, 1006))
+    assert decode(encode(state), mock_bot) == state
+
+def test_ctx_record(mock_bot):
+    ctx = ChanCtx(StoppedState(mock_bot, frozenset(), fset(), ('old msg',)))
+    ctx.msg_id_map = { 0: 123, ('ping', 1): 456 }
+    ctx.messages = { 0: 'old msg', ('ping', 1): Embed(title='ping') }
+    ctx.reacts = fset({ React(1, 'XD') })
+
+    restored = ChanCtx(**load_record(ctx_record(ctx), mock_bot))
+    assert restored.state == ctx.state
+    assert list(restored.msg_id_map.items()) == list(ctx.msg_id_map.items())
+    assert { k: fingerprint(m) for k, m in restored.messages.items() } == \
+           { k: fingerprint(m) for k, m in ctx.messages.items() }
+    assert restored.reacts == ctx.reacts
+
+def test_store(tmp_path):
+    path = tmp_path / 'test.db'
+    store = Store(path)
+    store.append(1, 'one')
+    store.append(2, 'two')
+    store.append(1, 'one again')
+    assert store.load() == { 1: 'one again', 2: 'two' }
+
+    store.append(2, None)
+    store.append(3, 'three')
+    store.close()
+    assert Store(path).load() == { 1: 'one again', 3: 'three' }
+
+@pytest.mark.asyncio
+async def test_store_writes_behind(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.persist, 'WRITE_DELAY', 0.01)
+    store = Store(tmp_path / 'test.db')
+    store.append(1, 'one')
+    store.append(2, 'two')
+    store.append(1, 'one again')
+    store.archive(1, [(0, 100, 'old msg')])
+    # nothing's written until the loop has moved on
+    assert store.db.execute('SELECT COUNT(*) FROM log').fetchone() == (0,)
+    await store.write_task
+    # and then only the latest record for each channel
+    assert store.db.execute('SELECT chan_id, record FROM log').fetchall() == [(1, 'one again'), (2, 'two')]
+    assert [msg for _, _, msg in await store.archived(1)] == ['old msg']
+
+    # closing writes whatever hasn't been yet
+    store.append(2, None)
+    store.close()
+    assert Store(tmp_path / 'test.db').load() == { 1: 'one again' }
+
+@pytest.mark.asyncio
+async def test_store_writes_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.persist, 'WRITE_DELAY', 0)
+    store = Store(tmp_path / 'test.db')
+    # the disk is slow, so the background write of the old record is still
+    # waiting when a newer one gets flushed
+    disk = threading.Event()
+    store.submit(disk.wait)
+    store.append(1, 'old')
+    await asyncio.sleep(0.01)
+    store.append(1, 'new')
+    flushed = store.flush()
+    disk.set()
+    await asyncio.wrap_future(flushed)
+    await store.write_task
+    assert store.load() == { 1: 'new' }
+
+def test_store_layout(tmp_path):
+    path = tmp_path / 'test.db'
+    store = Store(path)
+    assert store.load(layout=(2, 4)) == {}
+    store.append(1, 'one')
+    store.archive(1, [(0, 100, 'old msg')])
+    store.close()
+    assert Store(path).load(layout=(2, 4)) == { 1: 'one' }
+    # with a different number of workers, channel 1 might belong to another
+    # one now, so nothing's restored, then or later
+    assert Store(path).load(layout=(3, 4)) == {}
+    assert Store(path).load(layout=(3, 4)) == {}
+
+def test_worker_db_path():
+    assert worker_db_path(0, 'pugbot.db') == 'pugbot.db'
+    assert worker_db_path(2, 'data/pugbot.db') == 'data/pugbot.2.db'
+
+def test_deleted_ctx_not_restored(bot, tmp_path, monkeypatch):
+    bot.owner_id = 1
+    monkeypatch.setattr(mem, 'store', Store(tmp_path / 'test.db'))
+    chan_ctxs = ChanCtxs(bot)
+    mem.store.append(5, ctx_record(chan_ctxs[5]))
+    mem.store.append(6, ctx_record(chan_ctxs[6]))
+    del chan_ctxs[5]
+    assert list(mem.store.load()) == [6]
+
+@pytest.mark.asyncio
+async def test_archive(mock_bot, tmp_path):
+    history = History(('a', 'b'), base=5)
+    assert decode(encode(history), mock_bot) == history
+    assert decode(encode(history), mock_bot).base == 5
+
+    store = Store(tmp_path / 'test.db')
+    store.archive(1, [(0, 100, 'old msg'), (1, 101, Embed(title='old pug'))])
+    store.archive(2, [(0, 200, 'other msg')])
+    [(key, msg_id, msg), (key2, msg_id2, embed)] = await store.archived(1)
+    assert (key, msg_id, msg) == (0, 100, 'old msg')
+    assert (key2, msg_id2) == (1, 101) and fingerprint(embed) == fingerprint(Embed(title='old pug'))
@@ -0,0 +1,389 @@
+import asyncio
+from dataclasses import dataclass, replace
+from functools import cached_property
+from itertools import chain
+import pytest
+
+from discord import PartialEmoji, RawReactionActionEvent
+
+from src import mem, metrics
+import src.pug
+from src.pug import ChanCtx, ChanCtxs, React, archive_history, reconcile_reacts, set_msg_ids, reduce_sequence, state_sequence, status_pages, update_reacts, update_state
+from src.eggs import DanceState
+from src.states import State, History, StoppedState, IdleState, VoteState, MIN_PLAYERS, HOST_EMOJI, CAPT_EMOJI, DONE_EMOJI, OPTION_EMOJIS
+from src.utils import alist, fset
+
+MAIN_ID = 42
+
+@pytest.fixture
+def chan_ctx(mock_bot):
+    ctx = ChanCtx(StoppedState(mock_bot, set(), fset(), tuple()))
+    ctx.msg_id_map = { 'main': MAIN_ID }
+    return ctx
+
+@pytest.fixture
+def state_updates(monkeypatch):
+    updates = []
+    async def update_state(bot, ctx, chan_id, next_state_fn):
+        updates.append(ctx.reacts)
+    monkeypatch.setattr(src.pug, 'update_state', update_state)
+    return updates
+
+
+@pytest.mark.asyncio
+async def test_react_burst_is_batched(mock_bot, chan_ctx, state_updates):
+    reacts = { React(u, 'XD') for u in range(12) }
+    for r in reacts:
+        update_reacts(mock_bot, chan_ctx, 100, MAIN_ID, r, True)
+    await chan_ctx.react_task
+
+    assert state_updates == [reacts]
+    assert chan_ctx.react_task is None
+    assert not chan_ctx.react_events
+
+@pytest.mark.asyncio
+async def test_react_add_remove_cancels(mock_bot, chan_ctx, state_updates):
+    bob, alice = React('bob', 'XD'), React('alice', 'XD')
+    update_reacts(mock_bot, chan_ctx, 100, MAIN_ID, bob, True)
+    update_reacts(mock_bot, chan_ctx, 100, MAIN_ID, alice, True)
+    update_reacts(mock_bot, chan_ctx, 100, MAIN_ID, bob, False)
+    await chan_ctx.react_task
+    assert state_updates == [{ alice }]
+
+    # nothing changes, so no update should happen
+    update_reacts(mock_bot, chan_ctx, 100, MAIN_ID, bob, True)
+    update_reacts(mock_bot, chan_ctx, 100, MAIN_ID, bob, False)
+    await chan_ctx.react_task
+    assert state_updates == [{ alice }]
+
+@pytest.mark.asyncio
+async def test_react_other_message_ignored(mock_bot, chan_ctx, state_updates):
+    update_reacts(mock_bot, chan_ctx, 100, MAIN_ID + 1, React('bob', 'XD'), True)
+    await chan_ctx.react_task
+    assert state_updates == []
+
+
+@pytest.mark.asyncio
+async def test_react_ends_dance(mock_bot, chan_ctx, monkeypatch):
+    async def update_discord(*args, **kwargs):
+        return { 'main': MAIN_ID }
+    monkeypatch.setattr(src.pug, 'update_discord', update_discord)
+    monkeypatch.setattr(src.pug, 'EDIT_MAX_STALENESS', 0)
+    mock_bot.user_id = 1
+    mock_bot.scheduler.waiting.return_value = 0
+    admin_id, chan_id = 2, 100
+
+    # a dance's update never finishes by itself
+    dance = DanceState.make(chan_ctx.state, admin_ids={ admin_id })
+    asyncio.ensure_future(update_state(mock_bot, chan_ctx, chan_id, lambda c: dance))
+    await asyncio.sleep(0.01)
+
+    # so reacts can't wait for it, or nobody could stop the dance
+    update_reacts(mock_bot, chan_ctx, chan_id, MAIN_ID, React(5, 'XD'), True)
+    await asyncio.wait_for(chan_ctx.react_task, 1)
+    update_reacts(mock_bot, chan_ctx, chan_id, MAIN_ID, React(admin_id, DONE_EMOJI), True)
+    await asyncio.wait_for(chan_ctx.react_task, 1)
+    while chan_id in mem.update_tasks:
+        await asyncio.sleep(0.01)
+    assert isinstance(chan_ctx.state, StoppedState)
+    assert not chan_ctx.react_events
+
+
+@pytest.mark.asyncio
+async def test_reconcile_reacts(mock_bot, chan_ctx, state_updates):
+    chan_ctx.reacts = fset({ React('bob', 'XD'), React('alice', 'XD'), React('tom', 'uwu') })
+
+    # nothing's changed
+    mock_bot.reaction_counts.return_value = { 'XD': 2, 'uwu': 1 }
+    assert not await reconcile_reacts(mock_bot, chan_ctx, 100)
+    assert mock_bot.reaction_users.call_count == 0
+    assert state_updates == []
+
+    # we missed alice removing her react, and joe adding one
+    mock_bot.reaction_counts.return_value = { 'XD': 1, 'uwu': 1, ':)': 1 }
+    users = { 'XD': ['bob'], ':)': ['joe'] }
+    mock_bot.reaction_users.side_effect = lambda chan_id, msg_id, emoji: users[emoji]
+    assert await reconcile_reacts(mock_bot, chan_ctx, 100)
+    # only the emojis that changed should have been fetched
+    assert sorted(c.args[2] for c in mock_bot.reaction_users.call_args_list) == [':)', 'XD']
+    assert state_updates == [{ React('bob', 'XD'), React('tom', 'uwu'), React('joe', ':)') }]
+
+
+async def probe_sequence(start_state):
+    # the old way of running states, which calls on_update() on the final
+    # state to see whether it's stable
+    state_seq = start_state.on_update()
+    while True:
+        async for state in state_seq:
+            yield state
+        state_seq = state.on_update()
+        if state == (next_state := await state_seq.__anext__()):
+            return
+        yield (state := next_state)
+
+@pytest.mark.parametrize('n_players', [0, 4, 10, 12])
+@pytest.mark.asyncio
+async def test_reduce_sequence(mock_bot, n_players):
+    reacts = { React(u, OPTION_EMOJIS[u % 4]) for u in range(n_players) }
+    reacts |= { React(0, HOST_EMOJI), React(1, CAPT_EMOJI), React(2, CAPT_EMOJI) }
+    state = IdleState.make(State(mock_bot, { 1234 }, fset(), tuple()), reacts=reacts)
+
+    # embeds only compare equal to themselves, so compare history by length
+    def summary(states):
+        return [(replace(s, history=()), len(s.history)) for s in states]
+    expected = await alist(probe_sequence(state))
+    assert summary(reduce_sequence(state)) == summary(expected)
+    assert summary(await alist(state_sequence(state))) == summary(expected)
+    assert expected[-1].is_stable
+
+@dataclass(frozen=True)
+class CountState(State):
+    """ Counts to 3, waiting 'delay' between each number if it's set """
+    n: int = 0
+    delay: float = 0
+    # the bot reacts when it gets to this number
+    react_at: int = 0
+
+    @cached_property
+    def messages(state):
+        return { 'main': str(state.n) }
+
+    def next(state):
+        reacts = state.reacts | ({ React(state.bot.user_id, 'XD') } if state.n + 1 == state.react_at else set())
+        return replace(state, n=state.n + 1, reacts=reacts)
+
+    async def on_update(state):
+        yield state
+        while state.n < 3:
+            if state.delay:
+                await asyncio.sleep(state.delay)
+            yield (state := state.next())
+
+@pytest.mark.parametrize('delay,staleness,react_at,sent', [
+    (0,    1,    0, ['3']),            # states that come right away are never sent
+    (0.05, 1,    0, ['3']),
+    (0.05, 0.01, 0, ['1', '2', '3']),  # but they're only held for so long
+    (0.05, 1,    1, ['1', '3']),       # and bot reacts aren't held at all
+])
+@pytest.mark.asyncio
+async def test_update_state_debounced(mock_bot, chan_ctx, monkeypatch, delay, staleness, react_at, sent):
+    monkeypatch.setattr(src.pug, 'EDIT_MAX_STALENESS', staleness)
+    mock_bot.user_id = 1
+    msgs = []
+    async def update_discord(bot, chan_id, msg_ids, key_to_msg, key_to_new_msg, *args, **kwargs):
+        msgs.append(key_to_new_msg['main'])
+        return { 'main': MAIN_ID }
+    monkeypatch.setattr(src.pug, 'update_discord', update_discord)
+
+    state = CountState(mock_bot, set(), fset(), (), delay=delay, react_at=react_at)
+    chan_ctx.messages = state.messages
+    final_state = await update_state(mock_bot, chan_ctx, 100, lambda c: state)
+    assert msgs == sent
+    assert final_state.n == 3 and chan_ctx.state is final_state
+    assert chan_ctx.messages == { 'main': '3' }
+
+@pytest.mark.asyncio
+async def test_update_state_superseded(mock_bot, chan_ctx, monkeypatch):
+    monkeypatch.setattr(src.pug, 'EDIT_MAX_STALENESS', 0)
+    async def update_discord(*args, **kwargs):
+        return { 'main': MAIN_ID }
+    monkeypatch.setattr(src.pug, 'update_discord', update_discord)
+    chan_id = 100
+    cancelled = metrics.total('updates_cancelled', chan_id=chan_id)
+
+    # an update that takes forever
+    slow = CountState(mock_bot, set(), fset(), (), delay=60)
+    slow_update = asyncio.ensure_future(update_state(mock_bot, chan_ctx, chan_id, lambda c: slow))
+    await asyncio.sleep(0.01)
+    assert chan_ctx.state == slow
+    assert len(mem.update_tasks[chan_id]) == 1
+
+    # a new update cancels it straight away, instead of it waiting to notice
+    fast = CountState(mock_bot, set(), fset(), ())
+    assert (await update_state(mock_bot, chan_ctx, chan_id, lambda c: fast)).n == 3
+    assert await asyncio.wait_for(slow_update, 1) is None
+    assert metrics.total('updates_cancelled', chan_id=chan_id) == cancelled + 1
+    assert chan_id not in mem.update_tasks
+    assert chan_ctx.state.n == 3 and chan_ctx.messages == { 'main': '3' }
+
+@pytest.fixture
+def lobby(mock_bot, chan_ctx, monkeypatch):
+    """
+    A channel with an idle pug that's one player short, which records what
+    gets sent to discord. New messages get new ids, like they do on discord.
+    """
+    monkeypatch.setattr(src.pug, 'EDIT_MAX_STALENESS', 0)
+    mock_bot.user_id = 1
+    ids = iter(range(MAIN_ID + 1, MAIN_ID + 100))
+    sent = []
+    async def update_discord(bot, chan_id, msg_ids, key_to_msg, key_to_new_msg, old_reacts, new_reacts, **kwargs):
+        sent.append((next(iter(key_to_new_msg)), new_reacts))
+        return { key: msg_ids[key] if key in msg_ids else next(ids) for key in key_to_new_msg }
+    monkeypatch.setattr(src.pug, 'update_discord', update_discord)
+
+    reacts = { React(u, 'XD') for u in range(10, 10 + MIN_PLAYERS - 1) }
+    [*_, state] = reduce_sequence(IdleState.make(State(mock_bot, { 1234 }, fset(), tuple()), reacts=reacts))
+    chan_ctx.state, chan_ctx.messages, chan_ctx.reacts = state, state.messages, state.reacts
+    chan_ctx.msg_id_map = { 'idle': MAIN_ID }
+    return sent
+
+def assert_voting(chan_ctx, sent):
+    # the vote message is sent and gets its vote reacts, before anyone's voted
+    assert isinstance(chan_ctx.state, VoteState)
+    bot_reacts = { React(1, e) for e in chain(chan_ctx.state.host_emojis, chan_ctx.state.capt_emojis) }
+    assert ('vote', bot_reacts) in [(key, reacts.with_users((1,))) for key, reacts in sent]
+    assert chan_ctx.reacts == chan_ctx.state.reacts == bot_reacts
+
+@pytest.mark.asyncio
+async def test_update_state_new_main_message(mock_bot, chan_ctx, lobby):
+    chan_ctx.reacts |= { React(10 + MIN_PLAYERS, 'XD') }
+    await update_state(mock_bot, chan_ctx, 100, lambda c: replace(c.state, reacts=c.reacts))
+    assert_voting(chan_ctx, lobby)
+
+@pytest.mark.asyncio
+async def test_react_starts_vote(mock_bot, chan_ctx, lobby):
+    # the last player joining goes through the mailbox like any other react
+    update_reacts(mock_bot, chan_ctx, 100, MAIN_ID, React(10 + MIN_PLAYERS, 'XD'), True)
+    await asyncio.wait_for(chan_ctx.react_task, 1)
+    while 100 in mem.update_tasks:
+        await asyncio.sleep(0.01)
+    assert_voting(chan_ctx, lobby)
+
+class AnimatedCountState(CountState):
+    animated = True
+
+@pytest.mark.parametrize('state_cls,saves', [(CountState, 3), (AnimatedCountState, 1)])
+@pytest.mark.asyncio
+async def test_animation_frames_not_saved(mock_bot, chan_ctx, monkeypatch, state_cls, saves):
+    monkeypatch.setattr(src.pug, 'EDIT_MAX_STALENESS', 0)
+    async def update_discord(*args, **kwargs):
+        return { 'main': MAIN_ID }
+    monkeypatch.setattr(src.pug, 'update_discord', update_discord)
+    saved = []
+    monkeypatch.setattr(src.pug, 'save_ctx', lambda chan_id, ctx: saved.append(ctx.state.n))
+
+    # each number is sent as its own frame
+    state = state_cls(mock_bot, set(), fset(), (), n=1, delay=0.01)
+    chan_ctx.messages = state.messages
+    await update_state(mock_bot, chan_ctx, 100, lambda c: state)
+    assert len(saved) == saves
+
+def test_archive_history(mock_bot, chan_ctx):
+    chan_ctx.msg_id_map = { 'main': MAIN_ID, 3: 103, 4: 104, 5: 105 }
+    chan_ctx.messages = { 'main': 'main msg', 3: 'three', 4: 'four', 5: 'five' }
+    chan_ctx.reacts = fset({ React(1, 'XD') })
+    messages = chan_ctx.messages
+
+    state = StoppedState(mock_bot, set(), fset(), History(('five',), base=5))
+    archive_history(chan_ctx, 100, state)
+    # the dropped messages are just forgotten about, not deleted
+    assert chan_ctx.msg_id_map == { 'main': MAIN_ID, 5: 105 }
+    assert list(chan_ctx.messages) == ['main', 5] and len(messages) == 4
+    assert chan_ctx.reacts == { React(1, 'XD') }
+
+def test_chan_ctxs_eviction(bot, monkeypatch):
+    monkeypatch.setattr(src.pug, 'MAX_CHAN_CTXS', 2)
+    monkeypatch.setattr(src.pug, 'CTX_GRACE_SECONDS', -1)
+    bot.owner_id = 1
+    chan_ctxs = ChanCtxs(bot)
+    chan_ctxs[1].msg_id_map = { 0: 100 }
+    chan_ctxs[1].messages = { 0: 'old msg' }
+    busy = chan_ctxs[2]
+    busy.react_events[0, React(5, 'XD')] = True
+    metrics.inc('react_events', 3, chan_id=1)
+    react_events = metrics.total('react_events')
+
+    # 1 is the least recently used, so it's the one that gets evicted
+    chan_ctxs[3]
+    assert list(chan_ctxs.keys()) == [2, 3] and 1 in chan_ctxs
+    # its metrics go too, but still count towards the totals
+    assert metrics.total('react_events', chan_id=1) == 0
+    assert metrics.total('react_events') == react_events
+    # 2 has events waiting, so it can't be evicted
+    chan_ctxs[4]
+    assert list(chan_ctxs.keys()) == [2, 4] and 3 in chan_ctxs
+
+    # evicted contexts come back the same as they were
+    ctx = chan_ctxs[1]
+    assert ctx.msg_id_map == { 0: 100 } and ctx.messages == { 0: 'old msg' }
+    assert chan_ctxs[2] is busy
+    assert 5 not in chan_ctxs
+
+    del chan_ctxs[3]
+    assert 3 not in chan_ctxs
+    chan_ctxs.clear()
+    assert 1 not in chan_ctxs and 4 not in chan_ctxs
+
+@pytest.mark.asyncio
+async def test_watched_msg_ids(bot, state_updates, monkeypatch):
+    monkeypatch.setattr(mem, 'watched_msg_ids', set())
+    bot.load_extension('src.pug')
+    try:
+        ctx = mem.chan_ctxs[100]
+        set_msg_ids(ctx, { 'main': MAIN_ID, 0: 7 })
+        assert mem.watched_msg_ids == { MAIN_ID }
+
+        [on_raw_reaction] = bot.extra_events['on_raw_reaction_add']
+        def react(msg_id):
+            return RawReactionActionEvent({ 'message_id': msg_id, 'channel_id': 100, 'user_id': 5 },
+                                          PartialEmoji(name='XD'), 'REACTION_ADD')
+        ignored = metrics.total('reacts_ignored')
+        # reacts to other messages are dropped straight away
+        await on_raw_reaction(react(7))
+        assert ctx.react_events == {} and metrics.total('reacts_ignored') == ignored + 1
+        await on_raw_reaction(react(MAIN_ID))
+        assert list(ctx.react_events) == [(MAIN_ID, React(5, 'XD'))]
+        await ctx.react_task
+
+        # the main message changing stops it being watched
+        set_msg_ids(ctx, { 'other': 8 })
+        assert mem.watched_msg_ids == { 8 }
+    finally:
+        bot.unload_extension('src.pug')
+        mem.chan_ctxs.pop(100, None)
+
+@pytest.mark.asyncio
+async def test_react_to_new_main_message(bot, monkeypatch):
+    monkeypatch.setattr(mem, 'watched_msg_ids', set())
+    monkeypatch.setattr(src.pug, 'EDIT_MAX_STALENESS', 0)
+    new_id = MAIN_ID + 1
+    bot_reacts_added = asyncio.Event()
+    async def update_discord(bot, chan_id, msg_ids, key_to_msg, key_to_new_msg, *args, on_main_sent=None, **kwargs):
+        if not msg_ids:
+            # the main message is sent, but adding the bot's reacts takes a while
+            if on_main_sent is not None:
+                on_main_sent(new_id)
+            await bot_reacts_added.wait()
+        return { key: new_id for key in key_to_new_msg }
+    monkeypatch.setattr(src.pug, 'update_discord', update_discord)
+    bot.load_extension('src.pug')
+    try:
+        ctx = mem.chan_ctxs[100]
+        update = asyncio.ensure_future(update_state(bot, ctx, 100, lambda c: StoppedState.make(c.state, history=('msg',))))
+        await asyncio.sleep(0.01)
+
+        # someone reacts before the update's done, which still counts
+        [on_raw_reaction] = bot.extra_events['on_raw_reaction_add']
+        await on_raw_reaction(RawReactionActionEvent({ 'message_id': new_id, 'channel_id': 100, 'user_id': 5 },
+                                                     PartialEmoji(name='XD'), 'REACTION_ADD'))
+        assert list(ctx.react_events) == [(new_id, React(5, 'XD'))]
+        bot_reacts_added.set()
+        await update
+        await ctx.react_task
+        assert ctx.reacts == { React(5, 'XD') } and ctx.state.reacts == { React(5, 'XD') }
+    finally:
+        bot.unload_extension('src.pug')
+        mem.chan_ctxs.pop(100, None)
+
+@pytest.mark.parametrize('workers', [1, 8, 30])
+def test_status_pages(workers):
+    # a long summary from each worker, and lots of channels between them
+    summary = '\n'.join(['x' * 60] * 6)
+    results = [([f"{i:<18} | IdleState     |     3 |     0 |      5 |     0 |     1" for i in range(100)], summary)
+               for _ in range(workers)]
+    results[-1] = None
+    pages = status_pages(results)
+    assert all(len(page) <= 2000 for page in pages)
+    text = ''.join(pages)
+    assert text.count('IdleState') == 100 * (workers - 1) and text.count('x' * 60) == 6 * (workers - 1)
+    assert f"worker {workers - 1} not responding" in text or workers == 1
@@ -0,0 +1,23 @@
+import pytest
+
+from bench.reaction_storm import run, run_workers
+
+
+@pytest.mark.asyncio
+async def test_reaction_storm_smoke():
+    results = await run(channels=3, rate=20, duration=0.5, latency=0, reloads=1)
+    assert results['events'] > 0
+    assert results['transitions'] > 0
+    assert 0 < results['latency p50 (ms)'] <= results['latency max (ms)']
+    assert results['api calls by method'].keys() <= { 'edit_message', 'add_reaction', 'remove_reaction', 'remove_own_reaction',
+                                                      'clear_single_reaction', 'clear_reactions', 'send_message', 'delete_message', 'get_user' }
+    # the bot's limits are lower than discord's
+    assert results['429s'] == results['setup 429s'] == 0
+    assert results['bytes/channel'] > 0
+    assert results['nondeterministic edits'] == 0
+
+def test_reaction_storm_workers():
+    results = run_workers(2, channels=12, rate=20, duration=0.5, latency=0)
+    assert results['channels'] == 12 and results['events'] > 0
+    # the status broadcast gets to every worker's channels
+    assert results['channels in status'] == 12
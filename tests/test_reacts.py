@@ -0,0 +1,79 @@
+from itertools import product
+import random
+import pytest
+
+import src.reacts
+from src.reacts import React, Reacts
+from src.utils import fset
+
+
+def random_reacts(rand):
+    return fset(React(rand.randrange(200), rand.choice('abcde')) for _ in range(rand.randrange(30)))
+
+@pytest.mark.parametrize('seed', range(20))
+def test_same_as_frozenset(seed):
+    rand = random.Random(seed)
+    a, b = random_reacts(rand), random_reacts(rand)
+    ra, rb = Reacts(a), Reacts(b)
+
+    assert ra == a and a == ra and hash(ra) == hash(a)
+    assert len(ra) == len(a) and set(ra) == a
+    for op in ['__or__', '__and__', '__sub__', '__xor__', '__le__', '__ge__', '__lt__', '__gt__', '__eq__']:
+        expected = getattr(a, op)(b)
+        # Reacts with Reacts, and mixed with regular sets in both directions
+        assert getattr(ra, op)(rb) == expected
+        assert getattr(ra, op)(b) == expected
+        assert getattr(a, op)(rb) in (expected, NotImplemented)
+    assert a - rb == a - b and a | rb == a | b and a & rb == a & b
+    assert (a <= rb) == (a <= b)
+    # sets made from each other share their users, which goes a faster way
+    shared = ra | rb
+    for x, y in [(shared - rb, rb), (shared & ra, shared - ra)]:
+        for op in ['__or__', '__and__', '__sub__', '__xor__', '__le__', '__eq__']:
+            result, expected = getattr(x, op)(y), getattr(fset(x), op)(fset(y))
+            assert result == expected and (isinstance(result, bool) or len(result) == len(expected))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_one_at_a_time(seed):
+    rand = random.Random(seed)
+    reacts, expected = Reacts(), fset()
+    for _ in range(300):
+        react = React(rand.randrange(50), rand.choice('abc'))
+        if rand.random() < 0.4:
+            reacts, expected = reacts - { react }, expected - { react }
+        else:
+            reacts, expected = reacts | { react }, expected | { react }
+        assert reacts == expected and len(reacts) == len(expected)
+    # nothing changing gives back the same set
+    assert reacts | set() is reacts and reacts - { React('never seen', 'a') } is reacts
+
+def test_user_table_compacted(monkeypatch):
+    monkeypatch.setattr(src.reacts, 'USER_TABLE_MIN', 8)
+    reacts = Reacts()
+    for user_id in range(100):
+        reacts = (reacts | { React(user_id, 'a') }) - { React(user_id - 3, 'a') }
+    # only the last few users are left, so the masks stay narrow
+    assert reacts == { React(u, 'a') for u in range(97, 100) }
+    assert len(reacts._users.ids) <= 4 * 8 and max(reacts._masks.values()).bit_length() <= 4 * 8
+
+def test_contains():
+    reacts = Reacts({ React(1, 'a'), React(2, 'b') })
+    assert React(1, 'a') in reacts and (2, 'b') in reacts
+    assert React(1, 'b') not in reacts
+    assert React('never seen', 'a') not in reacts
+    assert 'junk' not in reacts
+
+def test_queries():
+    reacts = Reacts({ React(1, 'a'), React(2, 'a'), React(2, 'b'), React(3, 'c') })
+    assert reacts.emojis() == { 'a', 'b', 'c' }
+    assert reacts.user_ids() == { 1, 2, 3 }
+    assert reacts.with_emoji('a', 'c') == { React(1, 'a'), React(2, 'a'), React(3, 'c') }
+    assert reacts.with_emoji('never seen') == set()
+    assert reacts.without_emoji('a') == { React(2, 'b'), React(3, 'c') }
+    assert reacts.with_users({ 2, 4 }) == { React(2, 'a'), React(2, 'b') }
+    assert reacts.without_users({ 2 }) == { React(1, 'a'), React(3, 'c') }
+
+def test_empty():
+    assert Reacts() == set() == Reacts({ React(1, 'a') }) - { React(1, 'a') }
+    assert not Reacts()
+    assert hash(Reacts()) == hash(fset())
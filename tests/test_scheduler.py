@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+
+from src.scheduler import Scheduler, EDIT, SEND, REACT, DELETE, CLEANUP
+
+@pytest.fixture
+def scheduler():
+    return Scheduler(global_limit=(100, 1), route_limits={ 'a': (1, 0.01), 'b': (100, 1) })
+
+
+@pytest.mark.asyncio
+async def test_priority_order(scheduler):
+    sent = []
+    def make_request(name):
+        async def send():
+            sent.append(name)
+            return name
+        return send
+
+    priorities = [CLEANUP, SEND, DELETE, EDIT, REACT, EDIT]
+    results = await asyncio.gather(*(scheduler.request(p, ('a', 0), make_request(i))
+                                     for i, p in enumerate(priorities)))
+    assert results == list(range(len(priorities)))
+    # requests are sent by priority, and then by the order they came in
+    assert sent == [3, 5, 1, 4, 2, 0]
+    assert scheduler.queue_depth == 0
+    assert scheduler.sent == len(priorities)
+    assert scheduler.max_wait > 0
+
+@pytest.mark.asyncio
+async def test_routes_dont_block_each_other(scheduler):
+    sent = []
+    def make_request(name):
+        async def send():
+            sent.append(name)
+        return send
+
+    # 'a' only allows 1 request at a time, so the low priority requests on
+    # route 'b' should get sent before the second 'a' request.
+    await asyncio.gather(scheduler.request(EDIT, ('a', 0), make_request('a1')),
+                         scheduler.request(EDIT, ('a', 0), make_request('a2')),
+                         scheduler.request(CLEANUP, ('b', 0), make_request('b1')))
+    assert sent == ['a1', 'b1', 'a2']
+
+@pytest.mark.asyncio
+async def test_errors_are_passed_on(scheduler):
+    async def send():
+        raise ValueError()
+    with pytest.raises(ValueError):
+        await scheduler.request(EDIT, ('b', 0), send)
+
+@pytest.mark.asyncio
+async def test_superseded_requests_dropped(scheduler):
+    sent = []
+    def make_request(name):
+        async def send():
+            sent.append(name)
+            return name
+        return send
+
+    # once an edit's been sent, a new one with the same key is sent too
+    assert await scheduler.request(EDIT, ('a', 0), make_request('e1'), key='msg') == 'e1'
+    # route 'a' only allows 1 request at a time, so these are queued up
+    # together, and only the last edit gets sent. it keeps the place of the
+    # one it replaced.
+    results = await asyncio.gather(scheduler.request(EDIT, ('a', 0), make_request('e2'), key='msg'),
+                                   scheduler.request(EDIT, ('a', 0), make_request('x')),
+                                   scheduler.request(EDIT, ('a', 0), make_request('e3'), key='msg'))
+    assert sent == ['e1', 'e3', 'x']
+    # the dropped request gets the result of the one that replaced it
+    assert results == ['e3', 'x', 'e3']
+    assert scheduler.superseded == 1 and not scheduler.keyed
@@ -0,0 +1,53 @@
+import asyncio
+from multiprocessing import Pipe
+from threading import Thread
+import pytest
+
+from src.shards import Peer, Router, shard_for, worker_shards
+
+
+def test_shard_for():
+    # the shard only depends on the timestamp part of the id
+    assert shard_for(5 << 22, 4) == 1
+    assert shard_for((5 << 22) + 12345, 4) == 1
+    assert shard_for(5 << 22, 1) == 0
+
+def test_worker_shards():
+    shards = [worker_shards(w, 3, 8) for w in range(3)]
+    assert shards == [[0, 3, 6], [1, 4, 7], [2, 5]]
+
+
+@pytest.mark.asyncio
+async def test_router_broadcast():
+    loop = asyncio.get_event_loop()
+    pipes = [Pipe() for _ in range(3)]
+    router = Thread(target=Router(r for r, _ in pipes).run)
+    router.start()
+
+    calls = []
+    def make_peer(i, conn):
+        async def whoami(x):
+            calls.append(i)
+            return (i, x)
+        async def broken():
+            raise ValueError()
+        peer = Peer(conn, { 'whoami': whoami, 'broken': broken })
+        peer.start(loop)
+        return peer
+    peers = [make_peer(i, w) for i, (_, w) in enumerate(pipes)]
+
+    # every worker answers, and the results are in worker order
+    assert await peers[1].broadcast('whoami', 'hi') == [(0, 'hi'), (1, 'hi'), (2, 'hi')]
+    assert sorted(calls) == [0, 1, 2]
+    assert await peers[0].broadcast('broken') == [None, None, None]
+
+    # workers that have gone away are skipped
+    loop.remove_reader(pipes[2][1].fileno())
+    pipes[2][1].close()
+    assert await peers[0].broadcast('whoami', 1) == [(0, 1), (1, 1), None]
+
+    for peer in peers[:2]:
+        loop.remove_reader(peer.conn.fileno())
+        peer.conn.close()
+    router.join(timeout=1)
+    assert not router.is_alive()
@@ -1,12 +1,20 @@
 import asyncio
-from dataclasses import replace
+from collections import OrderedDict
+from dataclasses import dataclass, replace
 from itertools import chain
 import random
 import pytest
 
-from src.states import State, IdleState, VoteState, PickState, RunningState, StoppedState
+import src.eggs
+import src.mem
+import src.states
+from src import names
+from src.eggs import DANCE, DanceState, forget_frames
+from src.states import State, History, IdleState, VoteState, PickState, RunningState, StoppedState
+from src.states import HISTORY_LEN, renders
 from src.states import MIN_HOSTS, MIN_CAPTS, MIN_PLAYERS
 from src.states import React, HOST_EMOJI, CAPT_EMOJI, SKIP_EMOJI, WAIT_EMOJI, SHUFFLE_EMOJI, OPTION_EMOJIS, DONE_EMOJI
+from src.bot_stuff import fingerprint
 from src.utils import alist, fset
 
 TEST_ADMIN_ID = 1234
@@ -60,6 +68,25 @@ def test_idle_props(mock_bot):
     # accessing messages doesn't cause an exception
     state.messages
 
+@pytest.mark.parametrize('seed', range(5))
+def test_idle_views_incremental(mock_bot, seed):
+    # VERIFY_VIEWS is on in tests, so every step checks the incrementally
+    # updated views against computing them from scratch
+    rand = random.Random(seed)
+    emojis = [HOST_EMOJI, CAPT_EMOJI, SKIP_EMOJI, WAIT_EMOJI, 'a', 'b']
+    user_ids = [mock_bot.user_id, TEST_ADMIN_ID, *range(10)]
+    state = IdleState(mock_bot, { TEST_ADMIN_ID }, fset(), tuple())
+    for _ in range(50):
+        react = React(rand.choice(user_ids), rand.choice(emojis))
+        reacts = state.reacts - { react } if react in state.reacts else state.reacts | { react }
+        state = replace(state, reacts=reacts)
+        if rand.random() < 0.7:
+            state.player_ids
+    # views are carried over to new states
+    views = state.views
+    assert replace(state, reacts=state.reacts).prev_views is views
+
+
 
 admin_wait = { React(TEST_ADMIN_ID, WAIT_EMOJI) }
 admin_skip = { React(TEST_ADMIN_ID, SKIP_EMOJI) }
@@ -170,3 +197,122 @@ async def test_running_update(base_state):
     next_states = await alist(init_state.on_update())
     assert isinstance(next_states[-1], StoppedState)
     [state.messages for state in next_states]
+
+def test_renders_memoized(base_state):
+    state = PickState.make(base_state, 10, (3, 9), range(1000, 1004))
+    # reacts don't show up in the pick message, so changing them reuses it
+    reacted = replace(state, reacts={ React(3, OPTION_EMOJIS[0]) })
+    assert reacted.messages is state.messages
+    # picking someone does show up
+    picked = replace(state, team_ids=((1000,), ()), pick_idx=1)
+    assert picked.messages is not state.messages
+    assert fingerprint(picked.messages['pick']) == fingerprint(PickState.messages.render(picked)['pick'])
+    assert fingerprint(picked.messages['pick']) != fingerprint(state.messages['pick'])
+
+    idle = IdleState.make(base_state, reacts={ React(1, HOST_EMOJI) })
+    # the idle message shows who's reacted, so a new host changes it
+    assert replace(idle, reacts=idle.reacts | { React(2, HOST_EMOJI) }).messages is not idle.messages
+    assert replace(idle, reacts=idle.reacts | { React(1, HOST_EMOJI) }).messages is idle.messages
+
+def test_renders_dict_deps(base_state):
+    @dataclass(frozen=True)
+    class ScoreState(State):
+        scores: dict = None
+
+        @renders('scores')
+        def messages(state):
+            return { 'scores': repr(state.scores) }
+
+    state = ScoreState(base_state.bot, base_state.admin_ids, base_state.reacts, base_state.history, { 'red': 1 })
+    assert replace(state, scores={ 'red': 1 }).messages is state.messages
+    # same keys, different values
+    assert replace(state, scores={ 'red': 2 }).messages == { 'scores': "{'red': 2}" }
+    # values that can't be hashed just get rendered every time
+    assert replace(state, scores={ 'red': [1] }).messages == { 'scores': "{'red': [1]}" }
+
+def test_renders_deterministic(base_state, monkeypatch):
+    idle = IdleState.make(base_state, reacts={ React(10 + i, e) for i, e in enumerate(OPTION_EMOJIS[:4]) })
+    # rendering the same state from scratch (e.g. after a reload) gives the same messages
+    render = lambda: fingerprint(IdleState.messages.render(replace(idle))['idle'])
+    assert len({ render() for _ in range(10) }) == 1
+    # the player emoji is picked randomly otherwise
+    monkeypatch.setattr(src.states, 'DETERMINISTIC_RENDERS', False)
+    random.seed(0)
+    assert len({ render() for _ in range(10) }) > 1
+
+def test_renders_set_order(base_state):
+    # these ids collide in a small set, so the order they're added in changes
+    # the order the set iterates in
+    ids = [1 + 8*i for i in range(4)]
+    orders = [ids, ids[::-1]]
+    assert list(fset(ids)) != list(fset(ids[::-1]))
+    def render(state):
+        return { k: fingerprint(m) for k, m in type(state).messages.render(state).items() }
+
+    def make_idle(order):
+        # people react one at a time, so the views get updated in that order
+        state = IdleState.make(base_state)
+        for u in order:
+            state = replace(state, reacts=state.reacts | { React(u, e) for e in (HOST_EMOJI, CAPT_EMOJI, OPTION_EMOJIS[0]) })
+        return state
+    make_vote = lambda order: VoteState.make(base_state, fset(order), fset(order), fset(order))
+    make_pick = lambda order: PickState.make(base_state, 100, (200, 300), fset(order))
+    for make in (make_idle, make_vote, make_pick):
+        state, other = map(make, orders)
+        assert render(state) == render(other)
+
+@pytest.mark.asyncio
+async def test_dance_frames_memoized(base_state, monkeypatch):
+    monkeypatch.setattr(src.mem, 'names', OrderedDict())
+    monkeypatch.setattr(DanceState, 'frame_cache', {})
+    for user_id in (1, 2, 3):
+        names.remember(user_id, f"user{user_id}")
+    dance = DanceState.make(base_state, users=frozenset({ 1, 2 }))
+    # every frame gets rendered the first time one's needed, and a tick just
+    # looks its frame up, however the same dancers were put together
+    frames = [replace(dance, dance_idx=i).messages for i in range(len(DANCE))]
+    assert [users for users, _ in DanceState.frame_cache] == [{ 1, 2 }]
+    assert replace(dance, dance_idx=3, reacts={ React(1, DONE_EMOJI) }).messages is frames[3]
+    assert replace(dance, dance_idx=3, users=frozenset({ 2 }) | { 1 }).messages is frames[3]
+    # new dancers get their own frames, and the old ones' are dropped
+    updates = replace(dance, reacts={ React(3, DONE_EMOJI) }).on_update()
+    joined = await updates.__anext__()
+    await updates.aclose()
+    assert joined.messages is not frames[0] and [users for users, _ in DanceState.frame_cache] == [{ 1, 2, 3 }]
+    # renamed dancers get rendered again
+    names.remember(2, 'someone else')
+    forget_frames({ 2 })
+    assert joined.messages['main'].title == 'user1 someone else user3'
+    # and stopping drops them
+    stopped = await alist(replace(joined, reacts={ React(TEST_ADMIN_ID, DONE_EMOJI) }).on_update())
+    assert isinstance(stopped[-1], StoppedState) and not DanceState.frame_cache
+
+def test_dance_frames_shared(base_state, monkeypatch):
+    monkeypatch.setattr(DanceState, 'frame_cache', {})
+    renders = []
+    monkeypatch.setattr(src.eggs, 'render_rng', lambda *seed: renders.append(seed) or random.Random(repr(seed)))
+    # two channels dancing with the same (lack of) dancers, one with history
+    dances = [DanceState.make(base_state), DanceState.make(base_state, history=('old pug',))]
+    ticks = [[replace(dance, dance_idx=i).messages for i in range(len(DANCE))] for dance in dances]
+    assert len(renders) == 2 * len(DANCE)
+    # taking turns doesn't make either of them render their frames again
+    for i in range(len(DANCE)):
+        for dance, frames in zip(dances, ticks):
+            assert replace(dance, dance_idx=i).messages is frames[i]
+    assert len(renders) == 2 * len(DANCE)
+    assert list(ticks[1][0]) == ['main', 0] and list(ticks[0][0]) == ['main']
+    # and with the same history, they share
+    assert replace(dances[0], history=History()).messages is ticks[0][0]
+
+def test_history(base_state):
+    history = History()
+    for i in range(HISTORY_LEN + 5):
+        history = history + (f"msg {i}",)
+    # only the tail is kept, under the same keys as before
+    assert len(history) == HISTORY_LEN and history.base == 5
+    assert history.keyed() == { i: f"msg {i}" for i in range(5, HISTORY_LEN + 5) }
+    assert history != tuple(history) and History(history[1:], base=6) != history
+    assert History(('a',)) == ('a',) and hash(History(('a',))) == hash(('a',))
+
+    state = StoppedState.make(base_state, history=history)
+    assert list(state.messages) == list(range(5, HISTORY_LEN + 5))